@@ -208,25 +208,36 @@ class PostProcess:
         print("---------------------------------------")
         while likelihood_limit is False:
             print("Getting results...")
-            results = search.get_results(res_num, chunk_size)
+            chunk_lh = search.get_results_array()["lh"][res_num : res_num + chunk_size]
+            if len(chunk_lh) == 0:
+                break
             print("---------------------------------------")
             print("Chunk Start = %i" % res_num)
-            print("Chunk Max Likelihood = %.2f" % results[0].lh)
-            print("Chunk Min. Likelihood = %.2f" % results[-1].lh)
+            print("Chunk Max Likelihood = %.2f" % chunk_lh[0])
+            print("Chunk Min. Likelihood = %.2f" % chunk_lh[-1])
             print("---------------------------------------")
 
+            # Stop as soon as we hit a result below our limit, because anything after
+            # that is not guarrenteed to be valid due to potential on-GPU filtering.
+            num_valid = len(chunk_lh)
+            below_limit = np.flatnonzero(chunk_lh < lh_level)
+            if len(below_limit) > 0:
+                likelihood_limit = True
+                num_valid = below_limit[0]
+            results = search.get_results(res_num, num_valid)
+
+            # Extract the curves of all the valid results at once. They are converted
+            # to float64 to match the precision of the per-row curves.
+            psi_curves, phi_curves = search.get_result_curves(res_num, num_valid)
+            psi_curves = psi_curves.astype(np.float64)
+            phi_curves = phi_curves.astype(np.float64)
+
             result_batch = ResultList(self._mjds)
-            for i, trj in enumerate(results):
-                # Stop as soon as we hit a result below our limit, because anything after
-                # that is not guarrenteed to be valid due to potential on-GPU filtering.
-                if trj.lh < lh_level:
-                    likelihood_limit = True
-                    break
+            for i in range(num_valid):
+                trj = results[i]
                 if trj.lh < max_lh:
                     row = ResultRow(trj, len(self._mjds))
-                    psi_curve = np.array(search.psi_curves(trj))
-                    phi_curve = np.array(search.phi_curves(trj))
-                    row.set_psi_phi(psi_curve, phi_curve)
+                    row.set_psi_phi(psi_curves[i], phi_curves[i])
                     result_batch.append_result(row)
                     total_count += 1
 
@@ -241,6 +252,10 @@ class PostProcess:
 
                 # Add the results to the final set.
                 keep.extend(result_batch)
+
+            # Stop if we have reached the end of the results.
+            if len(chunk_lh) < chunk_size:
+                likelihood_limit = True
             res_num += chunk_size
         return keep
 
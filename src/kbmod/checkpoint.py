@@ -0,0 +1,145 @@
+"""Checkpoint and resume long searches.
+
+``checkpointed_search`` splits a search into blocks of starting rows (and optionally
+of the trajectory grid), searches them one at a time and saves each block's results
+to a checkpoint directory as soon as it finishes. The psi and phi images are saved
+there too. Running it again with the same directory, input images and settings (for
+example after the process was killed) reloads the psi and phi images, skips the
+finished blocks and produces exactly the same results as an uninterrupted run.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from .parallel_search import configure_search, merge_pixel_results, search_bands
+from .psi_phi_cache import load_psi_phi, save_psi_phi
+
+_manifest_file = "manifest.json"
+_psi_phi_file = "psi_phi.npy"
+
+
+def _atomic_save(filename, array):
+    """Save an array with ``numpy.save`` so that the file is either complete or missing."""
+    tmp_file = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp_file, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_file, filename)
+
+
+def checkpointed_search(
+    search, search_args, settings, checkpoint_dir, num_blocks=16, ranges=None, max_blocks=None, input_key=None
+):
+    """Run a search in blocks, saving the progress to a checkpoint directory.
+
+    If the directory already holds a checkpoint of the same search, its psi and phi
+    images are reused and its finished blocks are skipped. When all of the blocks are
+    done, their results are merged (see ``merge_pixel_results``) and stored in the
+    search.
+
+    Parameters
+    ----------
+    search : ``kbmod.search.stack_search``
+        The search.
+    search_args : list
+        The arguments to ``stack_search.search``.
+    settings : dict
+        The search settings (see ``kbmod.parallel_search.configure_search``).
+    checkpoint_dir : str
+        The checkpoint directory (created if needed).
+    num_blocks : int
+        The number of bands of starting rows to split the search into.
+    ranges : list
+        The blocks of the trajectory grid to search separately (see
+        ``kbmod.parallel_search.grid_ranges``). By default each band searches
+        the whole grid.
+    max_blocks : int
+        The maximum number of blocks to search in this call (default no limit).
+    input_key : str
+        An identifier of the input images and their masking, such as the last of
+        ``kbmod.psi_phi_cache.psi_phi_cache_keys``. If not given, the search's psi and
+        phi images are generated and their hash is used instead, so the saved ones
+        are never reused (only the finished blocks are).
+
+    Returns
+    -------
+    done : bool
+        Whether all of the blocks are done (and the results set).
+
+    Raises
+    ------
+    ValueError if the checkpoint directory holds a checkpoint of a different search.
+    """
+    if ranges is None:
+        ranges = [settings.get("grid_range")]
+    bounds = search_bands(search, settings, num_blocks)
+    blocks = [[b, r] for b in bounds for r in ranges]
+
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    manifest_file = os.path.join(checkpoint_dir, _manifest_file)
+    psi_phi_file = os.path.join(checkpoint_dir, _psi_phi_file)
+
+    # Without a key for the inputs, identify them by their psi and phi images.
+    new_psi_phi_file = None
+    if input_key is None:
+        new_psi_phi_file = f"{psi_phi_file}.{os.getpid()}.new"
+        save_psi_phi(search, new_psi_phi_file)
+        input_key = hashlib.sha256(np.load(new_psi_phi_file, mmap_mode="r")).hexdigest()
+
+    stack = search.get_image_stack()
+    manifest = {
+        "input_key": input_key,
+        "search_args": list(search_args),
+        "settings": settings,
+        "blocks": blocks,
+        "shape": [stack.img_count(), stack.get_height(), stack.get_width()],
+        "times": list(stack.get_times()),
+    }
+    # Compare the JSON forms so tuples and lists (and float formatting) match.
+    manifest = json.loads(json.dumps(manifest))
+
+    if os.path.exists(manifest_file):
+        with open(manifest_file, "r") as f:
+            if json.load(f) != manifest:
+                if new_psi_phi_file is not None:
+                    os.remove(new_psi_phi_file)
+                raise ValueError(f"{checkpoint_dir} holds a checkpoint of a different search.")
+    else:
+        tmp_file = f"{manifest_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_file, manifest_file)
+
+    if new_psi_phi_file is not None:
+        os.replace(new_psi_phi_file, psi_phi_file)
+    elif os.path.exists(psi_phi_file):
+        load_psi_phi(search, psi_phi_file)
+    else:
+        save_psi_phi(search, psi_phi_file)
+
+    configure_search(search, settings)
+    num_searched = 0
+    block_files = []
+    for i, (y_bounds, grid_range) in enumerate(blocks):
+        block_file = os.path.join(checkpoint_dir, f"block_{i}.npy")
+        block_files.append(block_file)
+        if os.path.exists(block_file):
+            continue
+        if max_blocks is not None and num_searched >= max_blocks:
+            return False
+
+        search.set_start_bounds_y(*y_bounds)
+        search.set_grid_range(*(grid_range or [0, -1, 0, -1]))
+        search.search(*search_args)
+        _atomic_save(block_file, search.get_results_array())
+        num_searched += 1
+
+    max_results = -1
+    if settings.get("result_filter") is not None:
+        max_results = settings["result_filter"][1]
+    results_per_pixel = settings.get("results_per_pixel") or search.get_results_per_pixel()
+    arrays = [np.load(block_file) for block_file in block_files]
+    search.set_results_array(merge_pixel_results(arrays, results_per_pixel, max_results))
+    return True
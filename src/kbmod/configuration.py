@@ -36,11 +36,16 @@ class KBMODConfig:
             "average_angle": None,
             "bary_dist": None,
             "center_thresh": 0.00,
+            "checkpoint_blocks": 16,
+            "checkpoint_dir": None,
             "chunk_size": 500000,
             "clip_negative": False,
             "cluster_function": "DBSCAN",
             "cluster_type": "all",
+            "coarse_bin_factor": 1,
+            "coarse_lh_fraction": 0.5,
             "debug": False,
+            "dedup_trajectories": False,
             "do_clustering": True,
             "do_mask": True,
             "do_stamp_filter": True,
@@ -54,22 +59,29 @@ class KBMODConfig:
             "known_obj_thresh": None,
             "known_obj_jpl": False,
             "lh_level": 10.0,
+            "lh_pruning": False,
             "mask_bits_dict": default_mask_bits_dict,
             "mask_bit_vector": None,
             "mask_grow": 10,
             "mask_num_images": 2,
             "mask_threshold": None,
             "max_lh": 1000.0,
+            "max_results": -1,
             "mjd_lims": None,
             "mom_lims": [35.5, 35.5, 2.0, 0.3, 0.3],
             "num_cores": 1,
             "num_obs": 10,
+            "num_search_workers": 1,
             "output_suffix": "search",
             "peak_offset": [2.0, 2.0],
             "psf_val": 1.4,
             "psf_file": None,
+            "psi_phi_cache_dir": None,
             "repeated_flag_keys": default_repeated_flag_keys,
             "res_filepath": None,
+            "result_filter": False,
+            "results_per_pixel": 8,
+            "search_mode": "grid",
             "sigmaG_lims": [25, 75],
             "stamp_radius": 10,
             "stamp_type": "sum",
@@ -15,6 +15,11 @@ def apply_mask_operations(stack, mask_list):
     """Apply a series of masking operations defined by a list of
     ImageMasker objects.
 
+    The masks that can be described as ``kbmod.search.mask_step`` objects
+    (see `ImageMasker.mask_steps`) are combined into a single plan that is
+    applied with one pass over each image. Any other masks are applied in
+    order with their own ``apply_mask``.
+
     Parameters
     ----------
     stack : `kbmod.image_stack`
@@ -27,11 +32,35 @@ def apply_mask_operations(stack, mask_list):
     stack : `kbmod.image_stack`
         The same stack object to allow chaining.
     """
+    steps = []
     for mask in mask_list:
-        stack = mask.apply_mask(stack)
+        mask_steps = _compiled_mask_steps(mask)
+        if mask_steps is None:
+            # Apply the pending steps first to keep the order of the masks.
+            if len(steps) > 0:
+                stack.apply_mask_steps(steps)
+                steps = []
+            stack = mask.apply_mask(stack)
+        else:
+            steps.extend(mask_steps)
+
+    if len(steps) > 0:
+        stack.apply_mask_steps(steps)
     return stack
 
 
+def _compiled_mask_steps(mask):
+    """Return the mask's steps, or None if it must be applied with ``apply_mask``.
+
+    A subclass that overrides ``apply_mask`` without also overriding ``mask_steps``
+    is applied with its own ``apply_mask``.
+    """
+    steps_owner = next(cls for cls in type(mask).__mro__ if "mask_steps" in cls.__dict__)
+    if type(mask).apply_mask is not steps_owner.apply_mask:
+        return None
+    return mask.mask_steps()
+
+
 class ImageMasker(abc.ABC):
     """The base class for masking operations."""
 
@@ -54,6 +83,18 @@ class ImageMasker(abc.ABC):
         """
         pass
 
+    def mask_steps(self):
+        """Describe the mask as a list of ``kbmod.search.mask_step`` objects so
+        it can be combined with other masks by `apply_mask_operations`.
+
+        Returns
+        -------
+        steps : `list` or None
+            The steps that give the same result as ``apply_mask`` or None if the
+            mask can only be applied with ``apply_mask``.
+        """
+        return None
+
 
 class BitVectorMasker(ImageMasker):
     """Apply a mask given a bit vector of masking flags to use
@@ -89,6 +130,22 @@ class BitVectorMasker(ImageMasker):
             stack.apply_mask_flags(self.flags, self.exception_list)
         return stack
 
+    def mask_steps(self):
+        """Describe the mask as a list of ``kbmod.search.mask_step`` objects.
+
+        Returns
+        -------
+        steps : `list`
+            The steps that give the same result as ``apply_mask``.
+        """
+        if self.flags == 0:
+            return []
+        step = kb.mask_step()
+        step.operation = kb.MASK_FLAGS
+        step.flags = self.flags
+        step.exceptions = list(self.exception_list)
+        return [step]
+
 
 class DictionaryMasker(BitVectorMasker):
     """Apply a mask given a dictionary of masking condition to key
@@ -162,6 +219,22 @@ class GlobalDictionaryMasker(ImageMasker):
             stack.apply_global_mask(self.global_flags, self.mask_num_images)
         return stack
 
+    def mask_steps(self):
+        """Describe the mask as a list of ``kbmod.search.mask_step`` objects.
+
+        Returns
+        -------
+        steps : `list`
+            The steps that give the same result as ``apply_mask``.
+        """
+        if self.global_flags == 0:
+            return []
+        step = kb.mask_step()
+        step.operation = kb.MASK_GLOBAL_FLAGS
+        step.flags = self.global_flags
+        step.num_images = self.mask_num_images
+        return [step]
+
 
 class ThresholdMask(ImageMasker):
     """Mask pixels over a given value.
@@ -192,6 +265,19 @@ class ThresholdMask(ImageMasker):
         stack.apply_mask_threshold(self.mask_threshold)
         return stack
 
+    def mask_steps(self):
+        """Describe the mask as a list of ``kbmod.search.mask_step`` objects.
+
+        Returns
+        -------
+        steps : `list`
+            The steps that give the same result as ``apply_mask``.
+        """
+        step = kb.mask_step()
+        step.operation = kb.MASK_THRESHOLD
+        step.threshold = self.mask_threshold
+        return [step]
+
 
 class GrowMask(ImageMasker):
     """Apply a mask that grows the current max out a given number of pixels.
@@ -224,3 +310,16 @@ class GrowMask(ImageMasker):
         """
         stack.grow_mask(self.num_pixels)
         return stack
+
+    def mask_steps(self):
+        """Describe the mask as a list of ``kbmod.search.mask_step`` objects.
+
+        Returns
+        -------
+        steps : `list`
+            The steps that give the same result as ``apply_mask``.
+        """
+        step = kb.mask_step()
+        step.operation = kb.MASK_GROW
+        step.steps = self.num_pixels
+        return [step]
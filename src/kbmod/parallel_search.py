@@ -0,0 +1,378 @@
+"""Run a single search over several processes.
+
+The psi and phi images are computed once, copied into a block of shared memory and
+attached by each worker process. Each worker searches a band of starting pixels
+(rows) and/or a block of the trajectory grid with its own ``stack_search`` and the
+results are merged back into one likelihood sorted result set that matches a single
+process search.
+"""
+
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import kbmod.search as kb
+
+_search_modes = {
+    "grid": kb.SearchMode.SEARCH_GRID,
+    "shift_stack": kb.SearchMode.SEARCH_SHIFT_STACK,
+    "tree": kb.SearchMode.SEARCH_TREE,
+}
+
+
+def configure_search(search, settings):
+    """Apply a dictionary of search settings to a ``stack_search``.
+
+    The settings are plain python values so they can be passed to other processes.
+    Missing keys (or ``None`` values) leave the search's defaults unchanged.
+
+    Parameters
+    ----------
+    search : ``kbmod.search.stack_search``
+        The search to configure.
+    settings : dict
+        The settings with the (optional) keys:
+        ``search_mode`` ("grid", "shift_stack" or "tree"), ``dedup_trajectories`` (bool),
+        ``coarse_search`` ([bin_factor, min_lh]), ``lh_pruning`` (bool),
+        ``results_per_pixel`` (int), ``result_filter`` ([min_lh, max_results]),
+        ``sigmag_filter`` ([[low, high], coeff, min_lh]), ``encoding`` ([psi_bytes, phi_bytes]),
+        ``bary_corr`` (list of 6 coefficients per image), ``x_bounds`` ([min, max]),
+        ``y_bounds`` ([min, max]), ``grid_range`` ([angle_start, angle_end,
+        velocity_start, velocity_end]) and ``debug`` (bool).
+
+    Raises
+    ------
+    ValueError if the search mode is unknown.
+    """
+    mode = settings.get("search_mode")
+    if mode is not None:
+        if mode not in _search_modes:
+            raise ValueError(f"Unknown search_mode {mode}")
+        search.set_search_mode(_search_modes[mode])
+    if settings.get("dedup_trajectories"):
+        search.set_dedup_trajectories(True)
+    if settings.get("coarse_search") is not None:
+        search.enable_coarse_search(*settings["coarse_search"])
+    if settings.get("lh_pruning"):
+        search.set_lh_pruning(True)
+    if settings.get("results_per_pixel") is not None:
+        search.set_results_per_pixel(settings["results_per_pixel"])
+    if settings.get("result_filter") is not None:
+        search.enable_result_filter(*settings["result_filter"])
+    if settings.get("sigmag_filter") is not None:
+        search.enable_gpu_sigmag_filter(*settings["sigmag_filter"])
+    if settings.get("encoding") is not None:
+        search.enable_gpu_encoding(*settings["encoding"])
+    if settings.get("bary_corr") is not None:
+        search.enable_corr(list(settings["bary_corr"]))
+    if settings.get("x_bounds") is not None:
+        search.set_start_bounds_x(*settings["x_bounds"])
+    if settings.get("y_bounds") is not None:
+        search.set_start_bounds_y(*settings["y_bounds"])
+    if settings.get("grid_range") is not None:
+        search.set_grid_range(*settings["grid_range"])
+    if settings.get("debug"):
+        search.set_debug(True)
+
+
+class SharedPsiPhi:
+    """The psi and phi images of a search held in a block of shared memory.
+
+    The block holds a float32 array of shape (2, num_images, height, width) with the
+    psi images followed by the phi images. Pickling the object only passes the name
+    of the block, so workers attach to the same memory instead of copying it.
+
+    Attributes
+    ----------
+    shape : tuple
+        The shape of the shared array.
+    times : list
+        The (zero based) times of the images.
+    """
+
+    def __init__(self, shm, shape, times, owner=False):
+        self._shm = shm
+        self._owner = owner
+        self.shape = tuple(shape)
+        self.times = list(times)
+
+    @classmethod
+    def from_search(cls, search):
+        """Compute the psi and phi images of a search (if needed) and copy them into
+        a new block of shared memory.
+
+        Parameters
+        ----------
+        search : ``kbmod.search.stack_search``
+            The search to use.
+
+        Returns
+        -------
+        shared : ``SharedPsiPhi``
+            The shared images. The caller must call ``unlink`` when done.
+        """
+        stack = search.get_image_stack()
+        shape = (2, stack.img_count(), stack.get_height(), stack.get_width())
+
+        shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * 4)
+        shared = cls(shm, shape, stack.get_times(), owner=True)
+        search.fill_psi_phi_array(shared.array())
+        return shared
+
+    def __getstate__(self):
+        return {"name": self._shm.name, "shape": self.shape, "times": self.times}
+
+    def __setstate__(self, state):
+        self._shm = shared_memory.SharedMemory(name=state["name"])
+        self._owner = False
+        self.shape = state["shape"]
+        self.times = state["times"]
+
+    def array(self):
+        """Return a numpy view of the shared images (valid until ``close``)."""
+        return np.ndarray(self.shape, dtype=np.float32, buffer=self._shm.buf)
+
+    def make_search(self):
+        """Create a ``stack_search`` that uses the shared psi and phi images.
+
+        The search's image stack only holds the size and times of the images (see
+        ``image_stack.has_pixels``) and the psi and phi images are copied once from
+        the shared memory, so it can only be used to search (not to create stamps).
+
+        Returns
+        -------
+        search : ``kbmod.search.stack_search``
+            The new search.
+        """
+        stack = kb.image_stack(self.shape[3], self.shape[2], self.times)
+        search = kb.stack_search(stack)
+        search.set_psi_phi_array(self.array())
+        return search
+
+    def close(self):
+        """Detach from the shared memory."""
+        self._shm.close()
+
+    def unlink(self):
+        """Detach from and free the shared memory (only in the creating process)."""
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+def shard_bounds(y_min, y_max, num_shards, align=1):
+    """Split the rows [y_min, y_max) into contiguous bands.
+
+    Parameters
+    ----------
+    y_min : int
+        The first starting row.
+    y_max : int
+        One past the last starting row.
+    num_shards : int
+        The maximum number of bands.
+    align : int
+        The band boundaries (other than y_min and y_max) are multiples of this
+        value. Use the coarse search's bin factor so neighboring bands do not
+        both search the same binned rows.
+
+    Returns
+    -------
+    bounds : list
+        A list of [start, end) pairs covering the rows in order.
+    """
+    if y_max <= y_min:
+        return [[y_min, y_max]]
+    cuts = [y_min]
+    for i in range(1, num_shards):
+        cut = y_min + ((y_max - y_min) * i) // num_shards
+        cut = ((cut + align // 2) // align) * align
+        if cut > cuts[-1] and cut < y_max:
+            cuts.append(cut)
+    cuts.append(y_max)
+    return [[cuts[i], cuts[i + 1]] for i in range(len(cuts) - 1)]
+
+
+def search_bands(search, settings, num_shards):
+    """Split the starting rows of a search into bands.
+
+    Parameters
+    ----------
+    search : ``kbmod.search.stack_search``
+        The search.
+    settings : dict
+        The search settings (see ``configure_search``). Uses the ``y_bounds``
+        (default the image height) and the coarse search's bin factor.
+    num_shards : int
+        The maximum number of bands.
+
+    Returns
+    -------
+    bounds : list
+        A list of [start, end) pairs (see ``shard_bounds``).
+    """
+    y_min, y_max = settings.get("y_bounds") or [0, search.get_image_stack().get_height()]
+    align = 1
+    if settings.get("coarse_search") is not None:
+        align = max(1, int(settings["coarse_search"][0]))
+    return shard_bounds(y_min, y_max, num_shards, align)
+
+
+def grid_ranges(angle_steps, velocity_steps, num_angle_shards, num_velocity_shards=1):
+    """Split a search grid into blocks of angle and velocity steps.
+
+    Parameters
+    ----------
+    angle_steps : int
+        The number of angle steps in the grid.
+    velocity_steps : int
+        The number of velocity steps in the grid.
+    num_angle_shards : int
+        The maximum number of blocks of angle steps.
+    num_velocity_shards : int
+        The maximum number of blocks of velocity steps.
+
+    Returns
+    -------
+    ranges : list
+        A list of [angle_start, angle_end, velocity_start, velocity_end] blocks
+        (see ``stack_search.set_grid_range``) in grid order.
+    """
+    angles = shard_bounds(0, angle_steps, num_angle_shards)
+    velocities = shard_bounds(0, velocity_steps, num_velocity_shards)
+    return [[a[0], a[1], v[0], v[1]] for a in angles for v in velocities]
+
+
+def merge_results(arrays, max_results=-1):
+    """Merge the structured result arrays of several searches.
+
+    Parameters
+    ----------
+    arrays : list
+        The (non-empty list of) structured arrays (see ``stack_search.get_results_array``).
+    max_results : int
+        The maximum number of results to keep (-1 keeps all of them).
+
+    Returns
+    -------
+    results : numpy.ndarray
+        A structured array sorted by decreasing likelihood. Ties keep the
+        order of ``arrays``.
+    """
+    merged = np.concatenate(arrays)
+    merged = merged[np.argsort(-merged["lh"], kind="stable")]
+    if max_results > 0:
+        merged = merged[:max_results]
+    return merged
+
+
+def merge_pixel_results(arrays, results_per_pixel, max_results=-1):
+    """Merge the structured result arrays of searches over different parts of the
+    trajectory grid (and possibly different starting pixels).
+
+    Each pixel keeps its best ``results_per_pixel`` results from all of the arrays,
+    which are the results a single search of the combined grid finds for it.
+
+    Parameters
+    ----------
+    arrays : list
+        The (non-empty list of) structured arrays (see ``stack_search.get_results_array``).
+    results_per_pixel : int
+        The number of results to keep for each starting pixel.
+    max_results : int
+        The maximum number of results to keep (-1 keeps all of them).
+
+    Returns
+    -------
+    results : numpy.ndarray
+        A structured array sorted by decreasing likelihood. Equal likelihoods at a
+        pixel keep the order of ``arrays``.
+    """
+    merged = np.concatenate(arrays)
+    if len(merged) == 0:
+        return merged
+
+    # Sort by pixel and then by decreasing likelihood (lexsort is stable) and keep
+    # the first results_per_pixel entries of each pixel.
+    merged = merged[np.lexsort((-merged["lh"], merged["x"], merged["y"]))]
+    new_pixel = np.ones(len(merged), dtype=bool)
+    new_pixel[1:] = (merged["x"][1:] != merged["x"][:-1]) | (merged["y"][1:] != merged["y"][:-1])
+    index = np.arange(len(merged))
+    rank = index - np.maximum.accumulate(np.where(new_pixel, index, 0))
+    return merge_results([merged[rank < results_per_pixel]], max_results)
+
+
+def _search_shard(shared, settings, search_args, y_bounds, grid_range):
+    """Search one band of starting rows (and block of the grid) in a worker process."""
+    search = shared.make_search()
+    configure_search(search, dict(settings, y_bounds=y_bounds, grid_range=grid_range))
+    search.search(*search_args)
+    results = search.get_results_array().copy()
+    shared.close()
+    return results
+
+
+def parallel_search(search, search_args, settings, num_workers, num_shards=None, ranges=None):
+    """Run a search over several processes and store the merged results in it.
+
+    Each worker searches a band of starting rows (and optionally a block of the
+    trajectory grid) with the same settings. Each pixel keeps its best results
+    from all of the blocks and the results are merged by likelihood, so the
+    search's results match running ``search.search(*search_args)`` in one process.
+    When several trajectories have exactly the same likelihood at a pixel (for
+    example because they only differ in samples off the image), splitting the grid
+    may keep a different one of them than the single search, whose choice depends
+    on the order the trajectories are evaluated in. The likelihoods are the same.
+
+    Parameters
+    ----------
+    search : ``kbmod.search.stack_search``
+        The search. Its psi and phi images are computed (if needed) and shared
+        with the workers.
+    search_args : list
+        The arguments to ``stack_search.search``: the number of angle and velocity
+        steps, the min and max angle, the min and max velocity and the minimum
+        number of observations.
+    settings : dict
+        The search settings (see ``configure_search``).
+    num_workers : int
+        The number of worker processes.
+    num_shards : int
+        The number of bands of rows (default ``num_workers`` without ``ranges``
+        and 1 with them).
+    ranges : list
+        The blocks of the trajectory grid to search separately as
+        [angle_start, angle_end, velocity_start, velocity_end] lists (see
+        ``grid_ranges``). By default each band searches the whole grid.
+
+    Returns
+    -------
+    search : ``kbmod.search.stack_search``
+        The search with the merged results.
+    """
+    if num_shards is None:
+        num_shards = num_workers if ranges is None else 1
+    if ranges is None:
+        ranges = [settings.get("grid_range")]
+
+    bounds = search_bands(search, settings, num_shards)
+    shards = [(b, r) for b in bounds for r in ranges]
+
+    shared = SharedPsiPhi.from_search(search)
+    try:
+        # Use fresh processes so the workers do not inherit GPU state.
+        ctx = mp.get_context("spawn")
+        with ctx.Pool(min(num_workers, len(shards))) as pool:
+            arrays = pool.starmap(
+                _search_shard, [(shared, settings, list(search_args), b, r) for b, r in shards]
+            )
+    finally:
+        shared.unlink()
+
+    max_results = -1
+    if settings.get("result_filter") is not None:
+        max_results = settings["result_filter"][1]
+    results_per_pixel = settings.get("results_per_pixel") or search.get_results_per_pixel()
+    search.set_results_array(merge_pixel_results(arrays, results_per_pixel, max_results))
+    return search
@@ -0,0 +1,217 @@
+"""Save, load and cache the psi and phi images of a search.
+
+The images are stored as one float32 array of shape (2, num_images, height, width)
+(psi followed by phi) in ``numpy.save`` format, so they can be memory mapped
+without any parsing. ``PsiPhiCache`` keeps these files in a directory, named by a
+hash of everything the images depend on (see ``psi_phi_cache_keys``), so repeated
+searches of the same data skip generating them and searches of data with new
+images added to the end only generate them for the new images.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import kbmod.search as kb
+
+# Increase this whenever the psi and phi computation changes to invalidate old entries.
+_cache_version = 1
+
+# The configuration parameters that change the loaded (and masked) images.
+_cache_config_keys = [
+    "do_mask",
+    "flag_keys",
+    "mask_bit_vector",
+    "mask_bits_dict",
+    "mask_grow",
+    "mask_num_images",
+    "mask_threshold",
+    "mjd_lims",
+    "repeated_flag_keys",
+]
+
+
+def save_psi_phi(search, filename):
+    """Save the psi and phi images of a search (computing them if needed) as a
+    float32 array of shape (2, num_images, height, width) in ``numpy.save`` format.
+
+    Parameters
+    ----------
+    search : ``kbmod.search.stack_search``
+        The search.
+    filename : str
+        The file to write. It is written to a temporary file first, so it is
+        either complete or missing.
+    """
+    stack = search.get_image_stack()
+    shape = (2, stack.img_count(), stack.get_height(), stack.get_width())
+
+    # Fill the file through a memory map so we do not need a second copy in memory.
+    tmp_file = f"{filename}.{os.getpid()}.tmp"
+    cube = np.lib.format.open_memmap(tmp_file, mode="w+", dtype=np.float32, shape=shape)
+    search.fill_psi_phi_array(cube)
+    cube.flush()
+    del cube
+    os.replace(tmp_file, filename)
+
+
+def load_psi_phi(search, filename):
+    """Set the psi and phi images of a search from a file written by ``save_psi_phi``.
+
+    Parameters
+    ----------
+    search : ``kbmod.search.stack_search``
+        The search.
+    filename : str
+        The file to read.
+
+    Raises
+    ------
+    RuntimeError if the images do not match the search's image stack.
+    """
+    # The memory mapped file is copied once, straight into the search.
+    search.set_psi_phi_array(np.load(filename, mmap_mode="r"))
+
+
+def _hash_file(hasher, filename):
+    """Add the size and contents of a file to a hash."""
+    hasher.update(str(os.path.getsize(filename)).encode())
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(block)
+
+
+def psi_phi_cache_keys(config, stack, img_info):
+    """Compute the cache keys for the psi and phi images of the images loaded
+    by ``run_search``.
+
+    The key of the first k images is a hash of their FITS file contents, times
+    and PSFs and of the parameters that change the loaded images (the masking
+    parameters and the MJD limits). It does not depend on the file names, the
+    later images or the search parameters, so when new images are added to the
+    end of a data set the keys of the earlier ones stay the same. With global
+    masking (``repeated_flag_keys``) every image's mask depends on all of the
+    images, so only the full set of images gets a key.
+
+    Parameters
+    ----------
+    config : ``KBMODConfig`` or dict
+        The configuration.
+    stack : ``kbmod.search.image_stack``
+        The loaded images.
+    img_info : ``kbmod.image_info.ImageInfoSet``
+        The information about the loaded images (including their file names).
+
+    Returns
+    -------
+    keys : list
+        The key of the first k images (a hexadecimal SHA-256 digest) at index k - 1,
+        or None if those images can not be cached on their own.
+    """
+    hasher = hashlib.sha256()
+    params = {key: config[key] for key in _cache_config_keys}
+    hasher.update(json.dumps([_cache_version, params], sort_keys=True, default=str).encode())
+
+    keys = []
+    mjds = img_info.get_all_mjd()
+    for i in range(stack.img_count()):
+        psf_stdev = stack.get_psf(i).get_stdev()
+        hasher.update(json.dumps([float(mjds[i]), psf_stdev]).encode())
+        _hash_file(hasher, img_info.stats[i].filename)
+        keys.append(hasher.hexdigest())
+
+    global_mask = config["do_mask"] and config["repeated_flag_keys"]
+    if global_mask and len(keys) > 0:
+        keys = [None] * (len(keys) - 1) + keys[-1:]
+    return keys
+
+
+class PsiPhiCache:
+    """A directory of psi and phi images named by their cache key.
+
+    Parameters
+    ----------
+    directory : str
+        The cache directory (created if needed).
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def filename(self, key):
+        """Return the file name for a key."""
+        return os.path.join(self.directory, f"psi_phi_{key}.npy")
+
+    def load(self, search, key):
+        """Set the psi and phi images of a search from the cache.
+
+        Parameters
+        ----------
+        search : ``kbmod.search.stack_search``
+            The search.
+        key : str
+            The cache key.
+
+        Returns
+        -------
+        found : bool
+            Whether the cache held the images.
+        """
+        filename = self.filename(key)
+        if not os.path.exists(filename):
+            return False
+        load_psi_phi(search, filename)
+        return True
+
+    def save(self, search, key):
+        """Compute the psi and phi images of a search (if needed) and add them to the cache.
+
+        Parameters
+        ----------
+        search : ``kbmod.search.stack_search``
+            The search.
+        key : str
+            The cache key.
+        """
+        save_psi_phi(search, self.filename(key))
+
+    def make_search(self, stack, keys):
+        """Create a search of a stack using as many cached psi and phi images as possible.
+
+        The search uses the cached images of the longest cached set of first images
+        and only generates the psi and phi images of the rest (see
+        ``stack_search.set_psi_phi_prefix``). It then adds its images to the cache.
+
+        Parameters
+        ----------
+        stack : ``kbmod.search.image_stack``
+            The images.
+        keys : list
+            The cache key of the first k images at index k - 1 (see ``psi_phi_cache_keys``).
+
+        Returns
+        -------
+        search : ``kbmod.search.stack_search``
+            The search with its psi and phi images set.
+        num_cached : int
+            The number of images whose psi and phi images came from the cache.
+        """
+        num_cached = 0
+        for i in reversed(range(len(keys))):
+            if keys[i] is not None and os.path.exists(self.filename(keys[i])):
+                num_cached = i + 1
+                break
+
+        search = kb.stack_search(stack)
+        if num_cached == len(keys) and num_cached > 0:
+            self.load(search, keys[-1])
+        elif num_cached > 0:
+            # The memory mapped file is copied once, straight into the search.
+            search.set_psi_phi_prefix(np.load(self.filename(keys[num_cached - 1]), mmap_mode="r"))
+
+        if num_cached < len(keys) and keys[-1] is not None:
+            self.save(search, keys[-1])
+        return search, num_cached
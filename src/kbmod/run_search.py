@@ -13,6 +13,7 @@ from numpy.linalg import lstsq
 import kbmod.search as kb
 
 from .analysis_utils import Interface, PostProcess
+from .checkpoint import checkpointed_search
 from .configuration import KBMODConfig
 from .masking import (
     BitVectorMasker,
@@ -22,6 +23,8 @@ from .masking import (
     ThresholdMask,
     apply_mask_operations,
 )
+from .parallel_search import configure_search, parallel_search
+from .psi_phi_cache import PsiPhiCache, psi_phi_cache_keys
 from .result_list import *
 
 
@@ -41,6 +44,9 @@ class run_search:
     ----------
     config : ``KBMODConfig``
         Search parameters.
+    input_key : ``str``
+        An identifier of the images loaded by the last ``load_search`` and their
+        masking (see ``psi_phi_cache_keys``), or None if it was not needed.
     """
 
     def __init__(self, input_parameters, config_file=None):
@@ -56,6 +62,7 @@ class run_search:
 
         # Validate the configuration.
         self.config.validate()
+        self.input_key = None
 
     def do_masking(self, stack):
         """Perform the masking based on the search's configuration parameters.
@@ -96,9 +103,9 @@ class run_search:
 
         return stack
 
-    def do_gpu_search(self, search, img_info, suggested_angle, post_process):
+    def get_search_settings(self, search, img_info, suggested_angle, post_process):
         """
-        Performs search on the GPU.
+        Compute the search's grid and settings from the configuration.
 
         Parameters
         ----------
@@ -109,8 +116,17 @@ class run_search:
         suggested_angle : ``float``
             Angle a 12 arcsecond segment parallel to the ecliptic is
             seen under from the image origin.
-        post_process :
-            Don't know
+        post_process : ``kbmod.analysis_utils.PostProcess``
+            The post processing object (used for the sigmaG coefficient).
+
+        Returns
+        -------
+        search_args : ``list``
+            The arguments to ``stack_search.search``.
+        settings : ``dict``
+            The search settings (see ``kbmod.parallel_search.configure_search``).
+        search_params : ``dict``
+            The angle and velocity limits of the search.
         """
         search_params = {}
 
@@ -127,18 +143,21 @@ class run_search:
         search_params["ang_lims"] = [ang_min, ang_max]
         search_params["vel_lims"] = [vel_min, vel_max]
 
+        # Collect the search settings so they can be applied here or in worker processes.
+        settings = {}
+
         # Set the search bounds.
         if self.config["x_pixel_bounds"] and len(self.config["x_pixel_bounds"]) == 2:
-            search.set_start_bounds_x(self.config["x_pixel_bounds"][0], self.config["x_pixel_bounds"][1])
+            settings["x_bounds"] = list(self.config["x_pixel_bounds"])
         elif self.config["x_pixel_buffer"] and self.config["x_pixel_buffer"] > 0:
             width = search.get_image_stack().get_width()
-            search.set_start_bounds_x(-self.config["x_pixel_buffer"], width + self.config["x_pixel_buffer"])
+            settings["x_bounds"] = [-self.config["x_pixel_buffer"], width + self.config["x_pixel_buffer"]]
 
         if self.config["y_pixel_bounds"] and len(self.config["y_pixel_bounds"]) == 2:
-            search.set_start_bounds_y(self.config["y_pixel_bounds"][0], self.config["y_pixel_bounds"][1])
+            settings["y_bounds"] = list(self.config["y_pixel_bounds"])
         elif self.config["y_pixel_buffer"] and self.config["y_pixel_buffer"] > 0:
             height = search.get_image_stack().get_height()
-            search.set_start_bounds_y(-self.config["y_pixel_buffer"], height + self.config["y_pixel_buffer"])
+            settings["y_bounds"] = [-self.config["y_pixel_buffer"], height + self.config["y_pixel_buffer"]]
 
         # If we are using barycentric corrections, compute the parameters and
         # enable it in the search function.
@@ -152,48 +171,121 @@ class run_search:
             bary_v = np.sqrt(bary_vx * bary_vx + bary_vy * bary_vy)
             bary_ang = np.arctan2(bary_vy, bary_vx)
             print("Average Velocity from Barycentric Correction", bary_v, "pix/day", bary_ang, "angle")
-            search.enable_corr(bary_corr.flatten())
-
-        search_start = time.time()
-        print("Starting Search")
-        print("---------------------------------------")
-        param_headers = (
-            "Ecliptic Angle",
-            "Min. Search Angle",
-            "Max Search Angle",
-            "Min Velocity",
-            "Max Velocity",
-        )
-        param_values = (suggested_angle, *search_params["ang_lims"], *search_params["vel_lims"])
-        for header, val in zip(param_headers, param_values):
-            print("%s = %.4f" % (header, val))
+            settings["bary_corr"] = bary_corr.flatten().tolist()
 
         # If we are using gpu_filtering, enable it and set the parameters.
         if self.config["gpu_filter"]:
             print("Using in-line GPU sigmaG filtering methods", flush=True)
             coeff = post_process._find_sigmaG_coeff(self.config["sigmaG_lims"])
-            search.enable_gpu_sigmag_filter(
-                np.array(self.config["sigmaG_lims"]) / 100.0,
+            settings["sigmag_filter"] = [
+                (np.array(self.config["sigmaG_lims"]) / 100.0).tolist(),
                 coeff,
                 self.config["lh_level"],
-            )
+            ]
 
         # If we are using an encoded image representation on GPU, enable it and
         # set the parameters.
         if self.config["encode_psi_bytes"] > 0 or self.config["encode_phi_bytes"] > 0:
-            search.enable_gpu_encoding(self.config["encode_psi_bytes"], self.config["encode_phi_bytes"])
+            settings["encoding"] = [self.config["encode_psi_bytes"], self.config["encode_phi_bytes"]]
+
+        # Select the search algorithm.
+        settings["search_mode"] = self.config["search_mode"]
+
+        # Skip trajectories with the same pixel offsets as an earlier one.
+        settings["dedup_trajectories"] = self.config["dedup_trajectories"]
+
+        # Search binned images first and only refine the promising regions.
+        if self.config["coarse_bin_factor"] > 1:
+            settings["coarse_search"] = [
+                self.config["coarse_bin_factor"],
+                self.config["coarse_lh_fraction"] * self.config["lh_level"],
+            ]
+
+        # Stop evaluating trajectories that can no longer make the results.
+        settings["lh_pruning"] = self.config["lh_pruning"]
+
+        settings["results_per_pixel"] = self.config["results_per_pixel"]
+
+        # Optionally only keep the results that load_and_filter_results() would use (lh >= lh_level).
+        if self.config["result_filter"]:
+            settings["result_filter"] = [self.config["lh_level"], self.config["max_results"]]
 
         # Enable debugging.
-        if self.config["debug"]:
-            search.set_debug(self.config["debug"])
+        settings["debug"] = self.config["debug"]
 
-        search.search(
+        search_args = [
             int(self.config["ang_arr"][2]),
             int(self.config["v_arr"][2]),
             *search_params["ang_lims"],
             *search_params["vel_lims"],
             int(self.config["num_obs"]),
+        ]
+        return (search_args, settings, search_params)
+
+    def do_gpu_search(self, search, img_info, suggested_angle, post_process):
+        """
+        Performs search on the GPU.
+
+        Parameters
+        ----------
+        search : ``~kbmod.search.Search``
+            Search object.
+        img_info : ``kbmod.search.ImageInfo``
+            ImageInfo object.
+        suggested_angle : ``float``
+            Angle a 12 arcsecond segment parallel to the ecliptic is
+            seen under from the image origin.
+        post_process : ``kbmod.analysis_utils.PostProcess``
+            The post processing object.
+        """
+        search_args, settings, search_params = self.get_search_settings(
+            search, img_info, suggested_angle, post_process
         )
+
+        search_start = time.time()
+        print("Starting Search")
+        print("---------------------------------------")
+        param_headers = (
+            "Ecliptic Angle",
+            "Min. Search Angle",
+            "Max Search Angle",
+            "Min Velocity",
+            "Max Velocity",
+        )
+        param_values = (suggested_angle, *search_params["ang_lims"], *search_params["vel_lims"])
+        for header, val in zip(param_headers, param_values):
+            print("%s = %.4f" % (header, val))
+
+        configure_search(search, settings)
+
+        # Search in blocks that are saved as they finish (resuming an earlier run) if requested.
+        if self.config["checkpoint_dir"] is not None:
+            print(f"Checkpointing the search to {self.config['checkpoint_dir']}", flush=True)
+            checkpointed_search(
+                search,
+                search_args,
+                settings,
+                self.config["checkpoint_dir"],
+                self.config["checkpoint_blocks"],
+                input_key=self.input_key,
+            )
+            print("Search finished in {0:.3f}s".format(time.time() - search_start), flush=True)
+            return (search, search_params)
+
+        # Split the starting pixels over several processes if requested.
+        if self.config["num_search_workers"] > 1:
+            print(f"Searching with {self.config['num_search_workers']} worker processes", flush=True)
+            parallel_search(search, search_args, settings, self.config["num_search_workers"])
+            print("Search finished in {0:.3f}s".format(time.time() - search_start), flush=True)
+            return (search, search_params)
+
+        search.search(*search_args)
+        if self.config["dedup_trajectories"]:
+            num_dups = search.get_num_duplicate_trajectories()
+            num_total = num_dups + search.get_num_trajectories()
+            print(f"Removed {num_dups} of {num_total} trajectories with duplicate pixel offsets.", flush=True)
+        if self.config["lh_pruning"]:
+            print(f"Pruning skipped {search.get_num_skipped_samples()} samples.", flush=True)
         print("Search finished in {0:.3f}s".format(time.time() - search_start), flush=True)
         return (search, search_params)
 
@@ -237,6 +329,32 @@ class run_search:
             The results.
         """
         start = time.time()
+        search, img_info, suggested_angle, kb_post_process = self.load_search()
+
+        # Perform the actual search.
+        search, search_params = self.do_gpu_search(search, img_info, suggested_angle, kb_post_process)
+
+        keep = self.filter_results(search, img_info, search_params, kb_post_process)
+
+        end = time.time()
+        print("Time taken for patch: ", end - start)
+
+        return keep
+
+    def load_search(self):
+        """Load and mask the images and create the search for them.
+
+        Returns
+        -------
+        search : ``kbmod.search.stack_search``
+            The (not yet run) search.
+        img_info : ``kbmod.image_info.ImageInfoSet``
+            The information about the images.
+        suggested_angle : ``float``
+            The ecliptic angle for the images.
+        kb_post_process : ``kbmod.analysis_utils.PostProcess``
+            The post processing object.
+        """
         kb_interface = Interface()
 
         # Load the PSF.
@@ -263,10 +381,42 @@ class run_search:
         if self.config["do_mask"]:
             stack = self.do_masking(stack)
 
-        # Perform the actual search.
-        search = kb.stack_search(stack)
-        search, search_params = self.do_gpu_search(search, img_info, suggested_angle, kb_post_process)
+        # Identify the inputs for the psi and phi cache and the checkpoints.
+        self.input_key = None
+        keys = None
+        if self.config["psi_phi_cache_dir"] is not None or self.config["checkpoint_dir"] is not None:
+            keys = psi_phi_cache_keys(self.config, stack, img_info)
+            self.input_key = keys[-1] if len(keys) > 0 else None
+
+        # Reuse the psi and phi images from earlier searches of the same images if we can.
+        if self.config["psi_phi_cache_dir"] is not None:
+            cache = PsiPhiCache(self.config["psi_phi_cache_dir"])
+            search, num_cached = cache.make_search(stack, keys)
+            print(f"Loaded the psi and phi images of {num_cached} images from the cache.", flush=True)
+        else:
+            search = kb.stack_search(stack)
 
+        return (search, img_info, suggested_angle, kb_post_process)
+
+    def filter_results(self, search, img_info, search_params, kb_post_process):
+        """Load, filter and save the results of a finished search.
+
+        Parameters
+        ----------
+        search : ``kbmod.search.stack_search``
+            The search with its results.
+        img_info : ``kbmod.image_info.ImageInfoSet``
+            The information about the images.
+        search_params : ``dict``
+            The angle and velocity limits of the search.
+        kb_post_process : ``kbmod.analysis_utils.PostProcess``
+            The post processing object.
+
+        Returns
+        -------
+        keep : ResultList
+            The results.
+        """
         # Load the KBMOD results into Python and apply a filter based on
         # 'filter_type.
         mjds = np.array(img_info.get_all_mjd())
@@ -315,9 +465,6 @@ class run_search:
             )
             self.config.save_configuration(config_filename, overwrite=True)
 
-        end = time.time()
-        print("Time taken for patch: ", end - start)
-
         return keep
 
     def _count_known_matches(self, result_list, search):
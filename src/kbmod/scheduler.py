@@ -0,0 +1,542 @@
+"""Split ``run_search`` jobs into tasks on a work queue.
+
+A job is the search of one patch (one ``run_search`` configuration). ``submit_search``
+splits it into tasks that each search a band of starting rows and a block of the
+trajectory grid, ``run_worker`` pulls tasks from the queue, runs them and stores the
+raw results, and ``merge_search`` combines the results of a finished job and applies
+the usual filtering to produce a ``ResultList``. Any number of workers (on any machine that can see the queue and
+the result directory) can run at once, and failed tasks are retried.
+
+The queue is pluggable. ``SQLiteWorkQueue`` keeps the tasks in an SQLite database
+file, which is enough for the workers on one machine or a shared file system.
+"""
+
+import abc
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+import numpy as np
+
+from .parallel_search import configure_search, grid_ranges, merge_pixel_results, search_bands
+from .run_search import run_search
+
+
+class Task:
+    """A task taken from a work queue.
+
+    Attributes
+    ----------
+    task_id : int
+        The task's unique identifier.
+    job : str
+        The name of the job the task belongs to.
+    payload : dict
+        The task's description.
+    attempts : int
+        The number of times the task has been started (including this one).
+    lease : str
+        A token unique to this claim of the task. Only the holder of the current
+        lease can renew it or report the task's outcome.
+    """
+
+    def __init__(self, task_id, job, payload, attempts, lease):
+        self.task_id = task_id
+        self.job = job
+        self.payload = payload
+        self.attempts = attempts
+        self.lease = lease
+
+
+class WorkQueue(abc.ABC):
+    """The base class for the work queues.
+
+    A task is ``pending`` until a worker claims it, then ``running`` until the
+    worker marks it as ``done`` or reports a failure. Failed tasks go back to
+    ``pending`` until they have been tried ``max_attempts`` times, after which
+    they are marked ``failed``.
+
+    Each claim holds a lease on the task. A running task whose lease has not been
+    renewed (see ``heartbeat``) for too long can be requeued (see ``requeue_stale``),
+    after which its old lease is void: the first worker's ``complete``, ``fail`` and
+    ``heartbeat`` calls are ignored, so a slow worker cannot overwrite the outcome
+    of a retry.
+
+    Parameters
+    ----------
+    max_attempts : int
+        The number of times to try each task.
+    """
+
+    def __init__(self, max_attempts=3):
+        self.max_attempts = max_attempts
+
+    @abc.abstractmethod
+    def put(self, job, payload):
+        """Add a task to the queue.
+
+        Parameters
+        ----------
+        job : str
+            The name of the job.
+        payload : dict
+            The task's description (must be JSON serializable).
+
+        Returns
+        -------
+        task_id : int
+            The new task's identifier.
+        """
+        pass
+
+    @abc.abstractmethod
+    def claim(self, worker):
+        """Take the next pending task.
+
+        Parameters
+        ----------
+        worker : str
+            The name of the worker taking the task.
+
+        Returns
+        -------
+        task : ``Task``
+            The task or ``None`` if there are no pending tasks.
+        """
+        pass
+
+    @abc.abstractmethod
+    def complete(self, task, result):
+        """Mark a task as done.
+
+        Parameters
+        ----------
+        task : ``Task``
+            The task (as returned by ``claim``).
+        result : str
+            Where the task's result was stored.
+
+        Returns
+        -------
+        held : bool
+            Whether the task's lease was still held. If not, nothing changes.
+        """
+        pass
+
+    @abc.abstractmethod
+    def fail(self, task, error):
+        """Report that a task failed, retrying it if it has attempts left.
+
+        Parameters
+        ----------
+        task : ``Task``
+            The task (as returned by ``claim``).
+        error : str
+            A description of the error.
+
+        Returns
+        -------
+        held : bool
+            Whether the task's lease was still held. If not, nothing changes.
+        """
+        pass
+
+    @abc.abstractmethod
+    def heartbeat(self, task):
+        """Renew the lease on a running task so ``requeue_stale`` leaves it alone.
+
+        Parameters
+        ----------
+        task : ``Task``
+            The task (as returned by ``claim``).
+
+        Returns
+        -------
+        held : bool
+            Whether the task's lease was still held.
+        """
+        pass
+
+    @abc.abstractmethod
+    def requeue_stale(self, timeout):
+        """Treat the running tasks whose lease has not been renewed for more than
+        timeout seconds as failed (for example because their worker was killed).
+
+        Parameters
+        ----------
+        timeout : float
+            The number of seconds.
+
+        Returns
+        -------
+        count : int
+            The number of tasks affected.
+        """
+        pass
+
+    @abc.abstractmethod
+    def tasks(self, job):
+        """Return all of a job's tasks.
+
+        Parameters
+        ----------
+        job : str
+            The name of the job.
+
+        Returns
+        -------
+        tasks : list
+            A list of dictionaries with the keys ``task_id``, ``payload``, ``status``,
+            ``attempts``, ``result`` and ``error`` in the order the tasks were added.
+        """
+        pass
+
+    def counts(self, job):
+        """Count a job's tasks in each state.
+
+        Parameters
+        ----------
+        job : str
+            The name of the job.
+
+        Returns
+        -------
+        counts : dict
+            A dictionary mapping each state to the number of tasks in it.
+        """
+        counts = {"pending": 0, "running": 0, "done": 0, "failed": 0}
+        for task in self.tasks(job):
+            counts[task["status"]] += 1
+        return counts
+
+
+class SQLiteWorkQueue(WorkQueue):
+    """A work queue stored in an SQLite database file.
+
+    Parameters
+    ----------
+    filename : str
+        The database file (created if needed).
+    max_attempts : int
+        The number of times to try each task.
+    """
+
+    def __init__(self, filename, max_attempts=3):
+        super().__init__(max_attempts)
+        self.filename = filename
+        with self._connect() as con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                "task_id INTEGER PRIMARY KEY AUTOINCREMENT, job TEXT NOT NULL, payload TEXT NOT NULL, "
+                "status TEXT NOT NULL, attempts INTEGER NOT NULL, worker TEXT, lease TEXT, result TEXT, "
+                "error TEXT, updated REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        # Use autocommit mode so we can control the transactions.
+        return _Connection(sqlite3.connect(self.filename, timeout=60.0, isolation_level=None))
+
+    def put(self, job, payload):
+        with self._connect() as con:
+            cur = con.execute(
+                "INSERT INTO tasks (job, payload, status, attempts, updated) VALUES (?, ?, 'pending', 0, ?)",
+                (job, json.dumps(payload), time.time()),
+            )
+            return cur.lastrowid
+
+    def claim(self, worker):
+        with self._connect() as con:
+            # Lock the database before reading so two workers cannot take the same task.
+            con.execute("BEGIN IMMEDIATE")
+            row = con.execute(
+                "SELECT task_id, job, payload, attempts FROM tasks WHERE status = 'pending' "
+                "ORDER BY task_id LIMIT 1"
+            ).fetchone()
+            if row is None:
+                con.execute("COMMIT")
+                return None
+            lease = uuid.uuid4().hex
+            con.execute(
+                "UPDATE tasks SET status = 'running', attempts = attempts + 1, worker = ?, lease = ?, "
+                "updated = ? WHERE task_id = ?",
+                (worker, lease, time.time(), row[0]),
+            )
+            con.execute("COMMIT")
+        return Task(row[0], row[1], json.loads(row[2]), row[3] + 1, lease)
+
+    def complete(self, task, result):
+        with self._connect() as con:
+            cur = con.execute(
+                "UPDATE tasks SET status = 'done', lease = NULL, result = ?, error = NULL, updated = ? "
+                "WHERE task_id = ? AND lease = ? AND status = 'running'",
+                (result, time.time(), task.task_id, task.lease),
+            )
+            return cur.rowcount == 1
+
+    def fail(self, task, error):
+        with self._connect() as con:
+            cur = con.execute(
+                "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "lease = NULL, error = ?, updated = ? WHERE task_id = ? AND lease = ? AND status = 'running'",
+                (self.max_attempts, error, time.time(), task.task_id, task.lease),
+            )
+            return cur.rowcount == 1
+
+    def heartbeat(self, task):
+        with self._connect() as con:
+            cur = con.execute(
+                "UPDATE tasks SET updated = ? WHERE task_id = ? AND lease = ? AND status = 'running'",
+                (time.time(), task.task_id, task.lease),
+            )
+            return cur.rowcount == 1
+
+    def requeue_stale(self, timeout):
+        with self._connect() as con:
+            cur = con.execute(
+                "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "lease = NULL, error = 'Timed out', updated = ? WHERE status = 'running' AND updated < ?",
+                (self.max_attempts, time.time(), time.time() - timeout),
+            )
+            return cur.rowcount
+
+    def tasks(self, job):
+        with self._connect() as con:
+            rows = con.execute(
+                "SELECT task_id, payload, status, attempts, result, error FROM tasks WHERE job = ? "
+                "ORDER BY task_id",
+                (job,),
+            ).fetchall()
+        return [
+            {
+                "task_id": row[0],
+                "payload": json.loads(row[1]),
+                "status": row[2],
+                "attempts": row[3],
+                "result": row[4],
+                "error": row[5],
+            }
+            for row in rows
+        ]
+
+
+class _Connection:
+    """Close an SQLite connection at the end of a with block (sqlite3's own context
+    manager only ends the transaction)."""
+
+    def __init__(self, con):
+        self.con = con
+
+    def __enter__(self):
+        return self.con
+
+    def __exit__(self, *args):
+        self.con.close()
+
+
+class _Heartbeat:
+    """Renew a task's lease every interval seconds in a background thread while a
+    with block runs. Stops early if the lease was lost."""
+
+    def __init__(self, queue, task, interval):
+        self.queue = queue
+        self.task = task
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                if not self.queue.heartbeat(self.task):
+                    return
+            except Exception:
+                # Keep trying: a missed renewal only matters once the lease times out.
+                traceback.print_exc()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+
+
+def submit_search(
+    queue, job, input_parameters, num_shards, config_file=None, num_angle_shards=1, num_velocity_shards=1
+):
+    """Split a search into tasks that each search a band of starting rows and a
+    block of the trajectory grid.
+
+    Parameters
+    ----------
+    queue : ``WorkQueue``
+        The queue.
+    job : str
+        The name of the job (for example the patch's name).
+    input_parameters : dict
+        The ``run_search`` parameters (must be JSON serializable).
+    num_shards : int
+        The number of bands of starting rows.
+    config_file : str
+        The ``run_search`` configuration file (optional).
+    num_angle_shards : int
+        The number of blocks of angle steps.
+    num_velocity_shards : int
+        The number of blocks of velocity steps.
+
+    Returns
+    -------
+    task_ids : list
+        The identifiers of the new tasks.
+    """
+    if len(queue.tasks(job)) > 0:
+        raise ValueError(f"Job {job} already exists.")
+    task_ids = []
+    for i in range(num_shards):
+        for j in range(num_angle_shards * num_velocity_shards):
+            payload = {
+                "parameters": input_parameters,
+                "config_file": config_file,
+                "shard": [i, num_shards],
+                "grid_shard": [j, num_angle_shards, num_velocity_shards],
+            }
+            task_ids.append(queue.put(job, payload))
+    return task_ids
+
+
+def run_task(payload, result_file):
+    """Run one task and save its results.
+
+    Parameters
+    ----------
+    payload : dict
+        The task's description (see ``submit_search``).
+    result_file : str
+        The file to save the structured results array in (``numpy.save`` format).
+    """
+    rs = run_search(payload["parameters"], config_file=payload["config_file"])
+    search, img_info, suggested_angle, post_process = rs.load_search()
+    search_args, settings, _ = rs.get_search_settings(search, img_info, suggested_angle, post_process)
+
+    # Searching rows or grid blocks past the last one (for tiny images or grids)
+    # finds nothing.
+    shard, num_shards = payload["shard"]
+    bounds = search_bands(search, settings, num_shards)
+    grid_shard, num_angle_shards, num_velocity_shards = payload["grid_shard"]
+    ranges = grid_ranges(search_args[0], search_args[1], num_angle_shards, num_velocity_shards)
+    if shard < len(bounds) and grid_shard < len(ranges):
+        settings["y_bounds"] = bounds[shard]
+        settings["grid_range"] = ranges[grid_shard]
+        configure_search(search, settings)
+        search.search(*search_args)
+
+    # Write to a temporary file first so a killed worker never leaves a partial result.
+    tmp_file = f"{result_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "wb") as f:
+        np.save(f, search.get_results_array())
+    os.replace(tmp_file, result_file)
+
+
+def run_worker(queue, result_dir, worker=None, max_tasks=None, lease_timeout=None, heartbeat_interval=None):
+    """Run tasks from the queue until it has no pending tasks.
+
+    Parameters
+    ----------
+    queue : ``WorkQueue``
+        The queue.
+    result_dir : str
+        The directory to store the results in (shared by all workers).
+    worker : str
+        The worker's name (default the host name and process ID).
+    max_tasks : int
+        The maximum number of tasks to run (default no limit).
+    lease_timeout : float
+        If given, running tasks whose lease has not been renewed for this many seconds
+        are treated as failed (see ``WorkQueue.requeue_stale``) before each claim.
+    heartbeat_interval : float
+        The number of seconds between renewals of the lease of the running task (see
+        ``WorkQueue.heartbeat``). Defaults to a quarter of ``lease_timeout`` or 60 seconds.
+        It must be well below the ``lease_timeout`` of every worker on the queue.
+
+    Returns
+    -------
+    num_tasks : int
+        The number of tasks run (including failed ones).
+    """
+    if worker is None:
+        worker = f"{socket.gethostname()}-{os.getpid()}"
+    if heartbeat_interval is None:
+        heartbeat_interval = 60.0 if lease_timeout is None else lease_timeout / 4.0
+    os.makedirs(result_dir, exist_ok=True)
+
+    num_tasks = 0
+    while max_tasks is None or num_tasks < max_tasks:
+        if lease_timeout is not None:
+            queue.requeue_stale(lease_timeout)
+        task = queue.claim(worker)
+        if task is None:
+            break
+
+        # Each attempt has its own result file, so a worker that lost its lease never
+        # overwrites the result of the attempt that replaced it.
+        result_file = os.path.join(result_dir, f"task_{task.task_id}_{task.attempts}.npy")
+        try:
+            with _Heartbeat(queue, task, heartbeat_interval):
+                run_task(task.payload, result_file)
+        except Exception:
+            print(f"Task {task.task_id} (attempt {task.attempts}) failed.", flush=True)
+            queue.fail(task, traceback.format_exc())
+        else:
+            if not queue.complete(task, result_file):
+                print(f"Task {task.task_id} (attempt {task.attempts}) lost its lease.", flush=True)
+                os.remove(result_file)
+        num_tasks += 1
+    return num_tasks
+
+
+def merge_search(queue, job):
+    """Merge the results of a finished job and filter them like ``run_search``.
+
+    Parameters
+    ----------
+    queue : ``WorkQueue``
+        The queue.
+    job : str
+        The name of the job.
+
+    Returns
+    -------
+    keep : ``ResultList``
+        The results.
+
+    Raises
+    ------
+    ValueError if the job does not exist.
+    RuntimeError if any of the job's tasks are not done.
+    """
+    tasks = queue.tasks(job)
+    if len(tasks) == 0:
+        raise ValueError(f"Unknown job {job}")
+    unfinished = [task["task_id"] for task in tasks if task["status"] != "done"]
+    if len(unfinished) > 0:
+        raise RuntimeError(f"Job {job} has unfinished tasks {unfinished}")
+
+    # Reload the images for the filtering and stamps.
+    payload = tasks[0]["payload"]
+    rs = run_search(payload["parameters"], config_file=payload["config_file"])
+    search, img_info, suggested_angle, post_process = rs.load_search()
+    _, settings, search_params = rs.get_search_settings(search, img_info, suggested_angle, post_process)
+
+    arrays = [np.load(task["result"]) for task in tasks]
+    max_results = -1
+    if settings.get("result_filter") is not None:
+        max_results = settings["result_filter"][1]
+    merged = merge_pixel_results(arrays, settings["results_per_pixel"], max_results)
+    search.set_results_array(merged)
+    return rs.filter_results(search, img_info, search_params, post_process)
@@ -0,0 +1,310 @@
+/*
+ * Convolution.cpp
+ *
+ * Created on: Oct 18, 2026
+ *
+ * CPU implementations of the PSF convolution of an image.
+ */
+
+#include "Convolution.h"
+
+namespace search {
+
+#ifdef HAVE_CUDA
+    // Performs convolution between an image represented as an array of floats
+    // and a PSF on a GPU device.
+    extern "C" void deviceConvolve(float* sourceImg, float* resultImg, int width, int height, float* psfKernel,
+                                   int psfSize, int psfDim, int psfRadius, float psfSum);
+#endif
+
+/* Return the smallest power of two that is at least n. */
+int nextPowerOfTwo(int n) {
+    int result = 1;
+    while (result < n) result *= 2;
+    return result;
+}
+
+/*
+ * The precomputed bit reversal permutation and roots of unity for FFTs of
+ * size n (a power of two).
+ */
+struct fftPlan {
+    int n;
+    std::vector<int> reversed;
+    std::vector<std::complex<double> > roots;
+
+    explicit fftPlan(int size) : n(size), reversed(size, 0), roots(size / 2) {
+        for (int i = 1, j = 0; i < n; ++i) {
+            int bit = n >> 1;
+            for (; j & bit; bit >>= 1) j ^= bit;
+            j ^= bit;
+            reversed[i] = j;
+        }
+        for (int k = 0; k < n / 2; ++k) roots[k] = std::polar(1.0, -2.0 * M_PI * k / n);
+    }
+
+    /* An in-place iterative radix-2 FFT (or the unscaled inverse FFT) of n values. */
+    void transform(std::complex<double>* values, bool inverse) const {
+        for (int i = 0; i < n; ++i) {
+            if (i < reversed[i]) std::swap(values[i], values[reversed[i]]);
+        }
+        for (int len = 2; len <= n; len *= 2) {
+            const int step = n / len;
+            for (int start = 0; start < n; start += len) {
+                for (int k = 0; k < len / 2; ++k) {
+                    const std::complex<double> w = inverse ? std::conj(roots[k * step]) : roots[k * step];
+                    const std::complex<double> u = values[start + k];
+                    const std::complex<double> v = values[start + k + len / 2] * w;
+                    values[start + k] = u + v;
+                    values[start + k + len / 2] = u - v;
+                }
+            }
+        }
+    }
+};
+
+/* An in-place 2D FFT (or the unscaled inverse FFT) of a row-major (ny x nx) array. */
+void transform2D(std::vector<std::complex<double> >& values, const fftPlan& xPlan, const fftPlan& yPlan,
+                 bool inverse) {
+    const int nx = xPlan.n;
+    const int ny = yPlan.n;
+    for (int y = 0; y < ny; ++y) xPlan.transform(&values[(long)y * nx], inverse);
+
+    std::vector<std::complex<double> > column(ny);
+    for (int x = 0; x < nx; ++x) {
+        for (int y = 0; y < ny; ++y) column[y] = values[(long)y * nx + x];
+        yPlan.transform(column.data(), inverse);
+        for (int y = 0; y < ny; ++y) values[(long)y * nx + x] = column[y];
+    }
+}
+
+/* The size of the FFT tiles along one axis of the given length: a power of two of at
+   least FFT_TILE_SIZE and 4 times the PSF's size, or less if that covers the padded axis. */
+int fftTileSize(int length, const PointSpreadFunc& psf) {
+    const int tile = nextPowerOfTwo(std::max(FFT_TILE_SIZE, 4 * psf.getDim()));
+    return std::min(tile, nextPowerOfTwo(length + 2 * psf.getRadius()));
+}
+
+/* The number of tiles of the given size needed to cover an axis of the given length.
+   Each tile overlaps its neighbors by twice the PSF's radius. */
+int fftTileCount(int length, int tileSize, const PointSpreadFunc& psf) {
+    const int step = tileSize - 2 * psf.getRadius();
+    return (length + step - 1) / step;
+}
+
+/* Return the transform of the PSF for (ny x nx) tiles from the buffers, computing
+   it if they do not hold it. */
+const std::vector<std::complex<double> >& fftKernel(const PointSpreadFunc& psf, const fftPlan& xPlan,
+                                                    const fftPlan& yPlan, ConvolutionBuffers* buffers) {
+    std::vector<FFTKernel>& kernels = buffers->fftKernels;
+    for (const FFTKernel& k : kernels) {
+        if (k.nx == xPlan.n && k.ny == yPlan.n && k.psfValues == psf.getKernel()) return k.transform;
+    }
+    if (kernels.size() >= FFT_KERNEL_CACHE_SIZE) kernels.erase(kernels.begin());
+
+    // Pixel (x + i, y + j) is weighted by the PSF value (i + psfRad, j + psfRad), so that
+    // value goes at (-i, -j) in the (circular) convolution kernel.
+    const int nx = xPlan.n;
+    const int ny = yPlan.n;
+    const int psfRad = psf.getRadius();
+    FFTKernel kernel = {nx, ny, psf.getKernel(), std::vector<std::complex<double> >((long)nx * ny, 0.0)};
+    for (int j = -psfRad; j <= psfRad; ++j) {
+        for (int i = -psfRad; i <= psfRad; ++i) {
+            const long index = (long)((ny - j) % ny) * nx + (nx - i) % nx;
+            kernel.transform[index] = psf.getValue(i + psfRad, j + psfRad);
+        }
+    }
+    transform2D(kernel.transform, xPlan, yPlan, false);
+    kernels.push_back(std::move(kernel));
+    return kernels.back().transform;
+}
+
+ConvolutionMethod chooseConvolution(int width, int height, const PointSpreadFunc& psf) {
+    std::vector<float> rowKernel;
+    std::vector<float> colKernel;
+    if (psf.getSeparableKernels(&rowKernel, &colKernel)) return CONVOLVE_SEPARABLE;
+
+    const int nx = fftTileSize(width, psf);
+    const int ny = fftTileSize(height, psf);
+    const double tilePixels = (double)nx * ny;
+    const double numTiles = (double)fftTileCount(width, nx, psf) * fftTileCount(height, ny, psf);
+    const double fftCost = FFT_COST_FACTOR * numTiles * tilePixels * std::log2(tilePixels);
+    const double directCost = (double)width * height * psf.getSize();
+    return (fftCost < directCost) ? CONVOLVE_FFT : CONVOLVE_DIRECT;
+}
+
+void convolveImage(const float* pixels, int width, int height, const PointSpreadFunc& psf,
+                   ConvolutionMethod method, float* result, ConvolutionBuffers* buffers) {
+    if (method == CONVOLVE_AUTO) method = chooseConvolution(width, height, psf);
+
+    if (method == CONVOLVE_SEPARABLE) {
+        if (!convolveSeparable(pixels, width, height, psf, result, buffers)) {
+            throw std::runtime_error("The PSF is not separable.");
+        }
+    } else if (method == CONVOLVE_FFT) {
+        convolveFFT(pixels, width, height, psf, result, buffers);
+    } else {
+        convolveDirect(pixels, width, height, psf, result);
+    }
+}
+
+void convolveInPlace(float* pixels, int width, int height, PointSpreadFunc& psf,
+                     ConvolutionBuffers* buffers) {
+    #ifdef HAVE_CUDA
+        deviceConvolve(pixels, pixels, width, height, psf.kernelData(), psf.getSize(), psf.getDim(),
+                       psf.getRadius(), psf.getSum());
+    #else
+        convolveImage(pixels, width, height, psf, CONVOLVE_AUTO, pixels, buffers);
+    #endif
+}
+
+void convolveDirect(const float* pixels, int width, int height, const PointSpreadFunc& psf, float* result) {
+    std::vector<float> convolved((long)width * height, 0.0);
+    const int psfRad = psf.getRadius();
+    const float psfTotal = psf.getSum();
+
+    for (int y = 0; y < height; ++y) {
+        for (int x = 0; x < width; ++x) {
+            // Pixels with NO_DATA remain NO_DATA.
+            if (pixels[y * width + x] == NO_DATA) {
+                convolved[y * width + x] = NO_DATA;
+                continue;
+            }
+
+            float sum = 0.0;
+            float psfPortion = 0.0;
+            for (int j = -psfRad; j <= psfRad; j++) {
+                for (int i = -psfRad; i <= psfRad; i++) {
+                    if ((x + i >= 0) && (x + i < width) && (y + j >= 0) && (y + j < height)) {
+                        float currentPixel = pixels[(y + j) * width + (x + i)];
+                        if (currentPixel != NO_DATA) {
+                            float currentPSF = psf.getValue(i + psfRad, j + psfRad);
+                            psfPortion += currentPSF;
+                            sum += currentPixel * currentPSF;
+                        }
+                    }
+                }
+            }
+            convolved[y * width + x] = (sum * psfTotal) / psfPortion;
+        }
+    }
+    std::copy(convolved.begin(), convolved.end(), result);
+}
+
+bool convolveSeparable(const float* pixels, int width, int height, const PointSpreadFunc& psf,
+                       float* result, ConvolutionBuffers* buffers) {
+    std::vector<float> rowKernel;
+    std::vector<float> colKernel;
+    if (!psf.getSeparableKernels(&rowKernel, &colKernel)) return false;
+    const int psfRad = psf.getRadius();
+    const float psfTotal = psf.getSum();
+    const long npixels = (long)width * height;
+
+    ConvolutionBuffers localBuffers;
+    if (buffers == nullptr) buffers = &localBuffers;
+    std::vector<float>& rowSum = buffers->rowSum;
+    std::vector<float>& rowPortion = buffers->rowPortion;
+    rowSum.assign(npixels, 0.0);
+    rowPortion.assign(npixels, 0.0);
+
+    // Convolve each row of the image (with 0 for NO_DATA) and of its mask of valid
+    // pixels with the row kernel. The loops over x have no bounds checks, so they
+    // vectorize.
+    std::vector<float> values(width);
+    std::vector<float> valid(width);
+    for (int y = 0; y < height; ++y) {
+        const long start = (long)y * width;
+        for (int x = 0; x < width; ++x) {
+            valid[x] = (pixels[start + x] == NO_DATA) ? 0.0 : 1.0;
+            values[x] = (pixels[start + x] == NO_DATA) ? 0.0 : pixels[start + x];
+        }
+        for (int i = -psfRad; i <= psfRad; ++i) {
+            const float k = rowKernel[i + psfRad];
+            const int xMin = std::max(0, -i);
+            const int xMax = std::min(width, width - i);
+            for (int x = xMin; x < xMax; ++x) {
+                rowSum[start + x] += k * values[x + i];
+                rowPortion[start + x] += k * valid[x + i];
+            }
+        }
+    }
+
+    // Convolve each column of the row results with the column kernel. Each row of the
+    // result only depends on the row results, so result may be pixels.
+    std::vector<float> sum(width);
+    std::vector<float> psfPortion(width);
+    for (int y = 0; y < height; ++y) {
+        const long start = (long)y * width;
+        std::fill(sum.begin(), sum.end(), 0.0);
+        std::fill(psfPortion.begin(), psfPortion.end(), 0.0);
+        for (int j = std::max(-psfRad, -y); j <= std::min(psfRad, height - 1 - y); ++j) {
+            const float k = colKernel[j + psfRad];
+            const long source = start + (long)j * width;
+            for (int x = 0; x < width; ++x) {
+                sum[x] += k * rowSum[source + x];
+                psfPortion[x] += k * rowPortion[source + x];
+            }
+        }
+        for (int x = 0; x < width; ++x) {
+            const bool hasData = (pixels[start + x] != NO_DATA);
+            result[start + x] = hasData ? (sum[x] * psfTotal) / psfPortion[x] : NO_DATA;
+        }
+    }
+    return true;
+}
+
+void convolveFFT(const float* pixels, int width, int height, const PointSpreadFunc& psf, float* result,
+                 ConvolutionBuffers* buffers) {
+    const int psfRad = psf.getRadius();
+    const float psfTotal = psf.getSum();
+
+    ConvolutionBuffers localBuffers;
+    if (buffers == nullptr) buffers = &localBuffers;
+    const fftPlan xPlan(fftTileSize(width, psf));
+    const fftPlan yPlan(fftTileSize(height, psf));
+    const int nx = xPlan.n;
+    const int ny = yPlan.n;
+    const std::vector<std::complex<double> >& kernel = fftKernel(psf, xPlan, yPlan, buffers);
+    std::vector<std::complex<double> >& tile = buffers->fftTile;
+
+    // Each tile reads the pixels from (x0 - psfRad, y0 - psfRad) and, since the kernel
+    // only wraps around within psfRad of the tile's edges, gives the sums of the
+    // (nx - 2 * psfRad) x (ny - 2 * psfRad) pixels from (x0, y0). The tiles read pixels
+    // that earlier tiles have written, so write to a separate array.
+    std::vector<float> convolved((long)width * height);
+    const int xStep = nx - 2 * psfRad;
+    const int yStep = ny - 2 * psfRad;
+    for (int y0 = 0; y0 < height; y0 += yStep) {
+        for (int x0 = 0; x0 < width; x0 += xStep) {
+            // Pack the image values into the real part and the mask of valid pixels into
+            // the imaginary part. Pixels outside the image have no data.
+            tile.assign((long)nx * ny, 0.0);
+            for (int ty = 0; ty < ny; ++ty) {
+                const int y = y0 - psfRad + ty;
+                if (y < 0 || y >= height) continue;
+                for (int tx = std::max(0, psfRad - x0); tx < std::min(nx, width - x0 + psfRad); ++tx) {
+                    const float value = pixels[(long)y * width + x0 - psfRad + tx];
+                    if (value != NO_DATA) tile[(long)ty * nx + tx] = std::complex<double>(value, 1.0);
+                }
+            }
+
+            transform2D(tile, xPlan, yPlan, false);
+            for (long p = 0; p < (long)nx * ny; ++p) tile[p] *= kernel[p];
+            transform2D(tile, xPlan, yPlan, true);
+
+            // The inverse transforms are unscaled, but the scale cancels in the ratio.
+            for (int y = y0; y < std::min(height, y0 + yStep); ++y) {
+                for (int x = x0; x < std::min(width, x0 + xStep); ++x) {
+                    const std::complex<double> value = tile[(long)(y - y0 + psfRad) * nx + x - x0 + psfRad];
+                    convolved[(long)y * width + x] = (value.real() * psfTotal) / value.imag();
+                }
+            }
+        }
+    }
+
+    for (long p = 0; p < (long)width * height; ++p) {
+        result[p] = (pixels[p] == NO_DATA) ? NO_DATA : convolved[p];
+    }
+}
+
+} /* namespace search */
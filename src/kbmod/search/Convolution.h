@@ -0,0 +1,93 @@
+/*
+ * Convolution.h
+ *
+ * Created on: Oct 18, 2026
+ *
+ * CPU implementations of the PSF convolution of an image. All of them compute
+ * the same result: NO_DATA pixels stay NO_DATA and every other pixel becomes the
+ * PSF weighted sum of its neighbors that have data, rescaled by the PSF's sum
+ * divided by the sum of the PSF values used (psfPortion). Pixels outside the
+ * image are treated as NO_DATA.
+ */
+
+#ifndef CONVOLUTION_H_
+#define CONVOLUTION_H_
+
+#include <algorithm>
+#include <cmath>
+#include <complex>
+#include <stdexcept>
+#include <vector>
+#include "common.h"
+#include "PointSpreadFunc.h"
+
+namespace search {
+
+/* The relative costs used to pick a convolution method: an FFT convolution takes
+   about FFT_COST_FACTOR * N * log2(N) operations for each tile of N pixels, while
+   the direct convolution takes one operation per pixel and PSF value. */
+constexpr double FFT_COST_FACTOR = 4.0;
+
+/* The smallest side of the FFT convolution's tiles. The tiles are powers of two at
+   least this large and 4 times the PSF's size (so most of each tile is output), but
+   no larger than needed to cover the image. Their memory use does not grow with the
+   image size. */
+constexpr int FFT_TILE_SIZE = 128;
+
+/* The number of PSF transforms kept in ConvolutionBuffers. */
+constexpr int FFT_KERNEL_CACHE_SIZE = 4;
+
+/* The transform of a PSF for FFT tiles of (ny x nx) pixels. */
+struct FFTKernel {
+    int nx;
+    int ny;
+    std::vector<float> psfValues;
+    std::vector<std::complex<double> > transform;
+};
+
+/* Scratch buffers for the separable and FFT convolutions. Passing the same buffers
+   to repeated convolutions (as preparing the psi and phi images does) avoids
+   allocating them for every image and transforming the same PSF again. */
+struct ConvolutionBuffers {
+    std::vector<float> rowSum;
+    std::vector<float> rowPortion;
+    std::vector<std::complex<double> > fftTile;
+    std::vector<FFTKernel> fftKernels;
+};
+
+/* Pick the fastest method to convolve a (width x height) image with the PSF: the
+   separable two-pass convolution if the PSF is separable, and otherwise the direct
+   or FFT convolution with the lower estimated cost. */
+ConvolutionMethod chooseConvolution(int width, int height, const PointSpreadFunc& psf);
+
+/* Convolve the (width x height) image in pixels with the PSF using the given
+   method and write the result to result (which may be pixels). Throws a
+   runtime_error if the separable method is requested for a PSF that is not
+   separable. buffers (if given) are used as the separable method's scratch space. */
+void convolveImage(const float* pixels, int width, int height, const PointSpreadFunc& psf,
+                   ConvolutionMethod method, float* result, ConvolutionBuffers* buffers = nullptr);
+
+/* Convolve the (width x height) image in pixels with the PSF in place, on the GPU
+   if there is one and otherwise with the fastest CPU method. */
+void convolveInPlace(float* pixels, int width, int height, PointSpreadFunc& psf,
+                     ConvolutionBuffers* buffers = nullptr);
+
+/* The direct convolution: a loop over every pixel and PSF value. */
+void convolveDirect(const float* pixels, int width, int height, const PointSpreadFunc& psf, float* result);
+
+/* The separable convolution: a pass of the row kernel followed by a pass of the
+   column kernel over both the image and its mask of valid pixels. Returns false
+   (without changing result) if the PSF is not separable. */
+bool convolveSeparable(const float* pixels, int width, int height, const PointSpreadFunc& psf,
+                       float* result, ConvolutionBuffers* buffers = nullptr);
+
+/* The FFT convolution: an overlap-save convolution over tiles of the image (see
+   FFT_TILE_SIZE). A single complex FFT of each tile convolves the image (real part)
+   and its mask of valid pixels (imaginary part) at the same time, since the PSF is
+   real. buffers (if given) hold the tile and the PSF's transform between calls. */
+void convolveFFT(const float* pixels, int width, int height, const PointSpreadFunc& psf, float* result,
+                 ConvolutionBuffers* buffers = nullptr);
+
+} /* namespace search */
+
+#endif /* CONVOLUTION_H_ */
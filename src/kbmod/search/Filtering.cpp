@@ -8,16 +8,12 @@
 
 #include "Filtering.h"
 #include <math.h>
+#include <algorithm>
+#include <stdexcept>
+#include <omp.h>
 
 namespace search {
 
-#ifdef HAVE_CUDA
-    /* The filter_kenerls.cu functions. */
-    extern "C" void sigmaGFilteredIndicesCU(float* values, int num_values, float sGL0, float sGL1,
-                                            float sigmaGCoeff, float width, int* idxArray, int* minKeepIndex,
-                                            int* maxKeepIndex);
-#endif
-
 /* Return the list of indices from the values array such that those elements
    pass the sigmaG filtering defined by percentiles [sGL0, sGL1] with coefficient
    sigmaGCoeff and a multiplicative factor of width. */
@@ -27,32 +23,99 @@ std::vector<int> sigmaGFilteredIndices(const std::vector<float>& values, float s
     assert(sGL0 > 0.0);
     assert(sGL1 < 1.0);
 
-    // Allocate space for the input and result.
     const int num_values = values.size();
-    float values_arr[num_values];
-    int idxArray[num_values];
+    std::vector<float> scratch(num_values);
+    float minValue = 0.0;
+    float maxValue = 0.0;
+    sigmaGFilterBounds(values.data(), num_values, sGL0, sGL1, sigmaGCoeff, width, scratch.data(),
+                       &minValue, &maxValue);
+
+    std::vector<int> result;
     for (int i = 0; i < num_values; ++i) {
-        values_arr[i] = values[i];
+        if ((values[i] >= minValue) && (values[i] <= maxValue)) result.push_back(i);
     }
+    return result;
+}
 
-    int minKeepIndex = 0;
-    int maxKeepIndex = num_values - 1;
+void sigmaGFilterBounds(const float* values, int num_values, float sGL0, float sGL1, float sigmaGCoeff,
+                        float width, float* scratch, float* minValue, float* maxValue) {
+    *minValue = 0.0;
+    *maxValue = 0.0;
+    if (num_values <= 0) return;
 
-    #ifdef HAVE_CUDA
-        sigmaGFilteredIndicesCU(values_arr, num_values, sGL0, sGL1, sigmaGCoeff, width, idxArray,
-                                &minKeepIndex, &maxKeepIndex);
-    #else
-        throw std::runtime_error("Non-GPU sigmaGFilteredIndicesCU is not implemented.");
-    #endif
+    // Clip the percentiles to [0.01, 99.99] to avoid invalid array accesses.
+    if (sGL0 < 0.0001) sGL0 = 0.0001;
+    if (sGL1 > 0.9999) sGL1 = 0.9999;
 
-    // Copy the result into a vector and return it.
-    std::vector<int> result;
-    for (int i = minKeepIndex; i <= maxKeepIndex; ++i) {
-        result.push_back(idxArray[i]);
+    // Compute the index of each of the percent values in the sorted values
+    // from the given bounds sGL0, 0.5 (median), and sGL1.
+    const int pct_L = int(ceil(num_values * sGL0) + 0.001) - 1;
+    const int pct_H = int(ceil(num_values * sGL1) + 0.001) - 1;
+    const int median_ind = int(ceil(num_values * 0.5) + 0.001) - 1;
+
+    // Select the median and then the percentiles from the partition on their side of it.
+    std::copy(values, values + num_values, scratch);
+    std::nth_element(scratch, scratch + median_ind, scratch + num_values);
+    auto select = [&](int ind) {
+        if (ind < median_ind) {
+            std::nth_element(scratch, scratch + ind, scratch + median_ind);
+        } else if (ind > median_ind) {
+            std::nth_element(scratch + median_ind + 1, scratch + ind, scratch + num_values);
+        }
+        return scratch[ind];
+    };
+    const float median = scratch[median_ind];
+    const float lower = select(pct_L);
+    const float upper = select(pct_H);
+
+    // Compute the values that are +/- (width * sigmaG) from the median.
+    float sigmaG = sigmaGCoeff * (upper - lower);
+    *minValue = median - width * sigmaG;
+    *maxValue = median + width * sigmaG;
+}
+
+void sigmaGFilterMasks(const float* values, int numRows, int numValues, float sGL0, float sGL1,
+                       float sigmaGCoeff, float width, bool* keep) {
+    #pragma omp parallel
+    {
+        std::vector<float> scratch(numValues);
+
+        #pragma omp for schedule(static)
+        for (int r = 0; r < numRows; ++r) {
+            const float* row = values + (long)r * numValues;
+            bool* rowKeep = keep + (long)r * numValues;
+
+            float minValue = 0.0;
+            float maxValue = 0.0;
+            sigmaGFilterBounds(row, numValues, sGL0, sGL1, sigmaGCoeff, width, scratch.data(), &minValue,
+                               &maxValue);
+            for (int i = 0; i < numValues; ++i) {
+                rowKeep[i] = (row[i] >= minValue) && (row[i] <= maxValue);
+            }
+        }
     }
-    return result;
 }
 
+#ifdef Py_PYTHON_H
+pybind11::array_t<bool> sigmaGFilteredMasks(
+        pybind11::array_t<float, pybind11::array::c_style | pybind11::array::forcecast> values, float sGL0,
+        float sGL1, float sigmaGCoeff, float width) {
+    pybind11::buffer_info info = values.request();
+    if (info.ndim != 2) throw std::runtime_error("Array must have 2 dimensions.");
+
+    const int numRows = info.shape[0];
+    const int numValues = info.shape[1];
+    pybind11::array_t<bool> keep({numRows, numValues});
+    bool* keepData = keep.mutable_data();
+    {
+        pybind11::gil_scoped_release release;
+        sigmaGFilterMasks(static_cast<const float*>(info.ptr), numRows, numValues, sGL0, sGL1, sigmaGCoeff,
+                          width, keepData);
+    }
+    return keep;
+}
+#endif
+
 /* Given a set of psi and phi values,
    return a likelihood value */
 double calculateLikelihoodFromPsiPhi(std::vector<double> psiValues, std::vector<double> phiValues) {
@@ -10,6 +10,10 @@
 #define FILTERING_H_
 
 #include <vector>
+#ifdef Py_PYTHON_H
+#include <pybind11/pybind11.h>
+#include <pybind11/numpy.h>
+#endif
 
 namespace search {
 
@@ -19,6 +23,27 @@ namespace search {
 std::vector<int> sigmaGFilteredIndices(const std::vector<float>& values, float sGL0, float sGL1,
                                        float sigmaGCoeff, float width);
 
+/* Compute the range [minValue, maxValue] of values that pass the sigmaG filter. This
+   keeps the same values as sigmaGFilteredIndicesCU (kernels.cu), but finds the
+   percentiles with linear time selection instead of sorting. The scratch array
+   must hold num_values values. */
+void sigmaGFilterBounds(const float* values, int num_values, float sGL0, float sGL1, float sigmaGCoeff,
+                        float width, float* scratch, float* minValue, float* maxValue);
+
+/* Apply the sigmaG filter to each row of a (numRows x numValues) row-major array
+   of values and set keep[r * numValues + i] to whether value i of row r passes.
+   The rows are filtered in parallel. */
+void sigmaGFilterMasks(const float* values, int numRows, int numValues, float sGL0, float sGL1,
+                       float sigmaGCoeff, float width, bool* keep);
+
+#ifdef Py_PYTHON_H
+/* The numpy version of sigmaGFilterMasks that returns a boolean array with
+   the same shape as the given two dimensional array. */
+pybind11::array_t<bool> sigmaGFilteredMasks(
+        pybind11::array_t<float, pybind11::array::c_style | pybind11::array::forcecast> values, float sGL0,
+        float sGL1, float sigmaGCoeff, float width);
+#endif
+
 } /* namespace search */
 
 #endif /* FILTERING_H_ */
@@ -9,7 +9,8 @@
 
 namespace search {
 
-ImageStack::ImageStack(const std::vector<std::string>& filenames, const std::vector<PointSpreadFunc>& psfs) {
+ImageStack::ImageStack(const std::vector<std::string>& filenames, const std::vector<PointSpreadFunc>& psfs)
+        : width(0), height(0) {
     verbose = true;
     resetImages();
     loadImages(filenames, psfs);
@@ -19,7 +20,7 @@ ImageStack::ImageStack(const std::vector<std::string>& filenames, const std::vec
     globalMask.setAllPix(0.0);
 }
 
-ImageStack::ImageStack(const std::vector<LayeredImage>& imgs) {
+ImageStack::ImageStack(const std::vector<LayeredImage>& imgs) : width(0), height(0) {
     verbose = true;
     images = imgs;
     extractImageTimes();
@@ -28,6 +29,12 @@ ImageStack::ImageStack(const std::vector<LayeredImage>& imgs) {
     globalMask.setAllPix(0.0);
 }
 
+ImageStack::ImageStack(unsigned w, unsigned h, const std::vector<float>& times) : width(w), height(h) {
+    verbose = true;
+    imageTimes = times;
+    if (imageTimes.size() > 0) setTimeOrigin();
+}
+
 void ImageStack::loadImages(const std::vector<std::string>& fileNames,
                             const std::vector<PointSpreadFunc>& psfs) {
     const int num_files = fileNames.size();
@@ -61,12 +68,17 @@ void ImageStack::setTimeOrigin() {
 }
 
 LayeredImage& ImageStack::getSingleImage(int index) {
-    if (index < 0 || index > images.size()) throw std::out_of_range("ImageStack index out of bounds.");
+    if (index < 0 || index >= images.size()) throw std::out_of_range("ImageStack index out of bounds.");
     return images[index];
 }
 
+const PointSpreadFunc& ImageStack::getPSF(int index) const {
+    if (index < 0 || index >= images.size()) throw std::out_of_range("ImageStack index out of bounds.");
+    return images[index].getPSF();
+}
+
 void ImageStack::setSingleImage(int index, LayeredImage& img) {
-    if (index < 0 || index > images.size()) throw std::out_of_range("ImageStack index out of bounds.");
+    if (index < 0 || index >= images.size()) throw std::out_of_range("ImageStack index out of bounds.");
     images[index] = img;
 }
 
@@ -79,7 +91,34 @@ void ImageStack::setTimes(const std::vector<float>& times) {
     setTimeOrigin();
 }
 
-void ImageStack::resetImages() { images = std::vector<LayeredImage>(); }
+void ImageStack::appendImages(const std::vector<LayeredImage>& imgs) {
+    if (!hasPixels()) throw std::runtime_error("Can not append images to a stack without pixel data.");
+    for (auto& img : imgs) {
+        if (images.size() > 0 && (img.getWidth() != getWidth() || img.getHeight() != getHeight())) {
+            throw std::runtime_error("Appended images must be the same size as the stack's images.");
+        }
+    }
+    if (images.size() == 0) {
+        images = imgs;
+        extractImageTimes();
+        setTimeOrigin();
+        globalMask = RawImage(getWidth(), getHeight());
+        globalMask.setAllPix(0.0);
+        return;
+    }
+
+    // Subtract in double precision since the observation times are usually MJDs.
+    const double initialTime = images[0].getObstime();
+    for (auto& img : imgs) {
+        images.push_back(img);
+        imageTimes.push_back(float(img.getObstime() - initialTime));
+    }
+}
+
+void ImageStack::resetImages() {
+    images = std::vector<LayeredImage>();
+    imageTimes = std::vector<float>();
+}
 
 void ImageStack::convolvePSF() {
     for (auto& i : images) i.convolvePSF();
@@ -111,20 +150,34 @@ void ImageStack::applyMaskThreshold(float thresh) {
 }
 
 void ImageStack::growMask(int steps) {
-    for (auto& i : images) i.growMask(steps);
+    #pragma omp parallel for schedule(dynamic)
+    for (int i = 0; i < images.size(); ++i) images[i].growMask(steps);
+}
+
+void ImageStack::applyMaskSteps(const std::vector<maskStep>& steps) {
+    // The global masks only depend on the mask layers, which masking does not change,
+    // so create them all first.
+    std::vector<RawImage> globalMasks(steps.size());
+    for (int s = 0; s < steps.size(); ++s) {
+        if (steps[s].operation == MASK_GLOBAL_FLAGS) {
+            createGlobalMask(steps[s].flags, steps[s].numImages);
+            globalMasks[s] = globalMask;
+        }
+    }
+
+    #pragma omp parallel for schedule(dynamic)
+    for (int i = 0; i < images.size(); ++i) images[i].applyMaskSteps(steps, globalMasks);
 }
 
 void ImageStack::createGlobalMask(int flags, int threshold) {
+    // A stack without pixel data has no masks.
+    if (!hasPixels()) return;
     int npixels = getNPixels();
 
     // For each pixel count the number of images where it is masked.
     std::vector<int> counts(npixels, 0);
     for (unsigned int img = 0; img < images.size(); ++img) {
-        float* imgMask = images[img].getMDataRef();
-        // Count the number of times a pixel has any of the flags
-        for (unsigned int pixel = 0; pixel < npixels; ++pixel) {
-            if ((flags & static_cast<int>(imgMask[pixel])) != 0) counts[pixel]++;
-        }
+        images[img].getMaskImage().countFlagged(flags, counts);
     }
 
     // Set all pixels below threshold to 0 and all above to 1
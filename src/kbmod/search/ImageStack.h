@@ -4,6 +4,9 @@
  *  Created on: Jun 22, 2017
  *      Author: kbmod-usr
  * ImageStack stores a series of LayeredImages from different times.
+ *
+ * ImageStack does no locking. Different stacks can be used from different threads,
+ * but a stack must not be modified while another thread reads it.
  */
 
 #ifndef IMAGESTACK_H_
@@ -24,21 +27,32 @@ public:
     ImageStack(const std::vector<std::string>& filenames, const std::vector<PointSpreadFunc>& psfs);
     ImageStack(const std::vector<LayeredImage>& imgs);
 
+    // A stack with only the size and times of its images and no pixel data, for
+    // searches of precomputed psi and phi images (see KBMOSearch::setPsiPhiArray).
+    // Functions that need the images' pixels throw (or do nothing for masking).
+    ImageStack(unsigned w, unsigned h, const std::vector<float>& times);
+
     // Simple getters.
-    unsigned imgCount() const { return images.size(); }
-    unsigned getWidth() const { return images.size() > 0 ? images[0].getWidth() : 0; }
-    unsigned getHeight() const { return images.size() > 0 ? images[0].getHeight() : 0; }
-    unsigned getNPixels() const { return images.size() > 0 ? images[0].getNPixels() : 0; }
+    unsigned imgCount() const { return imageTimes.size(); }
+    unsigned getWidth() const { return images.size() > 0 ? images[0].getWidth() : width; }
+    unsigned getHeight() const { return images.size() > 0 ? images[0].getHeight() : height; }
+    unsigned getNPixels() const { return getWidth() * getHeight(); }
+    bool hasPixels() const { return images.size() == imgCount(); }
     std::vector<LayeredImage>& getImages() { return images; }
     const std::vector<float>& getTimes() const { return imageTimes; }
     float* getTimesDataRef() { return imageTimes.data(); }
     LayeredImage& getSingleImage(int index);
+    const PointSpreadFunc& getPSF(int index) const;
 
     // Simple setters.
     void setTimes(const std::vector<float>& times);
     void resetImages();
     void setSingleImage(int index, LayeredImage& img);
 
+    // Add images (of the same size) to the end of the stack. Their times are their
+    // observation times relative to the first image's; use setTimes() to change them.
+    void appendImages(const std::vector<LayeredImage>& imgs);
+
     // Apply makes to all the images.
     void applyGlobalMask(int flags, int threshold);
     void applyMaskFlags(int flags, const std::vector<int>& exceptions);
@@ -46,6 +60,10 @@ public:
     void growMask(int steps);
     const RawImage& getGlobalMask() const;
 
+    // Apply a list of masking steps with the same result as running the corresponding
+    // functions above in order, but in a single pass over each image (in parallel).
+    void applyMaskSteps(const std::vector<maskStep>& steps);
+
     void convolvePSF();
 
     // Save data to files.
@@ -60,6 +78,9 @@ private:
     void setTimeOrigin();
     void createGlobalMask(int flags, int threshold);
     std::vector<LayeredImage> images;
+    // The image size of a stack without pixel data.
+    unsigned width;
+    unsigned height;
     RawImage globalMask;
     std::vector<float> imageTimes;
     bool verbose;
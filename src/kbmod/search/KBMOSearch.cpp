@@ -15,17 +15,61 @@ namespace search {
                                        trajectory* trajectoriesToSearch, int resultsCount,
                                        trajectory* bestTrajects);
 
+    // Upload the images of a GPU search once, search blocks of starting pixels with them
+    // and free them (see kernels.cu).
+    extern "C" void* deviceSearchUpload(int imageCount, int width, int height, float* psiVect,
+                                        float* phiVect, perImageData img_data, searchParameters params);
+    extern "C" void deviceSearchBlocks(void* uploaded, int numBlocks, const searchParameters* blockParams,
+                                       const int* trajOffsets, trajectory* trajectories,
+                                       const long* resultOffsets, trajectory* bestTrajects);
+    extern "C" void deviceSearchRelease(void* uploaded);
+
+    /*
+     * Search blocks of starting pixels on the GPU with images uploaded by deviceSearchUpload.
+     * Block b searches the starting pixels of blockParams[b] with the trajectories
+     * *trajectoryLists[b], and its results are written to (*blockResults)[b]. All of the
+     * blocks share one upload of the trajectories and one copy of the results.
+     */
+    static void searchDeviceBlocks(void* deviceImages, const std::vector<searchParameters>& blockParams,
+                                   const std::vector<const std::vector<trajectory>*>& trajectoryLists,
+                                   std::vector<std::vector<trajectory> >* blockResults) {
+        const int num_blocks = blockParams.size();
+        std::vector<int> trajOffsets(num_blocks + 1, 0);
+        std::vector<long> resultOffsets(num_blocks + 1, 0);
+        std::vector<trajectory> trajectories;
+        for (int b = 0; b < num_blocks; ++b) {
+            const searchParameters& params = blockParams[b];
+            trajectories.insert(trajectories.end(), trajectoryLists[b]->begin(), trajectoryLists[b]->end());
+            trajOffsets[b + 1] = trajectories.size();
+            const long num_pixels = (long)std::max(0, params.x_start_max - params.x_start_min) *
+                                    std::max(0, params.y_start_max - params.y_start_min);
+            resultOffsets[b + 1] = resultOffsets[b] + num_pixels * params.resultsPerPixel;
+        }
+
+        std::vector<trajectory> results(resultOffsets[num_blocks]);
+        deviceSearchBlocks(deviceImages, num_blocks, blockParams.data(), trajOffsets.data(),
+                           trajectories.data(), resultOffsets.data(), results.data());
+        blockResults->resize(num_blocks);
+        for (int b = 0; b < num_blocks; ++b) {
+            (*blockResults)[b].assign(results.begin() + resultOffsets[b],
+                                      results.begin() + resultOffsets[b + 1]);
+        }
+    }
+
     void deviceGetCoadds(ImageStack& stack, perImageData image_data, int num_trajectories,
                          trajectory* trajectories, stampParameters params,
                          std::vector<std::vector<bool> >& use_index_vect, float* results);
 #endif
 
 KBMOSearch::KBMOSearch(ImageStack& imstack) : stack(imstack) {
-    maxResultCount = 100000;
+    filterResultsOnInsert = false;
+    resultMinLH = -1.0;
+    maxResultCount = -1;
     debugInfo = false;
     psiPhiGenerated = false;
 
     // Default the thresholds.
+    params.resultsPerPixel = RESULTS_PER_PIXEL;
     params.minObservations = 0;
     params.minLH = 0.0;
 
@@ -50,7 +94,21 @@ KBMOSearch::KBMOSearch(ImageStack& imstack) : stack(imstack) {
     params.useCorr = false;
     useCorr = false;
 
+    // Pruning does not change the results, but its bounds are only effective
+    // on some data sets, so it is off by default.
+    params.do_lh_pruning = false;
+
     params.debug = false;
+    searchMode = SEARCH_GRID;
+    dedupTrajectories = false;
+    numDuplicateTrajectories = 0;
+    numSkippedSamples = 0;
+    gridAngleStart = 0;
+    gridAngleEnd = -1;
+    gridVelocityStart = 0;
+    gridVelocityEnd = -1;
+    coarseBinFactor = 1;
+    coarseMinLH = 0.0;
 }
 
 void KBMOSearch::setDebug(bool d) {
@@ -95,6 +153,43 @@ void KBMOSearch::enableGPUEncoding(int pyPsiNumBytes, int pyPhiNumBytes) {
     }
 }
 
+void KBMOSearch::setSearchMode(SearchMode mode) { searchMode = mode; }
+
+void KBMOSearch::setDedupTrajectories(bool dedup) { dedupTrajectories = dedup; }
+
+void KBMOSearch::setLHPruning(bool prune) { params.do_lh_pruning = prune; }
+
+void KBMOSearch::setResultsPerPixel(int numResults) {
+    if (numResults < 1 || numResults > MAX_RESULTS_PER_PIXEL) {
+        throw std::runtime_error("The number of results per pixel must be between 1 and " +
+                                 std::to_string(MAX_RESULTS_PER_PIXEL));
+    }
+    params.resultsPerPixel = numResults;
+}
+
+void KBMOSearch::enableResultFilter(float minLH, int maxResults) {
+    filterResultsOnInsert = true;
+    resultMinLH = minLH;
+    maxResultCount = maxResults;
+}
+
+void KBMOSearch::setGridRange(int angleStart, int angleEnd, int velocityStart, int velocityEnd) {
+    if (angleStart < 0 || velocityStart < 0 || (angleEnd >= 0 && angleEnd < angleStart) ||
+        (velocityEnd >= 0 && velocityEnd < velocityStart)) {
+        throw std::runtime_error("Invalid grid range.");
+    }
+    gridAngleStart = angleStart;
+    gridAngleEnd = angleEnd;
+    gridVelocityStart = velocityStart;
+    gridVelocityEnd = velocityEnd;
+}
+
+void KBMOSearch::enableCoarseSearch(int binFactor, float minCoarseLH) {
+    if (binFactor < 1) throw std::runtime_error("The bin factor must be at least 1.");
+    coarseBinFactor = binFactor;
+    coarseMinLH = minCoarseLH;
+}
+
 void KBMOSearch::setStartBoundsX(int x_min, int x_max) {
     params.x_start_min = x_min;
     params.x_start_max = x_max;
@@ -110,10 +205,10 @@ void KBMOSearch::search(int aSteps, int vSteps, float minAngle, float maxAngle,
     preparePsiPhi();
     createSearchList(aSteps, vSteps, minAngle, maxAngle, minVelocity, maxVelocity);
 
-    startTimer("Creating psi/phi buffers");
-    std::vector<float> psiVect;
-    std::vector<float> phiVect;
-    fillPsiAndPhiVects(psiImages, phiImages, &psiVect, &phiVect);
+    // The pixel offsets depend on the starting pixel when using barycentric
+    // corrections, so we can only remove duplicates without them.
+    startTimer("Selecting trajectories");
+    selectTrajectories(aSteps, vSteps, dedupTrajectories && !params.useCorr);
     endTimer();
 
     // Create a data stucture for the per-image data.
@@ -127,42 +222,353 @@ void KBMOSearch::search(int aSteps, int vSteps, float minAngle, float maxAngle,
     std::vector<scaleParameters> psiScaleVect;
     std::vector<scaleParameters> phiScaleVect;
     if (params.psiNumBytes > 0) {
-        psiScaleVect = computeImageScaling(psiImages, params.psiNumBytes);
+        psiScaleVect = computeImageScaling(psiVect, params.psiNumBytes);
         img_data.psiParams = psiScaleVect.data();
     }
     if (params.phiNumBytes > 0) {
-        phiScaleVect = computeImageScaling(phiImages, params.phiNumBytes);
+        phiScaleVect = computeImageScaling(phiVect, params.phiNumBytes);
         img_data.phiParams = phiScaleVect.data();
     }
 
-    // Allocate a vector for the results.
-    int num_search_pixels =
-            ((params.x_start_max - params.x_start_min) * (params.y_start_max - params.y_start_min));
-    int max_results = num_search_pixels * RESULTS_PER_PIXEL;
-    if (debugInfo) {
-        std::cout << "Searching X=[" << params.x_start_min << ", " << params.x_start_max << "]"
-                  << " Y=[" << params.y_start_min << ", " << params.y_start_max << "]\n";
-        std::cout << "Allocating space for " << max_results << " results.\n";
-    }
-    results = std::vector<trajectory>(max_results);
-    if (debugInfo) std::cout << searchList.size() << " trajectories... \n" << std::flush;
-
     // Set the minimum number of observations.
     params.minObservations = minObservations;
 
-    // Do the actual search on the GPU.
-    startTimer("Searching");
-    #ifdef HAVE_CUDA 
-        deviceSearchFilter(stack.imgCount(), stack.getWidth(), stack.getHeight(), psiVect.data(), phiVect.data(),
-                           img_data, params, searchList.size(), searchList.data(), max_results, results.data());
+    if (coarseBinFactor > 1) {
+        coarseToFineSearch(img_data, aSteps, vSteps, minAngle, maxAngle, minVelocity, maxVelocity);
+    } else {
+        if (debugInfo) {
+            std::cout << "Searching X=[" << params.x_start_min << ", " << params.x_start_max << "]"
+                      << " Y=[" << params.y_start_min << ", " << params.y_start_max << "]\n";
+            std::cout << searchList.size() << " trajectories... \n" << std::flush;
+        }
+
+        // Do the actual search on the GPU (or the CPU if there is no GPU).
+        startTimer("Searching");
+        if (filterResultsOnInsert) {
+            streamSearch(img_data);
+        } else {
+            numSkippedSamples = searchImages(stack.getWidth(), stack.getHeight(), psiVect, phiVect,
+                                             img_data, params, searchList, results);
+        }
+        endTimer();
+    }
+
+    startTimer("Sorting results");
+    finalizeResults();
+    endTimer();
+}
+
+void KBMOSearch::streamSearch(perImageData img_data) {
+    searchParameters stripParams = params;
+    encodedImageVect psiEncoded;
+    encodedImageVect phiEncoded;
+    std::vector<float> psiQuantized;
+    std::vector<float> phiQuantized;
+    encodeForCPUKernels(img_data, &stripParams, &psiEncoded, &phiEncoded, &psiQuantized, &phiQuantized);
+    std::vector<float>& psiSearch = psiQuantized.empty() ? psiVect : psiQuantized;
+    std::vector<float>& phiSearch = phiQuantized.empty() ? phiVect : phiQuantized;
+
+    // Search enough rows at a time to produce about RESULTS_PER_STRIP results.
+    const long search_width = std::max(1, params.x_start_max - params.x_start_min);
+    const int strip_rows = std::max(1L, RESULTS_PER_STRIP / (search_width * params.resultsPerPixel));
+
+    // The GPU grid kernel searches every strip with the images uploaded once.
+    const bool use_device = HAVE_GPU && searchMode == SEARCH_GRID;
+    void* deviceImages = nullptr;
+#ifdef HAVE_CUDA
+    if (use_device) {
+        deviceImages = deviceSearchUpload(stack.imgCount(), stack.getWidth(), stack.getHeight(),
+                                          psiVect.data(), phiVect.data(), img_data, params);
+    }
+#endif
+
+    results.clear();
+    numSkippedSamples = 0;
+    std::vector<trajectory> stripResults;
+    std::vector<std::vector<trajectory> > deviceResults;
+    for (int y = params.y_start_min; y < params.y_start_max; y += strip_rows) {
+        stripParams.y_start_min = y;
+        stripParams.y_start_max = std::min(y + strip_rows, params.y_start_max);
+        if (use_device) {
+#ifdef HAVE_CUDA
+            searchDeviceBlocks(deviceImages, {stripParams}, {&searchList}, &deviceResults);
+            addFilteredResults(deviceResults[0]);
+#endif
+        } else {
+            numSkippedSamples += searchImages(stack.getWidth(), stack.getHeight(), psiSearch, phiSearch,
+                                              img_data, stripParams, searchList, stripResults, &psiEncoded,
+                                              &phiEncoded);
+            addFilteredResults(stripResults);
+        }
+    }
+
+#ifdef HAVE_CUDA
+    if (deviceImages != nullptr) deviceSearchRelease(deviceImages);
+#endif
+}
+
+void KBMOSearch::encodeForCPUKernels(const perImageData& img_data, searchParameters* searchParams,
+                                     encodedImageVect* psiEncoded, encodedImageVect* phiEncoded,
+                                     std::vector<float>* psiQuantized, std::vector<float>* phiQuantized) {
+    // The CPU kernels would encode the images on every call, so do it once here. The
+    // grid kernel reads the encoded images and the others read the decoded values.
+    if (HAVE_GPU && searchMode == SEARCH_GRID) return;
+    const int num_images = stack.imgCount();
+    const int num_pixels = stack.getNPixels();
+    if (params.psiNumBytes > 0 && img_data.psiParams != nullptr) {
+        if (searchMode == SEARCH_GRID) {
+            *psiEncoded = encodeImageVect(psiVect.data(), num_images, num_pixels, params.psiNumBytes,
+                                          img_data.psiParams);
+        } else {
+            *psiQuantized = quantizeImageVect(psiVect.data(), num_images, num_pixels, params.psiNumBytes,
+                                              img_data.psiParams);
+            searchParams->psiNumBytes = -1;
+        }
+    }
+    if (params.phiNumBytes > 0 && img_data.phiParams != nullptr) {
+        if (searchMode == SEARCH_GRID) {
+            *phiEncoded = encodeImageVect(phiVect.data(), num_images, num_pixels, params.phiNumBytes,
+                                          img_data.phiParams);
+        } else {
+            *phiQuantized = quantizeImageVect(phiVect.data(), num_images, num_pixels, params.phiNumBytes,
+                                              img_data.phiParams);
+            searchParams->phiNumBytes = -1;
+        }
+    }
+}
+
+void KBMOSearch::addFilteredResults(const std::vector<trajectory>& newResults) {
+    // Skip the empty result slots (lh = -1) and the results below the thresholds.
+    for (const trajectory& trj : newResults) {
+        if (trj.lh > -1.0 && trj.lh >= resultMinLH && trj.obsCount >= params.minObservations) {
+            results.push_back(trj);
+        }
+    }
+
+    // Trim the results back to the best maxResultCount once we have twice as many.
+    if (maxResultCount > 0 && results.size() > 2 * (size_t)maxResultCount) {
+        std::nth_element(results.begin(), results.begin() + maxResultCount, results.end(),
+                         [](const trajectory& a, const trajectory& b) { return b.lh < a.lh; });
+        results.resize(maxResultCount);
+    }
+}
+
+void KBMOSearch::finalizeResults() {
+    if (filterResultsOnInsert && maxResultCount > 0 && results.size() > (size_t)maxResultCount) {
+        std::nth_element(results.begin(), results.begin() + maxResultCount, results.end(),
+                         [](const trajectory& a, const trajectory& b) { return b.lh < a.lh; });
+        results.resize(maxResultCount);
+    }
+    sortResults();
+    if (debugInfo) std::cout << "Kept " << results.size() << " results. " << std::flush;
+}
+
+long KBMOSearch::searchImages(int width, int height, std::vector<float>& psiVect, std::vector<float>& phiVect,
+                              perImageData img_data, const searchParameters& searchParams,
+                              std::vector<trajectory>& trajectories, std::vector<trajectory>& searchResults,
+                              const encodedImageVect* psiEncoded, const encodedImageVect* phiEncoded) {
+    // Allocate a vector for the results.
+    int num_search_pixels = ((searchParams.x_start_max - searchParams.x_start_min) *
+                             (searchParams.y_start_max - searchParams.y_start_min));
+    int max_results = num_search_pixels * searchParams.resultsPerPixel;
+    searchResults = std::vector<trajectory>(max_results);
+
+    long numSkipped = 0;
+    const int num_images = stack.imgCount();
+    if (searchMode == SEARCH_SHIFT_STACK) {
+        shiftStackSearch(num_images, width, height, psiVect.data(), phiVect.data(), img_data, searchParams,
+                         trajectories.size(), trajectories.data(), max_results, searchResults.data());
+    } else if (searchMode == SEARCH_TREE) {
+        treeSearch(num_images, width, height, psiVect.data(), phiVect.data(), img_data, searchParams,
+                   trajectories.size(), trajectories.data(), max_results, searchResults.data());
+    } else {
+    #ifdef HAVE_CUDA
+        deviceSearchFilter(num_images, width, height, psiVect.data(), phiVect.data(), img_data, searchParams,
+                           trajectories.size(), trajectories.data(), max_results, searchResults.data());
     #else
-        throw std::runtime_error("Non-GPU search is not implemented.");
+        cpuSearchFilter(num_images, width, height, psiVect.data(), phiVect.data(), img_data, searchParams,
+                        trajectories.size(), trajectories.data(), max_results, searchResults.data(),
+                        &numSkipped, psiEncoded, phiEncoded);
     #endif
+    }
+    return numSkipped;
+}
+
+void KBMOSearch::coarseToFineSearch(perImageData img_data, int aSteps, int vSteps, float minAngle,
+                                    float maxAngle, float minVelocity, float maxVelocity) {
+    const int factor = coarseBinFactor;
+    const int width = stack.getWidth();
+    const int height = stack.getHeight();
+
+    // Bin the psi and phi images.
+    startTimer("Binning psi/phi images");
+    int binned_width = 0;
+    int binned_height = 0;
+    std::vector<float> binnedPsi = binImageVect(psiVect, factor, &binned_width, &binned_height);
+    std::vector<float> binnedPhi = binImageVect(phiVect, factor, &binned_width, &binned_height);
     endTimer();
 
-    startTimer("Sorting results");
-    sortResults();
+    // Create the coarse velocity grid (in binned pixels per day).
+    std::vector<trajectory> fineList = searchList;
+    const int coarseASteps = std::max(1, aSteps / factor);
+    const int coarseVSteps = std::max(1, vSteps / factor);
+    createSearchList(coarseASteps, coarseVSteps, minAngle, maxAngle, minVelocity / factor,
+                     maxVelocity / factor);
+    std::vector<trajectory> coarseList = searchList;
+    searchList = fineList;
+    const float coarseAStep = (maxAngle - minAngle) / float(coarseASteps);
+    const float coarseVStep = (maxVelocity - minVelocity) / float(coarseVSteps);
+
+    // Search the binned images. The coarse search does not use the encoding or the
+    // sigmaG filter and ignores the barycentric corrections (which are in unbinned
+    // pixels).
+    searchParameters coarseParams = params;
+    coarseParams.do_sigmag_filter = false;
+    coarseParams.psiNumBytes = -1;
+    coarseParams.phiNumBytes = -1;
+    coarseParams.useCorr = false;
+    coarseParams.x_start_min = (int)std::floor(params.x_start_min / (float)factor);
+    coarseParams.x_start_max = (int)std::ceil(params.x_start_max / (float)factor);
+    coarseParams.y_start_min = (int)std::floor(params.y_start_min / (float)factor);
+    coarseParams.y_start_max = (int)std::ceil(params.y_start_max / (float)factor);
+
+    perImageData coarseImgData = img_data;
+    coarseImgData.baryCorrs = nullptr;
+    coarseImgData.psiParams = nullptr;
+    coarseImgData.phiParams = nullptr;
+
+    startTimer("Coarse search");
+    std::vector<trajectory> coarseResults;
+    numSkippedSamples = searchImages(binned_width, binned_height, binnedPsi, binnedPhi, coarseImgData,
+                                     coarseParams, coarseList, coarseResults);
+    endTimer();
+
+    // Collect the coarse results above the threshold for each binned starting pixel.
+    std::map<std::pair<int, int>, std::vector<trajectory> > candidates;
+    for (const trajectory& trj : coarseResults) {
+        if (trj.lh >= coarseMinLH && trj.obsCount >= params.minObservations) {
+            candidates[std::make_pair(trj.y, trj.x)].push_back(trj);
+        }
+    }
+
+    // Refine each candidate: search its block of unbinned starting pixels using the
+    // trajectories within one coarse step (in angle and speed) of its coarse results.
+    startTimer("Refining candidates");
+    std::vector<std::pair<int, int> > keys;
+    for (const auto& item : candidates) keys.push_back(item.first);
+    std::vector<std::vector<trajectory> > refinedResults(keys.size());
+    long num_refined_trajectories = 0;
+    long num_skipped = 0;
+    searchParameters encodedParams = params;
+    encodedImageVect psiEncoded;
+    encodedImageVect phiEncoded;
+    std::vector<float> psiQuantized;
+    std::vector<float> phiQuantized;
+    encodeForCPUKernels(img_data, &encodedParams, &psiEncoded, &phiEncoded, &psiQuantized, &phiQuantized);
+    std::vector<float>& psiSearch = psiQuantized.empty() ? psiVect : psiQuantized;
+    std::vector<float>& phiSearch = phiQuantized.empty() ? phiVect : phiQuantized;
+
+    // Collect each candidate's trajectories: those within one coarse step (in angle and
+    // speed) of its coarse results.
+    std::vector<std::vector<trajectory> > refineLists(keys.size());
+    std::vector<searchParameters> fineParams(keys.size(), encodedParams);
+    #pragma omp parallel for schedule(dynamic) reduction(+ : num_refined_trajectories)
+    for (int c = 0; c < (int)keys.size(); ++c) {
+        const std::vector<trajectory>& coarseTrjs = candidates.at(keys[c]);
+        for (const trajectory& fine : fineList) {
+            const float fineAngle = atan2(fine.yVel, fine.xVel);
+            const float fineSpeed = sqrt(fine.xVel * fine.xVel + fine.yVel * fine.yVel);
+            for (const trajectory& coarse : coarseTrjs) {
+                const float dAngle = std::remainder(fineAngle - atan2(coarse.yVel, coarse.xVel), 2.0 * M_PI);
+                const float coarseSpeed =
+                        factor * sqrt(coarse.xVel * coarse.xVel + coarse.yVel * coarse.yVel);
+                if (fabs(dAngle) <= coarseAStep && fabs(fineSpeed - coarseSpeed) <= coarseVStep) {
+                    refineLists[c].push_back(fine);
+                    break;
+                }
+            }
+        }
+        num_refined_trajectories += refineLists[c].size();
+
+        fineParams[c].debug = false;
+        fineParams[c].x_start_min = std::max(params.x_start_min, keys[c].second * factor);
+        fineParams[c].x_start_max = std::min(params.x_start_max, (keys[c].second + 1) * factor);
+        fineParams[c].y_start_min = std::max(params.y_start_min, keys[c].first * factor);
+        fineParams[c].y_start_max = std::min(params.y_start_max, (keys[c].first + 1) * factor);
+    }
+
+    if (HAVE_GPU && searchMode == SEARCH_GRID) {
+#ifdef HAVE_CUDA
+        // Upload the unbinned images once and refine all of the candidates in one batch.
+        std::vector<int> active;
+        std::vector<searchParameters> activeParams;
+        std::vector<const std::vector<trajectory>*> activeLists;
+        for (int c = 0; c < (int)keys.size(); ++c) {
+            if (refineLists[c].size() == 0) continue;
+            active.push_back(c);
+            activeParams.push_back(fineParams[c]);
+            activeLists.push_back(&refineLists[c]);
+        }
+        if (active.size() > 0) {
+            void* deviceImages = deviceSearchUpload(stack.imgCount(), width, height, psiVect.data(),
+                                                    phiVect.data(), img_data, params);
+            std::vector<std::vector<trajectory> > activeResults;
+            searchDeviceBlocks(deviceImages, activeParams, activeLists, &activeResults);
+            deviceSearchRelease(deviceImages);
+            for (int a = 0; a < (int)active.size(); ++a) refinedResults[active[a]].swap(activeResults[a]);
+        }
+#endif
+    } else {
+        #pragma omp parallel for schedule(dynamic) reduction(+ : num_skipped)
+        for (int c = 0; c < (int)keys.size(); ++c) {
+            if (refineLists[c].size() == 0) continue;
+            num_skipped += searchImages(width, height, psiSearch, phiSearch, img_data, fineParams[c],
+                                        refineLists[c], refinedResults[c], &psiEncoded, &phiEncoded);
+        }
+    }
+
+    numSkippedSamples += num_skipped;
+
+    results.clear();
+    for (const std::vector<trajectory>& refined : refinedResults) {
+        if (filterResultsOnInsert) {
+            addFilteredResults(refined);
+        } else {
+            results.insert(results.end(), refined.begin(), refined.end());
+        }
+    }
     endTimer();
+
+    if (debugInfo) {
+        std::cout << "Refined " << keys.size() << " of " << coarseResults.size() / params.resultsPerPixel
+                  << " binned starting pixels with " << num_refined_trajectories << " trajectories.\n"
+                  << std::flush;
+    }
+}
+
+std::vector<float> KBMOSearch::binImageVect(const std::vector<float>& imageVect, int factor,
+                                            int* binned_width, int* binned_height) const {
+    const int num_images = stack.imgCount();
+    const int width = stack.getWidth();
+    const int height = stack.getHeight();
+    *binned_width = (width + factor - 1) / factor;
+    *binned_height = (height + factor - 1) / factor;
+    const long binned_pixels = (long)(*binned_width) * (*binned_height);
+
+    // Sum the valid pixels in each bin (NO_DATA if there are none).
+    std::vector<float> binned(num_images * binned_pixels, NO_DATA);
+    for (int i = 0; i < num_images; ++i) {
+        for (int y = 0; y < height; ++y) {
+            for (int x = 0; x < width; ++x) {
+                const float value = imageVect[((long)i * height + y) * width + x];
+                if (value == NO_DATA) continue;
+
+                float& bin = binned[i * binned_pixels + (y / factor) * (*binned_width) + x / factor];
+                bin = (bin == NO_DATA) ? value : bin + value;
+            }
+        }
+    }
+    return binned;
 }
 
 void KBMOSearch::savePsiPhi(const std::string& path) {
@@ -172,35 +578,157 @@ void KBMOSearch::savePsiPhi(const std::string& path) {
 
 void KBMOSearch::preparePsiPhi() {
     if (!psiPhiGenerated) {
-        psiImages.clear();
-        phiImages.clear();
-
-        // Compute Phi and Psi from convolved images
-        // while leaving masked pixels alone
-        // Reinsert 0s for NO_DATA?
-        const int num_images = stack.imgCount();
-        for (int i = 0; i < num_images; ++i) {
+        psiVect.clear();
+        phiVect.clear();
+        generatePsiPhi(0);
+        psiPhiGenerated = true;
+    }
+}
+
+void KBMOSearch::generatePsiPhi(int first) {
+    if (!stack.hasPixels()) {
+        throw std::runtime_error("Can not generate psi and phi images from a stack without pixel data.");
+    }
+    const int num_images = stack.imgCount();
+    const long num_pixels = stack.getNPixels();
+    psiVect.resize(num_images * num_pixels);
+    phiVect.resize(num_images * num_pixels);
+
+    // Each thread reuses its convolution buffers for all of its images. The GPU
+    // convolutions are run one image at a time instead of from every thread at once.
+    #pragma omp parallel if (!HAVE_GPU)
+    {
+        ConvolutionBuffers buffers;
+        #pragma omp for schedule(dynamic)
+        for (int i = first; i < num_images; ++i) {
             LayeredImage& img = stack.getSingleImage(i);
-            psiImages.push_back(img.generatePsiImage());
-            phiImages.push_back(img.generatePhiImage());
+            img.fillPsiPhi(&psiVect[i * num_pixels], &phiVect[i * num_pixels], &buffers);
         }
+    }
+}
 
-        psiPhiGenerated = true;
+void KBMOSearch::appendImages(const std::vector<LayeredImage>& imgs) {
+    if (params.useCorr) {
+        throw std::runtime_error("Can not append images to a search with barycentric corrections.");
+    }
+    const int first_new = stack.imgCount();
+    stack.appendImages(imgs);
+    baryCorrs.resize(stack.imgCount());
+
+    if (psiPhiGenerated) generatePsiPhi(first_new);
+}
+
+void KBMOSearch::setPsiPhi(const std::vector<RawImage>& psiImgs, const std::vector<RawImage>& phiImgs) {
+    const int num_images = stack.imgCount();
+    if (psiImgs.size() != num_images || phiImgs.size() != num_images) {
+        throw std::runtime_error("The number of psi and phi images must match the number of images.");
+    }
+    for (int i = 0; i < num_images; ++i) {
+        if (psiImgs[i].getWidth() != stack.getWidth() || psiImgs[i].getHeight() != stack.getHeight() ||
+            phiImgs[i].getWidth() != stack.getWidth() || phiImgs[i].getHeight() != stack.getHeight()) {
+            throw std::runtime_error("The psi and phi images must be the same size as the images.");
+        }
+    }
+
+    const long num_pixels = stack.getNPixels();
+    psiVect.resize(num_images * num_pixels);
+    phiVect.resize(num_images * num_pixels);
+    for (int i = 0; i < num_images; ++i) {
+        std::copy(psiImgs[i].getPixels().begin(), psiImgs[i].getPixels().end(), &psiVect[i * num_pixels]);
+        std::copy(phiImgs[i].getPixels().begin(), phiImgs[i].getPixels().end(), &phiVect[i * num_pixels]);
+    }
+    psiPhiGenerated = true;
+}
+
+void KBMOSearch::setPsiPhiArray(const float* data) {
+    const long num_values = (long)stack.imgCount() * stack.getNPixels();
+    psiVect.assign(data, data + num_values);
+    phiVect.assign(data + num_values, data + 2 * num_values);
+    psiPhiGenerated = true;
+}
+
+void KBMOSearch::setPsiPhiPrefix(const float* data, int numSet) {
+    if (numSet < 0 || numSet > stack.imgCount()) {
+        throw std::runtime_error("More psi and phi images than images in the stack.");
+    }
+    const long num_pixels = stack.getNPixels();
+    const long num_values = (long)numSet * num_pixels;
+    psiVect.assign(data, data + num_values);
+    phiVect.assign(data + num_values, data + 2 * num_values);
+
+    // Only the remaining images need to be generated.
+    generatePsiPhi(numSet);
+    psiPhiGenerated = true;
+}
+
+void KBMOSearch::fillPsiPhiArray(float* out) {
+    preparePsiPhi();
+    std::copy(psiVect.begin(), psiVect.end(), out);
+    std::copy(phiVect.begin(), phiVect.end(), out + psiVect.size());
+}
+
+#ifdef Py_PYTHON_H
+/* Throw unless the array has the shape (2, numImages, height, width) of the search. */
+static void checkPsiPhiShape(const pybind11::array& cube, const ImageStack& stack) {
+    if (cube.ndim() != 4 || cube.shape(0) != 2 || cube.shape(1) != stack.imgCount() ||
+        cube.shape(2) != stack.getHeight() || cube.shape(3) != stack.getWidth()) {
+        throw std::runtime_error("The psi and phi array must have shape (2, num_images, height, width).");
+    }
+}
+
+void KBMOSearch::setPsiPhiNumpy(
+        pybind11::array_t<float, pybind11::array::c_style | pybind11::array::forcecast> cube) {
+    checkPsiPhiShape(cube, stack);
+    const float* data = cube.data();
+    pybind11::gil_scoped_release release;
+    setPsiPhiArray(data);
+}
+
+void KBMOSearch::setPsiPhiPrefixNumpy(
+        pybind11::array_t<float, pybind11::array::c_style | pybind11::array::forcecast> cube) {
+    if (cube.ndim() != 4 || cube.shape(0) != 2 || cube.shape(1) > stack.imgCount() ||
+        cube.shape(2) != stack.getHeight() || cube.shape(3) != stack.getWidth()) {
+        throw std::runtime_error("The psi and phi array must have shape (2, num_set, height, width).");
     }
+    const float* data = cube.data();
+    const int num_set = cube.shape(1);
+    pybind11::gil_scoped_release release;
+    setPsiPhiPrefix(data, num_set);
 }
 
-std::vector<scaleParameters> KBMOSearch::computeImageScaling(const std::vector<RawImage>& vect,
+void KBMOSearch::fillPsiPhiNumpy(pybind11::array out) {
+    // Take any array (instead of converting it) so we never fill a temporary copy.
+    checkPsiPhiShape(out, stack);
+    if (!out.dtype().is(pybind11::dtype::of<float>()) ||
+        !(out.flags() & pybind11::array::c_style) || !out.writeable()) {
+        throw std::runtime_error("The psi and phi array must be a writable C contiguous float32 array.");
+    }
+    float* data = static_cast<float*>(out.mutable_data());
+    pybind11::gil_scoped_release release;
+    fillPsiPhiArray(data);
+}
+#endif
+
+std::vector<scaleParameters> KBMOSearch::computeImageScaling(const std::vector<float>& vect,
                                                              int encoding_bytes) const {
     std::vector<scaleParameters> result;
 
-    const int num_images = vect.size();
+    const int num_images = stack.imgCount();
+    const long num_pixels = stack.getNPixels();
     for (int i = 0; i < num_images; ++i) {
         scaleParameters params;
         params.scale = 1.0;
 
-        std::array<float, 2> bnds = vect[i].computeBounds();
-        params.minVal = bnds[0];
-        params.maxVal = bnds[1];
+        // Find the bounds of the valid pixels.
+        params.minVal = FLT_MAX;
+        params.maxVal = -FLT_MAX;
+        for (long p = i * num_pixels; p < (i + 1) * num_pixels; ++p) {
+            if (vect[p] != NO_DATA) {
+                params.minVal = std::min(params.minVal, vect[p]);
+                params.maxVal = std::max(params.maxVal, vect[p]);
+            }
+        }
+        assert(params.maxVal != -FLT_MAX);
 
         // Increase width to avoid divide by zero.
         float width = (params.maxVal - params.minVal);
@@ -223,8 +751,8 @@ void KBMOSearch::saveImages(const std::string& path) {
         std::string number = std::to_string(i);
         // Add leading zeros
         number = std::string(4 - number.length(), '0') + number;
-        psiImages[i].saveToFile(path + "/psi/PSI" + number + ".fits");
-        phiImages[i].saveToFile(path + "/phi/PHI" + number + ".fits");
+        vectImage(psiVect, i).saveToFile(path + "/psi/PSI" + number + ".fits");
+        vectImage(phiVect, i).saveToFile(path + "/phi/PHI" + number + ".fits");
     }
 }
 
@@ -252,35 +780,56 @@ void KBMOSearch::createSearchList(int angleSteps, int velocitySteps, float minAn
     }
 }
 
-void KBMOSearch::fillPsiAndPhiVects(const std::vector<RawImage>& psiImgs,
-                                    const std::vector<RawImage>& phiImgs, std::vector<float>* psiVect,
-                                    std::vector<float>* phiVect) {
-    assert(psiVect != NULL);
-    assert(phiVect != NULL);
-
-    int num_images = psiImgs.size();
-    assert(num_images > 0);
-    assert(phiImgs.size() == num_images);
-
-    int num_pixels = psiImgs[0].getNPixels();
-    for (int i = 0; i < num_images; ++i) {
-        assert(psiImgs[i].getNPixels() == num_pixels);
-        assert(phiImgs[i].getNPixels() == num_pixels);
+// Hash a sequence of pixel offsets (FNV-1a over the values).
+struct offsetSequenceHash {
+    size_t operator()(const std::vector<int>& offsets) const {
+        uint64_t hash = 14695981039346656037ULL;
+        for (int value : offsets) {
+            hash ^= (uint32_t)value;
+            hash *= 1099511628211ULL;
+        }
+        return (size_t)hash;
     }
+};
 
-    psiVect->clear();
-    psiVect->reserve(num_images * num_pixels);
-    phiVect->clear();
-    phiVect->reserve(num_images * num_pixels);
-
-    for (int i = 0; i < num_images; ++i) {
-        const std::vector<float>& psiRef = psiImgs[i].getPixels();
-        const std::vector<float>& phiRef = phiImgs[i].getPixels();
-        for (unsigned p = 0; p < num_pixels; ++p) {
-            psiVect->push_back(psiRef[p]);
-            phiVect->push_back(phiRef[p]);
+void KBMOSearch::selectTrajectories(int aSteps, int vSteps, bool dedup) {
+    const std::vector<float>& times = stack.getTimes();
+    const int num_times = times.size();
+    const int angle_end = (gridAngleEnd < 0) ? aSteps : std::min(gridAngleEnd, aSteps);
+    const int velocity_end = (gridVelocityEnd < 0) ? vSteps : std::min(gridVelocityEnd, vSteps);
+
+    // Keep the first trajectory with each sequence of offsets. The offsets are
+    // computed exactly as in the search, so the removed trajectories would have
+    // produced the same results as the one kept. Trajectories outside the grid range
+    // still count as seen, so each offset sequence is searched in only one range.
+    std::unordered_set<std::vector<int>, offsetSequenceHash> seen;
+    std::vector<trajectory> selected;
+    std::vector<int> offsets(2 * num_times);
+    int num_in_range = 0;
+    for (int a = 0; a < aSteps; ++a) {
+        for (int v = 0; v < vSteps; ++v) {
+            const trajectory& trj = searchList[a * vSteps + v];
+            const bool in_range =
+                    (a >= gridAngleStart && a < angle_end && v >= gridVelocityStart && v < velocity_end);
+            num_in_range += in_range;
+
+            if (dedup) {
+                for (int i = 0; i < num_times; ++i) {
+                    offsets[2 * i] = int(trj.xVel * times[i] + 0.5);
+                    offsets[2 * i + 1] = int(trj.yVel * times[i] + 0.5);
+                }
+                if (!seen.insert(offsets).second) continue;
+            }
+            if (in_range) selected.push_back(trj);
         }
     }
+
+    numDuplicateTrajectories = num_in_range - selected.size();
+    searchList = selected;
+    if (debugInfo && dedup) {
+        std::cout << "Removed " << numDuplicateTrajectories << " of " << num_in_range
+                  << " trajectories with duplicate pixel offsets. " << std::flush;
+    }
 }
 
 std::vector<RawImage> KBMOSearch::scienceStamps(const trajectory& trj, int radius, bool interpolate,
@@ -381,7 +930,7 @@ std::vector<RawImage> KBMOSearch::coaddedScienceStamps(std::vector<trajectory>&
         #ifdef HAVE_CUDA
             return coaddedScienceStampsGPU(t_array, use_index_vect, params);
         #else
-            print("WARNING: GPU is not enabled. Performing co-adds on the CPU.");
+            std::cout << "WARNING: GPU is not enabled. Performing co-adds on the CPU.\n";
         #endif
     }
     return coaddedScienceStampsCPU(t_array, use_index_vect, params);
@@ -506,40 +1055,44 @@ std::vector<pixelPos> KBMOSearch::getMultTrajPos(trajectory& t) const {
     return results;
 }
 
-std::vector<float> KBMOSearch::createCurves(trajectory t, const std::vector<RawImage>& imgs) {
+std::vector<float> KBMOSearch::createCurves(trajectory t, const std::vector<float>& imgs) {
     /*Create a lightcurve from an image along a trajectory
      *
      *  INPUT-
      *    trajectory t - The trajectory along which to compute the lightcurve
-     *    std::vector<RawImage*> imgs - The image from which to compute the
-     *      trajectory. Most likely a psiImage or a phiImage.
+     *    std::vector<float> imgs - The images from which to compute the
+     *      trajectory. Most likely psiVect or phiVect.
      *  Output-
      *    std::vector<float> lightcurve - The computed trajectory
      */
 
-    int imgSize = imgs.size();
+    int imgSize = stack.imgCount();
     std::vector<float> lightcurve;
     lightcurve.reserve(imgSize);
-    const std::vector<float>& times = stack.getTimes();
     for (int i = 0; i < imgSize; ++i) {
-        /* Do not use getPixelInterp(), because results from createCurves must
-         * be able to recover the same likelihoods as the ones reported by the
-         * gpu search.*/
-        float pixVal;
-        if (useCorr) {
-            pixelPos pos = getTrajPos(t, i);
-            pixVal = imgs[i].getPixel(int(pos.x + 0.5), int(pos.y + 0.5));
-        }
-        /* Does not use getTrajPos to be backwards compatible with Hits_Rerun */
-        else {
-            pixVal = imgs[i].getPixel(t.x + int(times[i] * t.xVel + 0.5), t.y + int(times[i] * t.yVel + 0.5));
-        }
-        if (pixVal == NO_DATA) pixVal = 0.0;
-        lightcurve.push_back(pixVal);
+        lightcurve.push_back(curveValue(t, i, imgs.data()));
     }
     return lightcurve;
 }
 
+float KBMOSearch::curveValue(const trajectory& t, int i, const float* imgs) const {
+    /* Do not use getPixelInterp(), because results from createCurves must
+     * be able to recover the same likelihoods as the ones reported by the
+     * gpu search.*/
+    float pixVal;
+    if (useCorr) {
+        pixelPos pos = getTrajPos(t, i);
+        pixVal = vectPixel(imgs, i, int(pos.x + 0.5), int(pos.y + 0.5));
+    }
+    /* Does not use getTrajPos to be backwards compatible with Hits_Rerun */
+    else {
+        const float time = stack.getTimes()[i];
+        pixVal = vectPixel(imgs, i, t.x + int(time * t.xVel + 0.5), t.y + int(time * t.yVel + 0.5));
+    }
+    if (pixVal == NO_DATA) pixVal = 0.0;
+    return pixVal;
+}
+
 std::vector<float> KBMOSearch::psiCurves(trajectory& t) {
     /*Generate a psi lightcurve for further analysis
      *  INPUT-
@@ -548,7 +1101,7 @@ std::vector<float> KBMOSearch::psiCurves(trajectory& t) {
      *    std::vector<float> - A vector of the lightcurve values
      */
     preparePsiPhi();
-    return createCurves(t, psiImages);
+    return createCurves(t, psiVect);
 }
 
 std::vector<float> KBMOSearch::phiCurves(trajectory& t) {
@@ -559,12 +1112,86 @@ std::vector<float> KBMOSearch::phiCurves(trajectory& t) {
      *    std::vector<float> - A vector of the lightcurve values
      */
     preparePsiPhi();
-    return createCurves(t, phiImages);
+    return createCurves(t, phiVect);
+}
+
+void KBMOSearch::fillCurves(const trajectory* trjs, int numTrajectories, float* psiOut, float* phiOut) {
+    preparePsiPhi();
+    const int numImages = stack.imgCount();
+
+    #pragma omp parallel for schedule(static)
+    for (int n = 0; n < numTrajectories; ++n) {
+        const long offset = (long)n * numImages;
+        for (int i = 0; i < numImages; ++i) {
+            psiOut[offset + i] = curveValue(trjs[n], i, psiVect.data());
+            phiOut[offset + i] = curveValue(trjs[n], i, phiVect.data());
+        }
+    }
+}
+
+#ifdef Py_PYTHON_H
+pybind11::tuple KBMOSearch::psiPhiCurves(const std::vector<trajectory>& trjs) {
+    const long numTrajectories = trjs.size();
+    const long numImages = stack.imgCount();
+    pybind11::array_t<float> psi({numTrajectories, numImages});
+    pybind11::array_t<float> phi({numTrajectories, numImages});
+    float* psiData = psi.mutable_data();
+    float* phiData = phi.mutable_data();
+    {
+        pybind11::gil_scoped_release release;
+        fillCurves(trjs.data(), numTrajectories, psiData, phiData);
+    }
+    return pybind11::make_tuple(psi, phi);
+}
+
+pybind11::tuple KBMOSearch::resultCurves(int start, int count) {
+    if (start < 0) throw std::runtime_error("start must be 0 or greater");
+    if (count < 0) throw std::runtime_error("count must be 0 or greater");
+    start = std::min(start, (int)results.size());
+    count = std::min(count, (int)results.size() - start);
+
+    const long numImages = stack.imgCount();
+    pybind11::array_t<float> psi({(long)count, numImages});
+    pybind11::array_t<float> phi({(long)count, numImages});
+    float* psiData = psi.mutable_data();
+    float* phiData = phi.mutable_data();
+    {
+        pybind11::gil_scoped_release release;
+        fillCurves(results.data() + start, count, psiData, phiData);
+    }
+    return pybind11::make_tuple(psi, phi);
+}
+#endif
+
+float KBMOSearch::vectPixel(const float* imgs, int i, int x, int y) const {
+    const int width = stack.getWidth();
+    const int height = stack.getHeight();
+    if (x < 0 || x >= width || y < 0 || y >= height) return NO_DATA;
+    return imgs[((long)i * height + y) * width + x];
+}
+
+RawImage KBMOSearch::vectImage(const std::vector<float>& vect, int i) const {
+    const long num_pixels = stack.getNPixels();
+    RawImage img(stack.getWidth(), stack.getHeight());
+    if (vect.size() > 0) {
+        std::copy(vect.begin() + i * num_pixels, vect.begin() + (i + 1) * num_pixels, img.getDataRef());
+    }
+    return img;
 }
 
-std::vector<RawImage>& KBMOSearch::getPsiImages() { return psiImages; }
+std::vector<RawImage> KBMOSearch::getPsiImages() const {
+    std::vector<RawImage> images;
+    if (!psiPhiGenerated) return images;
+    for (int i = 0; i < stack.imgCount(); ++i) images.push_back(vectImage(psiVect, i));
+    return images;
+}
 
-std::vector<RawImage>& KBMOSearch::getPhiImages() { return phiImages; }
+std::vector<RawImage> KBMOSearch::getPhiImages() const {
+    std::vector<RawImage> images;
+    if (!psiPhiGenerated) return images;
+    for (int i = 0; i < stack.imgCount(); ++i) images.push_back(vectImage(phiVect, i));
+    return images;
+}
 
 void KBMOSearch::sortResults() {
     __gnu_parallel::sort(results.begin(), results.end(),
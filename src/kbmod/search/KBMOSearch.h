@@ -6,6 +6,11 @@
  *
  * The KBMOSearch class holds all of the information and functions
  * to perform the core stacked search.
+ *
+ * A KBMOSearch holds its own copy of the ImageStack and does no locking. The const
+ * functions (and the stamp and curve functions once preparePsiPhi() has been called)
+ * may be called concurrently, but the search and the setters must not overlap with
+ * any other call on the same object.
  */
 
 #ifndef KBMODSEARCH_H_
@@ -17,12 +22,17 @@
 #include <iostream>
 #include <fstream>
 #include <chrono>
+#include <unordered_set>
+#include <map>
 #include <stdexcept>
 #include <assert.h>
 #include <float.h>
 #include "common.h"
 #include "ImageStack.h"
 #include "PointSpreadFunc.h"
+#include "SearchCPU.h"
+#include "ShiftStackSearch.h"
+#include "TreeSearch.h"
 
 namespace search {
 
@@ -39,6 +49,19 @@ public:
     void enableGPUSigmaGFilter(std::vector<float> pyPercentiles, float pySigmaGCoeff, float pyMinLH);
     void enableCorr(std::vector<float> pyBaryCorrCoeff);
     void enableGPUEncoding(int psiNumBytes, int phiNumBytes);
+    void setSearchMode(SearchMode mode);
+    void setDedupTrajectories(bool dedup);
+    void enableCoarseSearch(int binFactor, float minCoarseLH);
+    void setLHPruning(bool prune);
+    void setResultsPerPixel(int numResults);
+    int getResultsPerPixel() const { return params.resultsPerPixel; }
+    void enableResultFilter(float minLH, int maxResults);
+
+    // Only search the angle steps [angleStart, angleEnd) and velocity steps
+    // [velocityStart, velocityEnd) of the grid given to search(). An end of -1
+    // means the last step. Searches over ranges that cover the grid find each
+    // pixel's results between them.
+    void setGridRange(int angleStart, int angleEnd, int velocityStart, int velocityEnd);
 
     void setStartBoundsX(int x_min, int x_max);
     void setStartBoundsY(int y_min, int y_max);
@@ -46,9 +69,20 @@ public:
     void search(int aSteps, int vSteps, float minAngle, float maxAngle, float minVelocity, float maxVelocity,
                 int minObservations);
 
+    // The number of trajectories evaluated by the last search and the number of
+    // duplicates (same pixel offsets in every image) that were removed.
+    int getNumTrajectories() const { return searchList.size(); }
+    int getNumDuplicateTrajectories() const { return numDuplicateTrajectories; }
+
+    // The number of (trajectory, image) samples the last CPU grid search skipped by pruning.
+    long getNumSkippedSamples() const { return numSkippedSamples; }
+
     // Gets the vector of result trajectories.
     std::vector<trajectory> getResults(int start, int end);
 
+    // Gets a reference to all of the results. It is invalidated by the next search.
+    std::vector<trajectory>& getAllResults() { return results; }
+
     // Get the predicted (pixel) positions for a given trajectory.
     pixelPos getTrajPos(const trajectory& t, int i) const;
     std::vector<pixelPos> getMultTrajPos(trajectory& t) const;
@@ -81,18 +115,53 @@ public:
     // Function to do the actual stamp filtering.
     bool filterStamp(const RawImage& img, const stampParameters& params);
 
-    // Getters for the Psi and Phi data.
-    std::vector<RawImage>& getPsiImages();
-    std::vector<RawImage>& getPhiImages();
+    // Getters for the Psi and Phi data (copies of each image, empty if they have
+    // not been generated or set).
+    std::vector<RawImage> getPsiImages() const;
+    std::vector<RawImage> getPhiImages() const;
     std::vector<float> psiCurves(trajectory& t);
     std::vector<float> phiCurves(trajectory& t);
 
+    // Fill row-major (numTrajectories x numImages) arrays with the psi and phi curves of
+    // each trajectory (in parallel). The curves match those from psiCurves() and phiCurves().
+    void fillCurves(const trajectory* trjs, int numTrajectories, float* psiOut, float* phiOut);
+#ifdef Py_PYTHON_H
+    // Return the psi and phi curves of a list of trajectories, or of the results
+    // [start, start + count), as a tuple of two (N x numImages) numpy arrays.
+    pybind11::tuple psiPhiCurves(const std::vector<trajectory>& trjs);
+    pybind11::tuple resultCurves(int start, int count);
+#endif
+
     // Save internal data products to a file.
     void savePsiPhi(const std::string& path);
 
     // Helper functions for computing Psi and Phi.
     void preparePsiPhi();
 
+    // Add images to the end of the stack (see ImageStack::appendImages). If the psi
+    // and phi images were already generated (or set), only the new images' psi and
+    // phi images are generated. Throws if barycentric corrections are enabled.
+    void appendImages(const std::vector<LayeredImage>& imgs);
+
+    // Use precomputed psi and phi images (one per image in the stack) instead of
+    // generating them from the stack.
+    void setPsiPhi(const std::vector<RawImage>& psiImgs, const std::vector<RawImage>& phiImgs);
+
+    // Use (or fill) one array of shape (2, numImages, height, width) that holds the psi
+    // images followed by the phi images. Each copies the images once.
+    void setPsiPhiArray(const float* data);
+    void fillPsiPhiArray(float* out);
+
+    // Use the precomputed psi and phi images of the first numSet images, from an array
+    // of shape (2, numSet, height, width), and generate those of the rest of the stack.
+    void setPsiPhiPrefix(const float* data, int numSet);
+#ifdef Py_PYTHON_H
+    void setPsiPhiNumpy(pybind11::array_t<float, pybind11::array::c_style | pybind11::array::forcecast> cube);
+    void setPsiPhiPrefixNumpy(
+            pybind11::array_t<float, pybind11::array::c_style | pybind11::array::forcecast> cube);
+    void fillPsiPhiNumpy(pybind11::array out);
+#endif
+
     // Helper functions for testing.
     void setResults(const std::vector<trajectory>& new_results);
 
@@ -101,14 +170,23 @@ public:
 protected:
     void saveImages(const std::string& path);
     void sortResults();
-    std::vector<float> createCurves(trajectory t, const std::vector<RawImage>& imgs);
+    std::vector<float> createCurves(trajectory t, const std::vector<float>& imgs);
+    float curveValue(const trajectory& t, int i, const float* imgs) const;
+
+    // Generate the psi and phi images of images [first, imgCount()) in parallel,
+    // writing them directly into psiVect and phiVect (which are resized to hold
+    // all of the images).
+    void generatePsiPhi(int first);
+
+    // Return the value of pixel (x, y) of image i in a flattened image vector
+    // (NO_DATA if it is outside the image).
+    float vectPixel(const float* imgs, int i, int x, int y) const;
 
-    // Fill an interleaved vector for the GPU functions.
-    void fillPsiAndPhiVects(const std::vector<RawImage>& psiImgs, const std::vector<RawImage>& phiImgs,
-                            std::vector<float>* psiVect, std::vector<float>* phiVect);
+    // Return a copy of image i of a flattened image vector.
+    RawImage vectImage(const std::vector<float>& vect, int i) const;
 
-    // Set the parameter min/max/scale from the psi/phi/other images.
-    std::vector<scaleParameters> computeImageScaling(const std::vector<RawImage>& vect,
+    // Set the parameter min/max/scale from each image of a flattened image vector.
+    std::vector<scaleParameters> computeImageScaling(const std::vector<float>& vect,
                                                      int encoding_bytes) const;
 
     // Functions to create and access stamps around proposed trajectories or
@@ -121,6 +199,48 @@ protected:
     void createSearchList(int angleSteps, int veloctiySteps, float minAngle, float maxAngle,
                           float minVelocity, float maxVelocity);
 
+    // Runs the search kernel for the current search mode on the given images. Returns
+    // the number of samples skipped by pruning.
+    // The CPU grid kernel reads psiEncoded and phiEncoded (if given, see
+    // encodeForCPUKernels) instead of encoding the images itself.
+    long searchImages(int width, int height, std::vector<float>& psiVect, std::vector<float>& phiVect,
+                      perImageData img_data, const searchParameters& searchParams,
+                      std::vector<trajectory>& trajectories, std::vector<trajectory>& searchResults,
+                      const encodedImageVect* psiEncoded = nullptr,
+                      const encodedImageVect* phiEncoded = nullptr);
+
+    // Encodes the psi and phi images once for repeated calls of the CPU kernels: the
+    // grid kernel gets psiEncoded and phiEncoded, while the other kernels get the
+    // decoded values in psiQuantized and phiQuantized (and the encoding is turned off
+    // in searchParams). Does nothing if the GPU kernel is used.
+    void encodeForCPUKernels(const perImageData& img_data, searchParameters* searchParams,
+                             encodedImageVect* psiEncoded, encodedImageVect* phiEncoded,
+                             std::vector<float>* psiQuantized, std::vector<float>* phiQuantized);
+
+    // Searches binned images with a coarser velocity grid and then refines the starting
+    // pixels and velocities of the coarse results above coarseMinLH.
+    void coarseToFineSearch(perImageData img_data, int aSteps, int vSteps, float minAngle, float maxAngle,
+                            float minVelocity, float maxVelocity);
+
+    // Sums factor x factor blocks of pixels in each image of a flattened image vector.
+    std::vector<float> binImageVect(const std::vector<float>& imageVect, int factor, int* binned_width,
+                                    int* binned_height) const;
+
+    // Runs the search in strips of starting rows, only keeping the results that pass
+    // the result filter (see enableResultFilter).
+    void streamSearch(perImageData img_data);
+
+    // Adds the results that pass the result filter to the results vector (keeping at
+    // most 2 * maxResultCount of them between trims).
+    void addFilteredResults(const std::vector<trajectory>& newResults);
+
+    // Keeps the best maxResultCount results (if set) and sorts them.
+    void finalizeResults();
+
+    // Selects the trajectories of the grid range and removes those whose per-image
+    // pixel offsets match an earlier trajectory of the full grid (if dedup is true).
+    void selectTrajectories(int aSteps, int vSteps, bool dedup);
+
     std::vector<RawImage> coaddedScienceStampsGPU(std::vector<trajectory>& t_array,
                                                   std::vector<std::vector<bool> >& use_index_vect,
                                                   const stampParameters& params);
@@ -132,13 +252,19 @@ protected:
     void startTimer(const std::string& message);
     void endTimer();
 
-    unsigned maxResultCount;
+    // Parameters for filtering the results as they are generated.
+    bool filterResultsOnInsert;
+    float resultMinLH;
+    int maxResultCount;
+
     bool psiPhiGenerated;
     bool debugInfo;
     ImageStack stack;
     std::vector<trajectory> searchList;
-    std::vector<RawImage> psiImages;
-    std::vector<RawImage> phiImages;
+    // The psi and phi images in the layout the search kernels read: pixel (x, y) of
+    // image i is at (i * height + y) * width + x.
+    std::vector<float> psiVect;
+    std::vector<float> phiVect;
     std::vector<trajectory> results;
 
     // Variables for the timer.
@@ -147,6 +273,15 @@ protected:
 
     // Parameters for the GPU search.
     searchParameters params;
+    SearchMode searchMode;
+    bool dedupTrajectories;
+    int numDuplicateTrajectories;
+    int gridAngleStart, gridAngleEnd, gridVelocityStart, gridVelocityEnd;
+    long numSkippedSamples;
+
+    // Parameters for the coarse-to-fine search.
+    int coarseBinFactor;
+    float coarseMinLH;
 
     // Parameters to do barycentric corrections.
     bool useCorr;
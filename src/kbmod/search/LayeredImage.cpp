@@ -21,7 +21,7 @@ LayeredImage::LayeredImage(std::string path, const PointSpreadFunc& psf) : psf(p
     width = science.getWidth();
     height = science.getHeight();
 
-    mask = RawImage();
+    mask = MaskImage();
     mask.loadFromFile(path, 2);
 
     variance = RawImage();
@@ -50,7 +50,7 @@ LayeredImage::LayeredImage(const RawImage& sci, const RawImage& var, const RawIm
 
     // Copy the image layers.
     science = sci;
-    mask = msk;
+    mask = MaskImage(msk);
     variance = var;
 }
 
@@ -78,7 +78,7 @@ LayeredImage::LayeredImage(std::string name, int w, int h, float noiseStDev, flo
     science = RawImage(w, h, rawSci);
     science.setObstime(time);
 
-    mask = RawImage(w, h, std::vector<float>(w * h, 0.0));
+    mask = MaskImage(w, h);
     variance = RawImage(w, h, std::vector<float>(w * h, pixelVariance));
 }
 
@@ -105,8 +105,17 @@ void LayeredImage::addObject(float x, float y, float flux) {
 }
 
 void LayeredImage::growMask(int steps) {
-    science.growMask(steps);
-    variance.growMask(steps);
+    // The layers are usually masked together, in which case they share the grown mask.
+    const std::vector<uint8_t> scienceMask = science.grownMask(steps);
+    const std::vector<float>& sciPix = science.getPixels();
+    const std::vector<float>& varPix = variance.getPixels();
+    bool sameMask = true;
+    for (int p = 0; p < sciPix.size() && sameMask; ++p) {
+        sameMask = ((sciPix[p] == NO_DATA) == (varPix[p] == NO_DATA));
+    }
+
+    science.applyNoDataMask(scienceMask);
+    variance.applyNoDataMask(sameMask ? scienceMask : variance.grownMask(steps));
 }
 
 void LayeredImage::convolvePSF() {
@@ -115,8 +124,46 @@ void LayeredImage::convolvePSF() {
 }
 
 void LayeredImage::applyMaskFlags(int flags, const std::vector<int>& exceptions) {
-    science.applyMask(flags, exceptions, mask);
-    variance.applyMask(flags, exceptions, mask);
+    std::vector<uint8_t> masked;
+    mask.flaggedPixels(flags, exceptions, &masked);
+    science.applyNoDataMask(masked);
+    variance.applyNoDataMask(masked);
+}
+
+void LayeredImage::applyMaskSteps(const std::vector<maskStep>& steps,
+                                  const std::vector<RawImage>& globalMasks) {
+    // Every operation except growing masks the union of the pixels it selects in both
+    // layers, so the order within a run of them does not matter. Collect each run's
+    // pixels and apply them together before the next grow (or at the end).
+    const int num_pixels = getNPixels();
+    const float* sciPix = science.getDataRef();
+    std::vector<uint8_t> masked(num_pixels, 0);
+    std::vector<uint8_t> flagged;
+    bool pending = false;
+    for (int s = 0; s <= steps.size(); ++s) {
+        if (s == steps.size() || steps[s].operation == MASK_GROW) {
+            if (pending) {
+                science.applyNoDataMask(masked);
+                variance.applyNoDataMask(masked);
+                std::fill(masked.begin(), masked.end(), 0);
+                pending = false;
+            }
+            if (s < steps.size()) growMask(steps[s].steps);
+            continue;
+        }
+
+        const maskStep& step = steps[s];
+        pending = true;
+        if (step.operation == MASK_FLAGS) {
+            mask.flaggedPixels(step.flags, step.exceptions, &flagged);
+            for (int p = 0; p < num_pixels; ++p) masked[p] |= flagged[p];
+        } else if (step.operation == MASK_GLOBAL_FLAGS) {
+            const std::vector<float>& globalPix = globalMasks[s].getPixels();
+            for (int p = 0; p < num_pixels; ++p) masked[p] |= (globalPix[p] != 0.0);
+        } else if (step.operation == MASK_THRESHOLD) {
+            for (int p = 0; p < num_pixels; ++p) masked[p] |= (sciPix[p] > step.threshold);
+        }
+    }
 }
 
 /* Mask all pixels that are not 0 in global mask */
@@ -175,7 +222,7 @@ void LayeredImage::saveLayers(const std::string& path) {
     fits_report_error(stderr, status);
 
     science.appendLayerToFile(path + fileName + ".fits");
-    mask.appendLayerToFile(path + fileName + ".fits");
+    mask.appendLayerToFile(path + fileName + ".fits", obstime);
     variance.appendLayerToFile(path + fileName + ".fits");
 }
 
@@ -186,7 +233,7 @@ void LayeredImage::setScience(RawImage& im) {
 
 void LayeredImage::setMask(RawImage& im) {
     checkDims(im);
-    mask = im;
+    mask = MaskImage(im);
 }
 
 void LayeredImage::setVariance(RawImage& im) {
@@ -244,4 +291,24 @@ RawImage LayeredImage::generatePhiImage() {
     return result;
 }
 
+void LayeredImage::fillPsiPhi(float* psiOut, float* phiOut, ConvolutionBuffers* buffers) {
+    const float* sciArray = getSDataRef();
+    const float* varArray = getVDataRef();
+
+    const int num_pixels = getNPixels();
+    for (int p = 0; p < num_pixels; ++p) {
+        float varPix = varArray[p];
+        if (varPix != NO_DATA) {
+            psiOut[p] = sciArray[p] / varPix;
+            phiOut[p] = 1.0 / varPix;
+        } else {
+            psiOut[p] = NO_DATA;
+            phiOut[p] = NO_DATA;
+        }
+    }
+
+    convolveInPlace(psiOut, width, height, psf, buffers);
+    convolveInPlace(phiOut, width, height, psfSQ, buffers);
+}
+
 } /* namespace search */
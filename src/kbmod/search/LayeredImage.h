@@ -19,6 +19,7 @@
 #include <assert.h>
 #include <stdexcept>
 #include "RawImage.h"
+#include "MaskImage.h"
 #include "common.h"
 
 namespace search {
@@ -48,13 +49,13 @@ public:
 
     // Getter functions for the data in the individual layers.
     RawImage& getScience() { return science; }
-    RawImage& getMask() { return mask; }
+    RawImage getMask() const { return mask.toRawImage(); }
+    MaskImage& getMaskImage() { return mask; }
     RawImage& getVariance() { return variance; }
 
     // Get pointers to the raw pixel arrays.
     float* getSDataRef() { return science.getDataRef(); }
     float* getVDataRef() { return variance.getDataRef(); }
-    float* getMDataRef() { return mask.getDataRef(); }
 
     // Applies the mask functions to each of the science and variance layers.
     void applyMaskFlags(int flag, const std::vector<int>& exceptions);
@@ -62,6 +63,10 @@ public:
     void applyMaskThreshold(float thresh);
     void growMask(int steps);
 
+    // Apply a list of masking steps (see ImageStack::applyMaskSteps). globalMasks[s]
+    // is the global mask of step s if it is a MASK_GLOBAL_FLAGS step.
+    void applyMaskSteps(const std::vector<maskStep>& steps, const std::vector<RawImage>& globalMasks);
+
     // Subtracts a template image from the science layer.
     void subtractTemplate(const RawImage& subTemplate);
 
@@ -83,6 +88,11 @@ public:
     RawImage generatePsiImage();
     RawImage generatePhiImage();
 
+    // Write the psi and phi images (the same as from generatePsiImage and
+    // generatePhiImage) to psiOut and phiOut, which each hold getNPixels() floats,
+    // with a single pass over the layers and in place convolutions.
+    void fillPsiPhi(float* psiOut, float* phiOut, ConvolutionBuffers* buffers = nullptr);
+
 private:
     void checkDims(RawImage& im);
 
@@ -93,7 +103,7 @@ private:
     PointSpreadFunc psf;
     PointSpreadFunc psfSQ;
     RawImage science;
-    RawImage mask;
+    MaskImage mask;
     RawImage variance;
 };
 
@@ -0,0 +1,151 @@
+/*
+ * MaskImage.cpp
+ *
+ * Created on: Oct 18, 2026
+ */
+
+#include "MaskImage.h"
+
+namespace search {
+
+// The number of pixels read from a FITS file at a time.
+constexpr long MASK_READ_CHUNK = 1 << 16;
+
+/* Set masked[p] to 1 for each value with any of the flags (and to 0 otherwise). */
+template <typename T>
+void flagValues(const std::vector<T>& values, uint32_t flags, uint8_t* masked) {
+    const long num_pixels = values.size();
+    for (long p = 0; p < num_pixels; ++p) masked[p] = (values[p] & flags) != 0;
+}
+
+MaskImage::MaskImage() : width(0), height(0), wide(false) {}
+
+MaskImage::MaskImage(unsigned w, unsigned h) : width(w), height(h), wide(false), flags16(w * h, 0) {}
+
+MaskImage::MaskImage(const RawImage& img) : MaskImage(img.getWidth(), img.getHeight()) {
+    const std::vector<float>& pixels = img.getPixels();
+    for (unsigned p = 0; p < getNPixels(); ++p) {
+        setPixelFlags(p, static_cast<uint32_t>(static_cast<int>(pixels[p])));
+    }
+}
+
+void MaskImage::widen() {
+    if (wide) return;
+    flags32.assign(flags16.begin(), flags16.end());
+    std::vector<uint16_t>().swap(flags16);
+    wide = true;
+}
+
+void MaskImage::setFlags(int x, int y, uint32_t value) { setPixelFlags((long)y * width + x, value); }
+
+void MaskImage::setPixelFlags(long p, uint32_t value) {
+    if (!wide && value > UINT16_MAX) widen();
+    if (wide) {
+        flags32[p] = value;
+    } else {
+        flags16[p] = static_cast<uint16_t>(value);
+    }
+}
+
+RawImage MaskImage::toRawImage() const {
+    RawImage img(width, height);
+    float* pixels = img.getDataRef();
+    for (unsigned p = 0; p < getNPixels(); ++p) {
+        // Convert through int so that negative flags in the file come back unchanged.
+        pixels[p] = static_cast<float>(static_cast<int>(wide ? flags32[p] : flags16[p]));
+    }
+    return img;
+}
+
+void MaskImage::loadFromFile(const std::string& filePath, int layer_num) {
+    fitsfile* fptr;
+    int status = 0;
+    int fileNotFound;
+    int anynull = 0;
+    float nullval = 0.0;
+
+    std::string layerPath = filePath + "[" + std::to_string(layer_num) + "]";
+    if (fits_open_file(&fptr, layerPath.c_str(), READONLY, &status)) {
+        fits_report_error(stderr, status);
+        throw std::runtime_error("Could not open FITS file to read MaskImage");
+    }
+
+    long dimensions[2];
+    if (fits_read_keys_lng(fptr, "NAXIS", 1, 2, dimensions, &fileNotFound, &status))
+        fits_report_error(stderr, status);
+    width = dimensions[0];
+    height = dimensions[1];
+    wide = false;
+    flags16.assign(getNPixels(), 0);
+    flags32.clear();
+
+    // Read the layer in chunks and truncate the values to integers (as the float mask
+    // layers were), so the whole layer is never held as floats.
+    const long num_pixels = getNPixels();
+    std::vector<float> chunk(std::min(num_pixels, MASK_READ_CHUNK));
+    for (long start = 0; start < num_pixels; start += chunk.size()) {
+        const long count = std::min((long)chunk.size(), num_pixels - start);
+        if (fits_read_img(fptr, TFLOAT, start + 1, count, &nullval, chunk.data(), &anynull, &status))
+            fits_report_error(stderr, status);
+        for (long i = 0; i < count; ++i) {
+            setPixelFlags(start + i, static_cast<uint32_t>(static_cast<int>(chunk[i])));
+        }
+    }
+    if (fits_close_file(fptr, &status)) fits_report_error(stderr, status);
+}
+
+void MaskImage::appendLayerToFile(const std::string& filename, double obstime) const {
+    RawImage img = toRawImage();
+    img.setObstime(obstime);
+    img.appendLayerToFile(filename);
+}
+
+void MaskImage::flaggedPixels(int flags, const std::vector<int>& exceptions,
+                              std::vector<uint8_t>* masked) const {
+    const long num_pixels = getNPixels();
+    masked->resize(num_pixels);
+    uint8_t* result = masked->data();
+    const uint32_t flagBits = static_cast<uint32_t>(flags);
+
+    if (exceptions.size() == 0) {
+        if (wide) {
+            flagValues(flags32, flagBits, result);
+        } else {
+            flagValues(flags16, flagBits, result);
+        }
+        return;
+    }
+
+    if (!wide) {
+        // Look the result of every possible 16 bit value up in a table.
+        std::vector<uint8_t> table(UINT16_MAX + 1);
+        for (uint32_t v = 0; v <= UINT16_MAX; ++v) table[v] = (v & flagBits) != 0;
+        for (int e : exceptions) {
+            if (static_cast<uint32_t>(e) <= UINT16_MAX) table[static_cast<uint32_t>(e)] = 0;
+        }
+        for (long p = 0; p < num_pixels; ++p) result[p] = table[flags16[p]];
+        return;
+    }
+
+    // Only the flagged pixels need to be checked against the (sorted) exceptions.
+    std::vector<uint32_t> sorted;
+    for (int e : exceptions) sorted.push_back(static_cast<uint32_t>(e));
+    std::sort(sorted.begin(), sorted.end());
+    flagValues(flags32, flagBits, result);
+    for (long p = 0; p < num_pixels; ++p) {
+        if (result[p] && std::binary_search(sorted.begin(), sorted.end(), flags32[p])) result[p] = 0;
+    }
+}
+
+void MaskImage::countFlagged(int flags, std::vector<int>& counts) const {
+    const long num_pixels = getNPixels();
+    assert(counts.size() == num_pixels);
+    const uint32_t flagBits = static_cast<uint32_t>(flags);
+    if (wide) {
+        for (long p = 0; p < num_pixels; ++p) counts[p] += (flags32[p] & flagBits) != 0;
+    } else {
+        for (long p = 0; p < num_pixels; ++p) counts[p] += (flags16[p] & flagBits) != 0;
+    }
+}
+
+} /* namespace search */
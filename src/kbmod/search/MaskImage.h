@@ -0,0 +1,80 @@
+/*
+ * MaskImage.h
+ *
+ * Created on: Oct 18, 2026
+ *
+ * MaskImage stores the integer flags of a mask layer. The flags are stored as
+ * 16 bit values, and only widened to 32 bits if a value needs more bits, so the
+ * layer takes half the memory of a float RawImage.
+ */
+
+#ifndef MASKIMAGE_H_
+#define MASKIMAGE_H_
+
+#include <algorithm>
+#include <cstdint>
+#include <fitsio.h>
+#include <stdexcept>
+#include <string>
+#include <vector>
+#include "common.h"
+#include "RawImage.h"
+
+namespace search {
+
+class MaskImage {
+public:
+    MaskImage();
+    explicit MaskImage(unsigned w, unsigned h);
+
+    // Convert the pixels of a RawImage to flags (truncated to integers).
+    explicit MaskImage(const RawImage& img);
+
+    // Basic getter functions for image data.
+    unsigned getWidth() const { return width; }
+    unsigned getHeight() const { return height; }
+    unsigned getNPixels() const { return width * height; }
+
+    // The number of bytes used to store each pixel's flags (2 or 4).
+    int getBytesPerPixel() const { return wide ? 4 : 2; }
+
+    // Get and set the flags of a pixel. Setting a value that does not fit in 16 bits
+    // widens the whole image to 32 bits.
+    uint32_t getFlags(int x, int y) const { return wide ? flags32[y * width + x] : flags16[y * width + x]; }
+    void setFlags(int x, int y, uint32_t value);
+
+    // Pointers to the flags (only the one for the current width is valid).
+    uint16_t* getData16() { return flags16.data(); }
+    uint32_t* getData32() { return flags32.data(); }
+
+    // Return the flags as a float RawImage.
+    RawImage toRawImage() const;
+
+    // Load the flags from a specific layer of a FITS file (overwriting the current
+    // flags) or append them to an existing file as a float layer.
+    void loadFromFile(const std::string& filePath, int layer_num);
+    void appendLayerToFile(const std::string& filename, double obstime) const;
+
+    // Set masked[p] to 1 for each pixel whose flags contain any of the given flags and
+    // are not one of the exceptions (and to 0 otherwise).
+    void flaggedPixels(int flags, const std::vector<int>& exceptions, std::vector<uint8_t>* masked) const;
+
+    // Add 1 to counts[p] for each pixel whose flags contain any of the given flags.
+    void countFlagged(int flags, std::vector<int>& counts) const;
+
+    virtual ~MaskImage(){};
+
+private:
+    void widen();
+    void setPixelFlags(long p, uint32_t value);
+
+    unsigned width;
+    unsigned height;
+    bool wide;
+    std::vector<uint16_t> flags16;
+    std::vector<uint32_t> flags32;
+};
+
+} /* namespace search */
+
+#endif /* MASKIMAGE_H_ */
@@ -116,6 +116,35 @@ void PointSpreadFunc::calcSum() {
     for (auto& i : kernel) sum += i;
 }
 
+bool PointSpreadFunc::getSeparableKernels(std::vector<float>* rowKernel,
+                                          std::vector<float>* colKernel) const {
+    // Factor the kernel through its largest value.
+    int pivot = 0;
+    for (int i = 0; i < kernel.size(); ++i) {
+        if (std::fabs(kernel[i]) > std::fabs(kernel[pivot])) pivot = i;
+    }
+    const float maxValue = std::fabs(kernel[pivot]);
+    if (maxValue == 0.0) return false;
+    const int pivotX = pivot % dim;
+    const int pivotY = pivot / dim;
+
+    rowKernel->resize(dim);
+    colKernel->resize(dim);
+    for (int i = 0; i < dim; ++i) {
+        (*rowKernel)[i] = getValue(i, pivotY) / kernel[pivot];
+        (*colKernel)[i] = getValue(pivotX, i);
+    }
+
+    // Check that the product matches the kernel up to float rounding.
+    const float tolerance = 1e-6 * maxValue;
+    for (int y = 0; y < dim; ++y) {
+        for (int x = 0; x < dim; ++x) {
+            if (std::fabs((*colKernel)[y] * (*rowKernel)[x] - getValue(x, y)) > tolerance) return false;
+        }
+    }
+    return true;
+}
+
 void PointSpreadFunc::squarePSF() {
     for (float& i : kernel) {
         i = i * i;
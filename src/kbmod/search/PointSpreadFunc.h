@@ -49,6 +49,11 @@ public:
     const std::vector<float>& getKernel() const { return kernel; };
     float* kernelData() { return kernel.data(); }
 
+    // If the kernel is the outer product of a column and a row kernel (as the
+    // Gaussian PSFs are), set them so that getValue(x, y) = colKernel[y] * rowKernel[x]
+    // and return true. Otherwise return false.
+    bool getSeparableKernels(std::vector<float>* rowKernel, std::vector<float>* colKernel) const;
+
     // Computation functions.
     void calcSum();
     void squarePSF();
@@ -9,13 +9,6 @@
 
 namespace search {
 
-#ifdef HAVE_CUDA
-    // Performs convolution between an image represented as an array of floats
-    // and a PSF on a GPU device.
-    extern "C" void deviceConvolve(float* sourceImg, float* resultImg, int width, int height, float* psfKernel,
-                                   int psfSize, int psfDim, int psfRadius, float psfSum);
-#endif
-
 RawImage::RawImage() : width(0), height(0), obstime(-1.0) { pixels = std::vector<float>(); }
 
 // Copy constructor
@@ -230,52 +223,11 @@ RawImage RawImage::createStamp(float x, float y, int radius, bool interpolate, b
     return stamp;
 }
 
-void RawImage::convolve_cpu(const PointSpreadFunc& psf) {
-    std::vector<float> result(width * height, 0.0);
-    const int psfRad = psf.getRadius();
-    const float psfTotal = psf.getSum();
-
-    for (int y = 0; y < height; ++y) {
-        for (int x = 0; x < width; ++x) {
-            // Pixels with NO_DATA remain NO_DATA.
-            if (pixels[y * width + x] == NO_DATA) {
-                result[y * width + x] = NO_DATA;
-                continue;
-            }
-
-            float sum = 0.0;
-            float psfPortion = 0.0;
-            for (int j = -psfRad; j <= psfRad; j++) {
-                for (int i = -psfRad; i <= psfRad; i++) {
-                    if ((x + i >= 0) && (x + i < width) && (y + j >= 0) && (y + j < height)) {
-                        float currentPixel = pixels[(y + j) * width + (x + i)];
-                        if (currentPixel != NO_DATA) {
-                            float currentPSF = psf.getValue(i + psfRad, j + psfRad);
-                            psfPortion += currentPSF;
-                            sum += currentPixel * currentPSF;
-                        }
-                    }
-                }
-            }
-            result[y * width + x] = (sum * psfTotal) / psfPortion;
-        }
-    }
-
-    // Copy the data into the pixels vector.
-    const int npixels = getNPixels();
-    for(int i = 0; i < npixels; ++i) {
-        pixels[i] = result[i];
-    }
+void RawImage::convolve_cpu(const PointSpreadFunc& psf, ConvolutionMethod method) {
+    convolveImage(pixels.data(), width, height, psf, method, pixels.data());
 }
 
-void RawImage::convolve(PointSpreadFunc psf) {
-    #ifdef HAVE_CUDA
-        deviceConvolve(pixels.data(), pixels.data(), getWidth(), getHeight(), psf.kernelData(),
-                       psf.getSize(), psf.getDim(), psf.getRadius(), psf.getSum());
-    #else
-        convolve_cpu(psf);
-    #endif
-}
+void RawImage::convolve(PointSpreadFunc psf) { convolveInPlace(pixels.data(), width, height, psf); }
 
 void RawImage::applyMask(int flags, const std::vector<int>& exceptions, const RawImage& mask) {
     const std::vector<float>& maskPix = mask.getPixels();
@@ -289,47 +241,50 @@ void RawImage::applyMask(int flags, const std::vector<int>& exceptions, const Ra
     }
 }
 
-/* This implementation of growMask is optimized for steps > 1
-   (which is how the code is generally used. If you are only
-   growing the mask by 1, the extra copy will be a little slower.
-*/
-void RawImage::growMask(int steps) {
+std::vector<uint8_t> RawImage::grownMask(int steps) const {
     const int num_pixels = width * height;
-
-    // Set up the initial masked vector that stores the number of steps
-    // each pixel is from a masked pixel in the original image.
-    std::vector<int> masked(num_pixels, -1);
-    for (int i = 0; i < num_pixels; ++i) {
-        if (pixels[i] == NO_DATA) masked[i] = 0;
+    std::vector<uint8_t> masked(num_pixels);
+    for (int i = 0; i < num_pixels; ++i) masked[i] = (pixels[i] == NO_DATA);
+    if (steps <= 0) return masked;
+
+    // Growing the mask one pixel at a time (in the 4 directions) masks exactly the
+    // pixels within a Manhattan distance of steps of a masked pixel, so compute that
+    // distance with one forward and one backward pass. Distances are capped at
+    // steps + 1 since larger ones are never masked.
+    const int far = steps + 1;
+    std::vector<int> dist(num_pixels);
+    for (int y = 0; y < height; ++y) {
+        for (int x = 0; x < width; ++x) {
+            const int center = width * y + x;
+            int d = masked[center] ? 0 : far;
+            if (x > 0) d = std::min(d, dist[center - 1] + 1);
+            if (y > 0) d = std::min(d, dist[center - width] + 1);
+            dist[center] = d;
+        }
     }
-
-    // Grow out the mask one for each step.
-    for (int itr = 1; itr <= steps; ++itr) {
-        for (int y = 0; y < height; ++y) {
-            for (int x = 0; x < width; ++x) {
-                int center = width * y + x;
-                if (masked[center] == -1) {
-                    // Mask pixels that are adjacent to a pixel masked during
-                    // the last iteration only.
-                    if ((x + 1 < width && masked[center + 1] == itr - 1) ||
-                        (x - 1 >= 0 && masked[center - 1] == itr - 1) ||
-                        (y + 1 < height && masked[center + width] == itr - 1) ||
-                        (y - 1 >= 0 && masked[center - width] == itr - 1)) {
-                        masked[center] = itr;
-                    }
-                }
-            }
+    for (int y = height - 1; y >= 0; --y) {
+        for (int x = width - 1; x >= 0; --x) {
+            const int center = width * y + x;
+            int d = dist[center];
+            if (x + 1 < width) d = std::min(d, dist[center + 1] + 1);
+            if (y + 1 < height) d = std::min(d, dist[center + width] + 1);
+            dist[center] = d;
+            masked[center] = (d <= steps);
         }
     }
+    return masked;
+}
 
-    // Mask the pixels in the image.
-    for (std::size_t i = 0; i < num_pixels; ++i) {
-        if (masked[i] > -1) {
-            pixels[i] = NO_DATA;
-        }
+void RawImage::applyNoDataMask(const std::vector<uint8_t>& masked) {
+    const int num_pixels = getNPixels();
+    assert(masked.size() == num_pixels);
+    for (int i = 0; i < num_pixels; ++i) {
+        if (masked[i]) pixels[i] = NO_DATA;
     }
 }
 
+void RawImage::growMask(int steps) { applyNoDataMask(grownMask(steps)); }
+
 std::vector<float> RawImage::bilinearInterp(float x, float y) const {
     // Linear interpolation
     // Find the 4 pixels (aPix, bPix, cPix, dPix)
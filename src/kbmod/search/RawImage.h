@@ -26,6 +26,7 @@
 #endif
 #include "common.h"
 #include "PointSpreadFunc.h"
+#include "Convolution.h"
 
 namespace search {
 
@@ -91,9 +92,15 @@ public:
     void addPixelInterp(float x, float y, float value);
     std::vector<float> bilinearInterp(float x, float y) const;
 
-    // Grow the area of masked pixels.
+    // Grow the area of masked pixels by steps pixels in the 4 directions.
     void growMask(int steps);
 
+    // Return which pixels growMask(steps) would mask (without changing the image).
+    std::vector<uint8_t> grownMask(int steps) const;
+
+    // Set the pixels where masked is nonzero to NO_DATA.
+    void applyNoDataMask(const std::vector<uint8_t>& masked);
+
     // Load the image data from a specific layer of a FITS file.
     // Overwrites the current image data.
     void loadFromFile(const std::string& filePath, int layer_num);
@@ -102,9 +109,10 @@ public:
     void saveToFile(const std::string& filename);
     void appendLayerToFile(const std::string& filename);
 
-    // Convolve the image with a point spread function.
+    // Convolve the image with a point spread function. convolve uses the GPU when
+    // available. convolve_cpu uses the given method (see Convolution.h).
     void convolve(PointSpreadFunc psf);
-    void convolve_cpu(const PointSpreadFunc& psf);
+    void convolve_cpu(const PointSpreadFunc& psf, ConvolutionMethod method = CONVOLVE_AUTO);
 
     // Create a "stamp" image of a give radius (width=2*radius+1)
     // about the given point.
@@ -0,0 +1,595 @@
+/*
+ * SearchCPU.cpp
+ *
+ * Created on: Oct 18, 2026
+ *
+ * A multithreaded (OpenMP) CPU implementation of the grid search.
+ */
+
+#include "SearchCPU.h"
+
+namespace search {
+
+/*
+ * Encode a (valid) pixel value exactly as encodeImage() in kernels.cu.
+ */
+template <typename T>
+inline T encodePixel(float value, float safe_max, const scaleParameters& params) {
+    value = std::min(value, safe_max);
+    value = std::max(value, params.minVal);
+    value = (value - params.minVal) / params.scale + 1.0;
+    return static_cast<T>(value);
+}
+
+/*
+ * Decode a pixel value exactly as readEncodedPixel() in kernels.cu.
+ */
+template <typename T>
+inline float decodePixel(T encoded, const scaleParameters& params) {
+    return (encoded == 0) ? NO_DATA : (encoded - 1.0) * params.scale + params.minVal;
+}
+
+template <typename T>
+std::vector<T> encodeImages(const float* imageVect, int numTimes, int numPixels,
+                            const scaleParameters* params) {
+    std::vector<T> result((long)numTimes * numPixels);
+    for (int t = 0; t < numTimes; ++t) {
+        float safe_max = params[t].maxVal - params[t].scale / 100.0;
+        for (int p = 0; p < numPixels; ++p) {
+            long index = (long)t * numPixels + p;
+            float value = imageVect[index];
+            result[index] = (value == NO_DATA) ? 0 : encodePixel<T>(value, safe_max, params[t]);
+        }
+    }
+    return result;
+}
+
+encodedImageVect encodeImageVect(const float* imageVect, int numTimes, int numPixels, int numBytes,
+                                 const scaleParameters* params) {
+    if (numBytes != 1 && numBytes != 2) throw std::runtime_error("Invalid number of encoding bytes.");
+
+    encodedImageVect result;
+    result.numBytes = numBytes;
+    if (numBytes == 1) {
+        result.data8 = encodeImages<uint8_t>(imageVect, numTimes, numPixels, params);
+        result.decodeTable = std::vector<float>(numTimes * 256);
+        for (int t = 0; t < numTimes; ++t) {
+            for (int v = 0; v < 256; ++v) {
+                result.decodeTable[t * 256 + v] = decodePixel((uint8_t)v, params[t]);
+            }
+        }
+    } else {
+        result.data16 = encodeImages<uint16_t>(imageVect, numTimes, numPixels, params);
+    }
+    return result;
+}
+
+std::vector<float> quantizeImageVect(const float* imageVect, int numTimes, int numPixels, int numBytes,
+                                     const scaleParameters* params) {
+    if (numBytes != 1 && numBytes != 2) throw std::runtime_error("Invalid number of encoding bytes.");
+
+    std::vector<float> result((long)numTimes * numPixels);
+    for (int t = 0; t < numTimes; ++t) {
+        float safe_max = params[t].maxVal - params[t].scale / 100.0;
+        for (int p = 0; p < numPixels; ++p) {
+            long index = (long)t * numPixels + p;
+            float value = imageVect[index];
+            if (value == NO_DATA) {
+                result[index] = NO_DATA;
+            } else if (numBytes == 1) {
+                result[index] = decodePixel(encodePixel<uint8_t>(value, safe_max, params[t]), params[t]);
+            } else {
+                result[index] = decodePixel(encodePixel<uint16_t>(value, safe_max, params[t]), params[t]);
+            }
+        }
+    }
+    return result;
+}
+
+/*
+ * Reads the pixels of a flattened psi or phi image vector that is stored either as
+ * floats or with the 1 or 2 byte encoding (decoding each value as the GPU does).
+ */
+template <typename T>
+struct imageReader {
+    const T* data;
+    const scaleParameters* params;
+    inline float operator()(int image, long index) const { return decodePixel(data[index], params[image]); }
+};
+
+// One byte values are decoded with a per-image table of the 256 decoded values.
+template <>
+struct imageReader<uint8_t> {
+    const uint8_t* data;
+    const float* table;
+    inline float operator()(int image, long index) const { return table[image * 256 + data[index]]; }
+};
+
+template <>
+struct imageReader<float> {
+    const float* data;
+    const scaleParameters* params;
+    inline float operator()(int image, long index) const { return data[index]; }
+};
+
+/*
+ * The sigmaG filter of a single trajectory (see sigmaGFilterTrajectory()) reading the
+ * images through imageReaders.
+ */
+template <typename TPsi, typename TPhi>
+void sigmaGFilterEncoded(int x, int y, int imageCount, int width, int height, imageReader<TPsi> psi,
+                         imageReader<TPhi> phi, const int* xOffsets, const int* yOffsets, int stride,
+                         const searchParameters& params, float* lcArray, float* psiArray, float* phiArray,
+                         float* sortArray, trajectory* trj) {
+    const long pixelsPerImage = (long)width * height;
+
+    // Gather the trajectory's valid observations.
+    int num_seen = 0;
+    for (int i = 0; i < imageCount; ++i) {
+        const int currentX = x + xOffsets[i * stride];
+        const int currentY = y + yOffsets[i * stride];
+        if (currentX >= width || currentY >= height || currentX < 0 || currentY < 0) {
+            continue;
+        }
+
+        const long pixel_index = pixelsPerImage * i + currentY * width + currentX;
+        const float cPsi = psi(i, pixel_index);
+        const float cPhi = phi(i, pixel_index);
+        if (cPsi == NO_DATA || cPhi == NO_DATA) continue;
+
+        psiArray[num_seen] = cPsi;
+        phiArray[num_seen] = cPhi;
+        lcArray[num_seen] = (cPhi != 0.0) ? cPsi / cPhi : 0.0;
+        num_seen += 1;
+    }
+
+    float minValue = 0.0;
+    float maxValue = 0.0;
+    sigmaGFilterBounds(lcArray, num_seen, params.sGL_L, params.sGL_H, params.sigmaGCoeff, 2.0, sortArray,
+                       &minValue, &maxValue);
+
+    // Compute the likelihood and flux of the track based on the filtered
+    // observations (ones with a light curve value in [minValue, maxValue]).
+    float newPsiSum = 0.0;
+    float newPhiSum = 0.0;
+    for (int i = 0; i < num_seen; i++) {
+        if ((lcArray[i] >= minValue) && (lcArray[i] <= maxValue)) {
+            newPsiSum += psiArray[i];
+            newPhiSum += phiArray[i];
+        }
+    }
+    trj->lh = newPsiSum / sqrt(newPhiSum);
+    trj->flux = newPsiSum / newPhiSum;
+}
+
+void sigmaGFilterTrajectory(int x, int y, int imageCount, int width, int height, const float* psiVect,
+                            const float* phiVect, const int* xOffsets, const int* yOffsets, int stride,
+                            const searchParameters& params, float* lcArray, float* psiArray, float* phiArray,
+                            float* sortArray, trajectory* trj) {
+    sigmaGFilterEncoded(x, y, imageCount, width, height, imageReader<float>{psiVect, nullptr},
+                        imageReader<float>{phiVect, nullptr}, xOffsets, yOffsets, stride, params, lcArray,
+                        psiArray, phiArray, sortArray, trj);
+}
+
+void insertTrajectory(trajectory trj, trajectory* best, int numResults) {
+    // Insert the new trajectory into the sorted list of results.
+    // Only sort the values with valid likelihoods.
+    trajectory temp;
+    for (int r = 0; r < numResults; ++r) {
+        if (trj.lh > best[r].lh && trj.lh > -1.0) {
+            temp = best[r];
+            best[r] = trj;
+            trj = temp;
+        }
+    }
+}
+
+/*
+ * The read-only data shared by all of the threads in the CPU search (the psi and phi
+ * images are passed separately as imageReaders). The trajectories are split into blocks
+ * of TRAJ_BLOCK_SIZE (padding the last block) and, when we are not using barycentric
+ * corrections, the per-image pixel offsets of every trajectory are precomputed in
+ * [block][image][lane] order.
+ */
+struct cpuSearchData {
+    int imageCount;
+    int width;
+    int height;
+    perImageData image_data;
+    searchParameters params;
+
+    int trajCount;
+    int numBlocks;
+    std::vector<float> xVels;
+    std::vector<float> yVels;
+    std::vector<int> xOffsets;
+    std::vector<int> yOffsets;
+
+    // For pruning: the sum of the (positive) maximum psi values of images i and later.
+    bool prune;
+    std::vector<float> remainingMaxPsi;
+};
+
+/*
+ * Per-thread scratch space.
+ */
+struct cpuSearchScratch {
+    std::vector<int> xOffsets;
+    std::vector<int> yOffsets;
+    std::vector<float> lcArray;
+    std::vector<float> psiArray;
+    std::vector<float> phiArray;
+    std::vector<float> sortArray;
+    long numSkippedSamples;
+};
+
+/*
+ * Compute the pixel offsets (relative to the starting pixel) of a block of trajectories
+ * using the barycentric corrections. This uses the same expression as the GPU kernel, so
+ * the predicted positions are identical.
+ */
+void computeCorrectedOffsets(const cpuSearchData& data, int x, int y, int block, int* xOffsets,
+                             int* yOffsets) {
+    const baryCorrection* baryCorrs = data.image_data.baryCorrs;
+    for (int i = 0; i < data.imageCount; ++i) {
+        const float cTime = data.image_data.imageTimes[i];
+        const baryCorrection bc = baryCorrs[i];
+        for (int l = 0; l < TRAJ_BLOCK_SIZE; ++l) {
+            const int t = block * TRAJ_BLOCK_SIZE + l;
+            const float xVel = data.xVels[t];
+            const float yVel = data.yVels[t];
+            xOffsets[i * TRAJ_BLOCK_SIZE + l] =
+                    int(x + xVel * cTime + bc.dx + x * bc.dxdx + y * bc.dxdy + 0.5) - x;
+            yOffsets[i * TRAJ_BLOCK_SIZE + l] =
+                    int(y + yVel * cTime + bc.dy + x * bc.dydx + y * bc.dydy + 0.5) - y;
+        }
+    }
+}
+
+/*
+ * Check whether a trajectory with the given partial sums (after the first i images) can
+ * still reach a likelihood of at least pruneLH or minObs observations. The remaining
+ * images can add at most remainingMaxPsi to psi and (since phi is never negative) cannot
+ * decrease phi, so psi / sqrt(phi) is bounded by (psi + remainingMaxPsi) / sqrt(phi).
+ * The bound is padded by the worst case rounding error of the float sums, so pruning
+ * never changes the results.
+ */
+inline bool cannotImprove(float psiSum, float psiAbsSum, float phiSum, int count, int numImages,
+                          int numRemaining, float remainingMaxPsi, float pruneLH, int minObs) {
+    if (count + numRemaining < minObs) return true;
+
+    const double error = 4.0 * numImages * FLT_EPSILON;
+    const double upperPsi = (double)psiSum + remainingMaxPsi + error * (psiAbsSum + remainingMaxPsi);
+    const double lowerPhi = (double)phiSum * (1.0 - error);
+    if (lowerPhi <= 0.0) return false;
+
+    const double bound = (upperPsi <= 0.0) ? 0.0 : upperPsi / sqrt(lowerPhi) * (1.0 + error);
+    return bound < pruneLH;
+}
+
+/*
+ * Sum the psi and phi values along a block of TRAJ_BLOCK_SIZE trajectories starting at
+ * pixel (x, y). The offsets are in [image][lane] order. For each image all lanes are
+ * processed together so the loop compiles to vector gathers and blends; out of bounds or
+ * NO_DATA samples contribute nothing. The sums are accumulated in image order (the same
+ * order as the scalar kernel) so the results are bitwise identical.
+ *
+ * If remainingMaxPsi is given, the bounds are checked every PRUNE_CHECK_INTERVAL images
+ * and the evaluation stops once none of the first numLanes lanes can reach pruneLH (or
+ * minObs). Returns the number of images evaluated (imageCount if the block was not pruned).
+ */
+template <typename TPsi, typename TPhi>
+KB_CPU_DISPATCH int evaluateTrajectoryBlock(int x, int y, int imageCount, int width, int height,
+                                            imageReader<TPsi> psi, imageReader<TPhi> phi,
+                                            const int* xOffsets, const int* yOffsets,
+                                            const float* remainingMaxPsi, float pruneLH, int minObs,
+                                            int numLanes, float* psiSums, float* phiSums, int* counts) {
+    const long pixelsPerImage = (long)width * height;
+
+    float psiSum[TRAJ_BLOCK_SIZE];
+    float psiAbsSum[TRAJ_BLOCK_SIZE];
+    float phiSum[TRAJ_BLOCK_SIZE];
+    int count[TRAJ_BLOCK_SIZE];
+    for (int l = 0; l < TRAJ_BLOCK_SIZE; ++l) {
+        psiSum[l] = 0.0;
+        psiAbsSum[l] = 0.0;
+        phiSum[l] = 0.0;
+        count[l] = 0;
+    }
+
+    for (int i = 0; i < imageCount; ++i) {
+        if (remainingMaxPsi != nullptr && i > 0 && i % PRUNE_CHECK_INTERVAL == 0) {
+            bool prune = true;
+            for (int l = 0; l < numLanes && prune; ++l) {
+                prune = cannotImprove(psiSum[l], psiAbsSum[l], phiSum[l], count[l], imageCount,
+                                      imageCount - i, remainingMaxPsi[i], pruneLH, minObs);
+            }
+            if (prune) return i;
+        }
+
+        const long imageStart = pixelsPerImage * i;
+        const int* xOff = xOffsets + i * TRAJ_BLOCK_SIZE;
+        const int* yOff = yOffsets + i * TRAJ_BLOCK_SIZE;
+
+        for (int l = 0; l < TRAJ_BLOCK_SIZE; ++l) {
+            const int currentX = x + xOff[l];
+            const int currentY = y + yOff[l];
+            const bool inBounds =
+                    (currentX >= 0) & (currentX < width) & (currentY >= 0) & (currentY < height);
+
+            // Read a safe pixel for out of bounds lanes and mask the value out below.
+            const int pixel_index = inBounds ? currentY * width + currentX : 0;
+            const float cPsi = psi(i, imageStart + pixel_index);
+            const float cPhi = phi(i, imageStart + pixel_index);
+            const bool valid = inBounds & (cPsi != NO_DATA) & (cPhi != NO_DATA);
+
+            psiSum[l] += valid ? cPsi : 0.0f;
+            psiAbsSum[l] += valid ? std::fabs(cPsi) : 0.0f;
+            phiSum[l] += valid ? cPhi : 0.0f;
+            count[l] += valid ? 1 : 0;
+        }
+    }
+
+    for (int l = 0; l < TRAJ_BLOCK_SIZE; ++l) {
+        psiSums[l] = psiSum[l];
+        phiSums[l] = phiSum[l];
+        counts[l] = count[l];
+    }
+    return imageCount;
+}
+
+/*
+ * Evaluate all of the trajectories for a single starting pixel (x, y) and save the best
+ * params.resultsPerPixel of them (sorted by decreasing likelihood) into best.
+ */
+template <typename TPsi, typename TPhi>
+void searchFilterPixel(const cpuSearchData& data, imageReader<TPsi> psi, imageReader<TPhi> phi, int x, int y,
+                       cpuSearchScratch& scratch, trajectory* best) {
+    const searchParameters& params = data.params;
+    const bool useCorr = params.useCorr && (data.image_data.baryCorrs != nullptr);
+
+    // Create an initial set of best results with likelihood -1.0.
+    // We also set (x, y) because they are used in the later python
+    // functions.
+    for (int r = 0; r < params.resultsPerPixel; ++r) {
+        best[r].x = x;
+        best[r].y = y;
+        best[r].lh = -1.0;
+    }
+
+    float psiSums[TRAJ_BLOCK_SIZE];
+    float phiSums[TRAJ_BLOCK_SIZE];
+    int counts[TRAJ_BLOCK_SIZE];
+    const int offsetsPerBlock = data.imageCount * TRAJ_BLOCK_SIZE;
+    for (int b = 0; b < data.numBlocks; ++b) {
+        const int* xOffsets = &data.xOffsets[0];
+        const int* yOffsets = &data.yOffsets[0];
+        if (useCorr) {
+            computeCorrectedOffsets(data, x, y, b, scratch.xOffsets.data(), scratch.yOffsets.data());
+            xOffsets = scratch.xOffsets.data();
+            yOffsets = scratch.yOffsets.data();
+        } else {
+            xOffsets += (long)b * offsetsPerBlock;
+            yOffsets += (long)b * offsetsPerBlock;
+        }
+        // Without the sigmaG filter, a trajectory only makes the results if it beats the current
+        // worst result. With the filter, the likelihood can increase after filtering, so we can only
+        // prune on minLH (which is applied before filtering).
+        const int numLanes = std::min(TRAJ_BLOCK_SIZE, data.trajCount - b * TRAJ_BLOCK_SIZE);
+        const float pruneLH = params.do_sigmag_filter ? params.minLH : best[params.resultsPerPixel - 1].lh;
+        const int numEvaluated = evaluateTrajectoryBlock(
+                x, y, data.imageCount, data.width, data.height, psi, phi, xOffsets,
+                yOffsets, data.prune ? data.remainingMaxPsi.data() : nullptr, pruneLH,
+                params.minObservations, numLanes, psiSums, phiSums, counts);
+        if (numEvaluated < data.imageCount) {
+            scratch.numSkippedSamples += (long)numLanes * (data.imageCount - numEvaluated);
+            continue;
+        }
+
+        // Process the lanes in trajectory order (skipping the padding).
+        for (int l = 0; l < TRAJ_BLOCK_SIZE; ++l) {
+            const int t = b * TRAJ_BLOCK_SIZE + l;
+            if (t >= data.trajCount) break;
+
+            // Create a trajectory for this search.
+            trajectory currentT;
+            currentT.x = x;
+            currentT.y = y;
+            currentT.xVel = data.xVels[t];
+            currentT.yVel = data.yVels[t];
+            currentT.obsCount = counts[l];
+            currentT.lh = psiSums[l] / sqrt(phiSums[l]);
+            currentT.flux = psiSums[l] / phiSums[l];
+
+            // If we do not have enough observations or a good enough LH score,
+            // do not bother with any of the following steps.
+            if ((currentT.obsCount < params.minObservations) ||
+                (params.do_sigmag_filter && currentT.lh < params.minLH))
+                continue;
+
+            // If we are doing in-line filtering, run the sigmaG filter and recompute
+            // the likelihoods from the remaining observations.
+            if (params.do_sigmag_filter && currentT.obsCount > 0) {
+                sigmaGFilterEncoded(x, y, data.imageCount, data.width, data.height, psi, phi, xOffsets + l,
+                                    yOffsets + l, TRAJ_BLOCK_SIZE, params, scratch.lcArray.data(),
+                                    scratch.psiArray.data(), scratch.phiArray.data(),
+                                    scratch.sortArray.data(), &currentT);
+            }
+
+            insertTrajectory(currentT, best, params.resultsPerPixel);
+        }
+    }
+}
+
+/*
+ * Search all of the starting pixels in data.params' bounds, reading the images through
+ * psi and phi. Returns the number of samples skipped by pruning.
+ */
+template <typename TPsi, typename TPhi>
+long searchAllPixels(cpuSearchData& data, imageReader<TPsi> psi, imageReader<TPhi> phi,
+                     trajectory* bestTrajects) {
+    const searchParameters& params = data.params;
+    const int imageCount = data.imageCount;
+    const int numPixels = data.width * data.height;
+    const int search_width = params.x_start_max - params.x_start_min;
+    const int search_height = params.y_start_max - params.y_start_min;
+
+    // Compute the bounds used for pruning: the sum of the largest psi value of each
+    // remaining image. Pruning relies on phi never being negative.
+    data.prune = params.do_lh_pruning;
+    if (data.prune) {
+        data.remainingMaxPsi = std::vector<float>(imageCount + 1, 0.0);
+        for (int i = imageCount - 1; i >= 0; --i) {
+            float maxPsi = 0.0;
+            for (int p = 0; p < numPixels; ++p) {
+                const float cPsi = psi(i, (long)i * numPixels + p);
+                const float cPhi = phi(i, (long)i * numPixels + p);
+                if (cPsi == NO_DATA || cPhi == NO_DATA) continue;
+                if (cPhi < 0.0) data.prune = false;
+                maxPsi = std::max(maxPsi, cPsi);
+            }
+            data.remainingMaxPsi[i] = data.remainingMaxPsi[i + 1] + maxPsi;
+        }
+    }
+
+    if (params.debug) {
+        printf("Searching %i x %i starting pixels with %i threads (%i trajectory blocks).\n", search_width,
+               search_height, omp_get_max_threads(), data.numBlocks);
+    }
+    long totalSkipped = 0;
+
+    // Each thread allocates its own scratch space once and then processes
+    // full rows of starting pixels.
+    #pragma omp parallel
+    {
+        cpuSearchScratch scratch;
+        scratch.xOffsets = std::vector<int>(imageCount * TRAJ_BLOCK_SIZE);
+        scratch.yOffsets = std::vector<int>(imageCount * TRAJ_BLOCK_SIZE);
+        scratch.lcArray = std::vector<float>(imageCount);
+        scratch.psiArray = std::vector<float>(imageCount);
+        scratch.phiArray = std::vector<float>(imageCount);
+        scratch.sortArray = std::vector<float>(imageCount);
+        scratch.numSkippedSamples = 0;
+
+        #pragma omp for schedule(dynamic)
+        for (int y_i = 0; y_i < search_height; ++y_i) {
+            for (int x_i = 0; x_i < search_width; ++x_i) {
+                // Note the results index is based on the pixel values in search
+                // space (not image space).
+                const long base_index = ((long)y_i * search_width + x_i) * params.resultsPerPixel;
+                searchFilterPixel(data, psi, phi, x_i + params.x_start_min, y_i + params.y_start_min, scratch,
+                                  &bestTrajects[base_index]);
+            }
+        }
+
+        #pragma omp atomic
+        totalSkipped += scratch.numSkippedSamples;
+    }
+
+    if (params.debug && data.prune) {
+        printf("Pruning skipped %li of %li samples.\n", totalSkipped,
+               (long)search_width * search_height * data.trajCount * imageCount);
+    }
+    return totalSkipped;
+}
+
+/*
+ * Pick the phi imageReader for the storage of phi and search.
+ */
+template <typename TPsi>
+long searchWithPhi(cpuSearchData& data, imageReader<TPsi> psi, const float* phiVect,
+                   const encodedImageVect* phiEncoded, trajectory* bestTrajects) {
+    if (phiEncoded == nullptr) {
+        return searchAllPixels(data, psi, imageReader<float>{phiVect, nullptr}, bestTrajects);
+    } else if (phiEncoded->numBytes == 1) {
+        imageReader<uint8_t> phi{phiEncoded->data8.data(), phiEncoded->decodeTable.data()};
+        return searchAllPixels(data, psi, phi, bestTrajects);
+    }
+    imageReader<uint16_t> phi{phiEncoded->data16.data(), data.image_data.phiParams};
+    return searchAllPixels(data, psi, phi, bestTrajects);
+}
+
+/*
+ * Return the encoded images to search: the given ones if they use numBytes bytes or
+ * else newly encoded ones (stored in local). Returns nullptr if the images are not encoded.
+ */
+const encodedImageVect* getEncodedImages(const float* imageVect, int imageCount, int numPixels, int numBytes,
+                                         const scaleParameters* params, const encodedImageVect* given,
+                                         encodedImageVect* local) {
+    if ((numBytes != 1 && numBytes != 2) || params == nullptr) return nullptr;
+    if (given != nullptr && given->numBytes == numBytes) return given;
+    *local = encodeImageVect(imageVect, imageCount, numPixels, numBytes, params);
+    return local;
+}
+
+void cpuSearchFilter(int imageCount, int width, int height, float* psiVect, float* phiVect,
+                     perImageData img_data, searchParameters params, int trajCount,
+                     trajectory* trajectoriesToSearch, int resultsCount, trajectory* bestTrajects,
+                     long* numSkippedSamples, const encodedImageVect* psiEncoded,
+                     const encodedImageVect* phiEncoded) {
+    const int search_width = params.x_start_max - params.x_start_min;
+    const int search_height = params.y_start_max - params.y_start_min;
+    if ((long)search_width * search_height * params.resultsPerPixel > resultsCount) {
+        throw std::runtime_error("Results buffer is too small for the search bounds.");
+    }
+
+    cpuSearchData data;
+    data.imageCount = imageCount;
+    data.width = width;
+    data.height = height;
+    data.image_data = img_data;
+    data.params = params;
+
+    // Use the same encoding as the GPU (if requested) so that both searches return
+    // identical results. The kernel reads the encoded values and decodes them.
+    const int numPixels = width * height;
+    encodedImageVect psiLocal;
+    encodedImageVect phiLocal;
+    psiEncoded = getEncodedImages(psiVect, imageCount, numPixels, params.psiNumBytes, img_data.psiParams,
+                                  psiEncoded, &psiLocal);
+    phiEncoded = getEncodedImages(phiVect, imageCount, numPixels, params.phiNumBytes, img_data.phiParams,
+                                  phiEncoded, &phiLocal);
+
+    // Split the trajectories into blocks, padding the last block with zero velocities.
+    data.trajCount = trajCount;
+    data.numBlocks = (trajCount + TRAJ_BLOCK_SIZE - 1) / TRAJ_BLOCK_SIZE;
+    data.xVels = std::vector<float>(data.numBlocks * TRAJ_BLOCK_SIZE, 0.0);
+    data.yVels = std::vector<float>(data.numBlocks * TRAJ_BLOCK_SIZE, 0.0);
+    for (int t = 0; t < trajCount; ++t) {
+        data.xVels[t] = trajectoriesToSearch[t].xVel;
+        data.yVels[t] = trajectoriesToSearch[t].yVel;
+    }
+
+    // Without barycentric corrections the offsets do not depend on the starting
+    // pixel, so we compute them once.
+    const bool useCorr = params.useCorr && (img_data.baryCorrs != nullptr);
+    if (!useCorr) {
+        data.xOffsets = std::vector<int>((long)data.numBlocks * imageCount * TRAJ_BLOCK_SIZE);
+        data.yOffsets = std::vector<int>((long)data.numBlocks * imageCount * TRAJ_BLOCK_SIZE);
+        for (int b = 0; b < data.numBlocks; ++b) {
+            for (int i = 0; i < imageCount; ++i) {
+                const float cTime = img_data.imageTimes[i];
+                for (int l = 0; l < TRAJ_BLOCK_SIZE; ++l) {
+                    const long index = ((long)b * imageCount + i) * TRAJ_BLOCK_SIZE + l;
+                    data.xOffsets[index] = int(data.xVels[b * TRAJ_BLOCK_SIZE + l] * cTime + 0.5);
+                    data.yOffsets[index] = int(data.yVels[b * TRAJ_BLOCK_SIZE + l] * cTime + 0.5);
+                }
+            }
+        }
+    }
+
+    long totalSkipped = 0;
+    if (psiEncoded == nullptr) {
+        imageReader<float> psi{psiVect, nullptr};
+        totalSkipped = searchWithPhi(data, psi, phiVect, phiEncoded, bestTrajects);
+    } else if (psiEncoded->numBytes == 1) {
+        imageReader<uint8_t> psi{psiEncoded->data8.data(), psiEncoded->decodeTable.data()};
+        totalSkipped = searchWithPhi(data, psi, phiVect, phiEncoded, bestTrajects);
+    } else {
+        imageReader<uint16_t> psi{psiEncoded->data16.data(), img_data.psiParams};
+        totalSkipped = searchWithPhi(data, psi, phiVect, phiEncoded, bestTrajects);
+    }
+    if (numSkippedSamples != nullptr) *numSkippedSamples += totalSkipped;
+}
+
+} /* namespace search */
@@ -0,0 +1,92 @@
+/*
+ * SearchCPU.h
+ *
+ * Created on: Oct 18, 2026
+ *
+ * A multithreaded (OpenMP) CPU implementation of the grid search. It mirrors
+ * the GPU kernel in kernels.cu and produces the same per-pixel results.
+ */
+
+#ifndef SEARCHCPU_H_
+#define SEARCHCPU_H_
+
+#include <algorithm>
+#include <cfloat>
+#include <cmath>
+#include <cstdint>
+#include <stdexcept>
+#include <stdio.h>
+#include <vector>
+#include <omp.h>
+#include "common.h"
+#include "Filtering.h"
+
+namespace search {
+
+/* The number of trajectories evaluated together by the CPU kernel. 16 floats
+   fill an AVX-512 register (or two AVX2 registers). */
+constexpr int TRAJ_BLOCK_SIZE = 16;
+
+/* The number of images between checks of the likelihood bounds when pruning. */
+constexpr int PRUNE_CHECK_INTERVAL = 8;
+
+/* Compile the CPU kernel for several instruction sets and pick the best one
+   supported by the machine at load time. */
+#if defined(__GNUC__) && !defined(__clang__) && defined(__x86_64__)
+#define KB_CPU_DISPATCH __attribute__((target_clones("avx512f", "avx2", "default")))
+#else
+#define KB_CPU_DISPATCH
+#endif
+
+/* A flattened image vector stored with the 1 or 2 byte encoding used on the GPU.
+   Only the vector matching numBytes is filled. For 1 byte, decodeTable holds the
+   256 decoded values of each image. */
+struct encodedImageVect {
+    int numBytes = -1;
+    std::vector<uint8_t> data8;
+    std::vector<uint16_t> data16;
+    std::vector<float> decodeTable;
+};
+
+/* Search the (flattened) psi and phi images for the best params.resultsPerPixel
+   trajectories of each starting pixel in the search bounds. The results are
+   written to bestTrajects using the same layout as deviceSearchFilter(). If
+   params.do_lh_pruning is set, trajectories that can no longer reach the pixel's
+   results are not fully evaluated and the number of skipped (trajectory, image)
+   samples is added to numSkippedSamples (if given).
+
+   If params.psiNumBytes (or phiNumBytes) is 1 or 2, the kernel reads the encoded
+   images and decodes each sample as the GPU does, so it reads 2-4x fewer bytes. The
+   images are encoded on each call unless psiEncoded (or phiEncoded) holds them
+   with the same number of bytes. */
+void cpuSearchFilter(int imageCount, int width, int height, float* psiVect, float* phiVect,
+                     perImageData img_data, searchParameters params, int trajCount,
+                     trajectory* trajectoriesToSearch, int resultsCount, trajectory* bestTrajects,
+                     long* numSkippedSamples = nullptr, const encodedImageVect* psiEncoded = nullptr,
+                     const encodedImageVect* phiEncoded = nullptr);
+
+/* Apply the 1 or 2 byte encoding used on the GPU (see encodeImage() in kernels.cu). */
+encodedImageVect encodeImageVect(const float* imageVect, int numTimes, int numPixels, int numBytes,
+                                 const scaleParameters* params);
+
+/* Apply the 1 or 2 byte encoding used on the GPU (and decode it again) so the
+   CPU search sees the same quantized values. */
+std::vector<float> quantizeImageVect(const float* imageVect, int numTimes, int numPixels, int numBytes,
+                                     const scaleParameters* params);
+
+/* Apply the sigmaG filter to the valid observations of the trajectory starting at
+   (x, y) and recompute its likelihood and flux. The per-image pixel offsets are read
+   from xOffsets[i * stride] and yOffsets[i * stride]. The scratch arrays must hold
+   imageCount values. */
+void sigmaGFilterTrajectory(int x, int y, int imageCount, int width, int height, const float* psiVect,
+                            const float* phiVect, const int* xOffsets, const int* yOffsets, int stride,
+                            const searchParameters& params, float* lcArray, float* psiArray, float* phiArray,
+                            float* sortArray, trajectory* trj);
+
+/* Insert a trajectory into a list of numResults results sorted by
+   decreasing likelihood (dropping the worst one). */
+void insertTrajectory(trajectory trj, trajectory* best, int numResults);
+
+} /* namespace search */
+
+#endif /* SEARCHCPU_H_ */
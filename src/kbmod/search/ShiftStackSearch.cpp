@@ -0,0 +1,167 @@
+/*
+ * ShiftStackSearch.cpp
+ *
+ * Created on: Oct 18, 2026
+ *
+ * A shift-and-stack implementation of the search.
+ */
+
+#include "ShiftStackSearch.h"
+
+namespace search {
+
+/*
+ * Add one (shifted) row of psi and phi values to the accumulators, skipping
+ * NO_DATA pixels.
+ */
+KB_CPU_DISPATCH
+void accumulateShiftedRow(const float* psiRow, const float* phiRow, int numPixels, float* psiAcc,
+                          float* phiAcc, int* countAcc) {
+    for (int p = 0; p < numPixels; ++p) {
+        const float cPsi = psiRow[p];
+        const float cPhi = phiRow[p];
+        const bool valid = (cPsi != NO_DATA) & (cPhi != NO_DATA);
+        psiAcc[p] += valid ? cPsi : 0.0f;
+        phiAcc[p] += valid ? cPhi : 0.0f;
+        countAcc[p] += valid ? 1 : 0;
+    }
+}
+
+void shiftStackSearch(int imageCount, int width, int height, float* psiVect, float* phiVect,
+                      perImageData img_data, searchParameters params, int trajCount,
+                      trajectory* trajectoriesToSearch, int resultsCount, trajectory* bestTrajects) {
+    // The offsets depend on the starting pixel when using barycentric corrections,
+    // so fall back to the per-pixel search.
+    if (params.useCorr && (img_data.baryCorrs != nullptr)) {
+        if (params.debug) printf("Barycentric corrections enabled. Using the grid search.\n");
+        cpuSearchFilter(imageCount, width, height, psiVect, phiVect, img_data, params, trajCount,
+                        trajectoriesToSearch, resultsCount, bestTrajects);
+        return;
+    }
+
+    const int search_width = params.x_start_max - params.x_start_min;
+    const int search_height = params.y_start_max - params.y_start_min;
+    if ((long)search_width * search_height * params.resultsPerPixel > resultsCount) {
+        throw std::runtime_error("Results buffer is too small for the search bounds.");
+    }
+    if (search_width <= 0 || search_height <= 0) return;
+
+    // Apply the same encoding as the GPU (if requested).
+    const long pixelsPerImage = (long)width * height;
+    std::vector<float> psiQuantized;
+    std::vector<float> phiQuantized;
+    const float* psiData = psiVect;
+    const float* phiData = phiVect;
+    if ((params.psiNumBytes == 1 || params.psiNumBytes == 2) && (img_data.psiParams != nullptr)) {
+        psiQuantized = quantizeImageVect(psiVect, imageCount, pixelsPerImage, params.psiNumBytes,
+                                         img_data.psiParams);
+        psiData = psiQuantized.data();
+    }
+    if ((params.phiNumBytes == 1 || params.phiNumBytes == 2) && (img_data.phiParams != nullptr)) {
+        phiQuantized = quantizeImageVect(phiVect, imageCount, pixelsPerImage, params.phiNumBytes,
+                                         img_data.phiParams);
+        phiData = phiQuantized.data();
+    }
+
+    // Precompute the per-image offsets of each trajectory in [trajectory][image] order.
+    std::vector<int> xOffsets((long)trajCount * imageCount);
+    std::vector<int> yOffsets((long)trajCount * imageCount);
+    for (int t = 0; t < trajCount; ++t) {
+        for (int i = 0; i < imageCount; ++i) {
+            const float cTime = img_data.imageTimes[i];
+            xOffsets[(long)t * imageCount + i] = int(trajectoriesToSearch[t].xVel * cTime + 0.5);
+            yOffsets[(long)t * imageCount + i] = int(trajectoriesToSearch[t].yVel * cTime + 0.5);
+        }
+    }
+
+    const int numBands = (search_height + SHIFT_STACK_ROWS - 1) / SHIFT_STACK_ROWS;
+    if (params.debug) {
+        printf("Shift-and-stack search of %i x %i starting pixels with %i threads (%i bands).\n",
+               search_width, search_height, omp_get_max_threads(), numBands);
+    }
+
+    #pragma omp parallel
+    {
+        const long accSize = (long)SHIFT_STACK_ROWS * search_width;
+        std::vector<float> psiAcc(accSize);
+        std::vector<float> phiAcc(accSize);
+        std::vector<int> countAcc(accSize);
+        std::vector<float> lcArray(imageCount);
+        std::vector<float> psiArray(imageCount);
+        std::vector<float> phiArray(imageCount);
+        std::vector<float> sortArray(imageCount);
+
+        #pragma omp for schedule(dynamic)
+        for (int band = 0; band < numBands; ++band) {
+            const int row_start = band * SHIFT_STACK_ROWS;
+            const int num_rows = std::min(SHIFT_STACK_ROWS, search_height - row_start);
+            const long num_band_pixels = (long)num_rows * search_width;
+
+            // Create an initial set of best results with likelihood -1.0.
+            trajectory* bandResults = &bestTrajects[(long)row_start * search_width * params.resultsPerPixel];
+            for (long p = 0; p < num_band_pixels; ++p) {
+                for (int r = 0; r < params.resultsPerPixel; ++r) {
+                    trajectory& res = bandResults[p * params.resultsPerPixel + r];
+                    res.x = params.x_start_min + p % search_width;
+                    res.y = params.y_start_min + row_start + p / search_width;
+                    res.lh = -1.0;
+                }
+            }
+
+            for (int t = 0; t < trajCount; ++t) {
+                const int* xOff = &xOffsets[(long)t * imageCount];
+                const int* yOff = &yOffsets[(long)t * imageCount];
+
+                // Stack the shifted rows of every image (in image order).
+                std::fill(psiAcc.begin(), psiAcc.begin() + num_band_pixels, 0.0f);
+                std::fill(phiAcc.begin(), phiAcc.begin() + num_band_pixels, 0.0f);
+                std::fill(countAcc.begin(), countAcc.begin() + num_band_pixels, 0);
+                for (int i = 0; i < imageCount; ++i) {
+                    // The starting x values whose shifted pixel falls on the image.
+                    const int x_lo = std::max(params.x_start_min, -xOff[i]);
+                    const int x_hi = std::min(params.x_start_max, width - xOff[i]);
+                    if (x_lo >= x_hi) continue;
+
+                    for (int r = 0; r < num_rows; ++r) {
+                        const int currentY = params.y_start_min + row_start + r + yOff[i];
+                        if (currentY < 0 || currentY >= height) continue;
+
+                        const long src = pixelsPerImage * i + (long)currentY * width + x_lo + xOff[i];
+                        const long dst = (long)r * search_width + (x_lo - params.x_start_min);
+                        accumulateShiftedRow(psiData + src, phiData + src, x_hi - x_lo, &psiAcc[dst],
+                                             &phiAcc[dst], &countAcc[dst]);
+                    }
+                }
+
+                // Merge the stacked values into each pixel's results.
+                for (long p = 0; p < num_band_pixels; ++p) {
+                    trajectory currentT;
+                    currentT.x = params.x_start_min + p % search_width;
+                    currentT.y = params.y_start_min + row_start + p / search_width;
+                    currentT.xVel = trajectoriesToSearch[t].xVel;
+                    currentT.yVel = trajectoriesToSearch[t].yVel;
+                    currentT.obsCount = countAcc[p];
+                    currentT.lh = psiAcc[p] / sqrt(phiAcc[p]);
+                    currentT.flux = psiAcc[p] / phiAcc[p];
+
+                    // If we do not have enough observations or a good enough LH score,
+                    // do not bother with any of the following steps.
+                    if ((currentT.obsCount < params.minObservations) ||
+                        (params.do_sigmag_filter && currentT.lh < params.minLH))
+                        continue;
+
+                    if (params.do_sigmag_filter && currentT.obsCount > 0) {
+                        sigmaGFilterTrajectory(currentT.x, currentT.y, imageCount, width, height, psiData,
+                                               phiData, xOff, yOff, 1, params, lcArray.data(),
+                                               psiArray.data(), phiArray.data(), sortArray.data(), &currentT);
+                    }
+
+                    insertTrajectory(currentT, &bandResults[p * params.resultsPerPixel],
+                                     params.resultsPerPixel);
+                }
+            }
+        }
+    }
+}
+
+} /* namespace search */
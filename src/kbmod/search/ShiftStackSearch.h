@@ -0,0 +1,40 @@
+/*
+ * ShiftStackSearch.h
+ *
+ * Created on: Oct 18, 2026
+ *
+ * A shift-and-stack implementation of the search. Without barycentric
+ * corrections a trajectory's per-image pixel offsets do not depend on the
+ * starting pixel, so each trajectory can be evaluated for all starting pixels
+ * at once by adding shifted rows of the psi and phi images. The results are
+ * identical to those of cpuSearchFilter().
+ */
+
+#ifndef SHIFTSTACKSEARCH_H_
+#define SHIFTSTACKSEARCH_H_
+
+#include <algorithm>
+#include <cmath>
+#include <stdexcept>
+#include <stdio.h>
+#include <vector>
+#include <omp.h>
+#include "common.h"
+#include "SearchCPU.h"
+
+namespace search {
+
+/* The number of rows of starting pixels accumulated together. */
+constexpr int SHIFT_STACK_ROWS = 16;
+
+/* Search the (flattened) psi and phi images for the best params.resultsPerPixel
+   trajectories of each starting pixel using shift-and-stack. Uses the same
+   arguments and result layout as cpuSearchFilter() (which is used instead
+   when barycentric corrections are enabled). */
+void shiftStackSearch(int imageCount, int width, int height, float* psiVect, float* phiVect,
+                      perImageData img_data, searchParameters params, int trajCount,
+                      trajectory* trajectoriesToSearch, int resultsCount, trajectory* bestTrajects);
+
+} /* namespace search */
+
+#endif /* SHIFTSTACKSEARCH_H_ */
@@ -0,0 +1,421 @@
+/*
+ * TreeSearch.cpp
+ *
+ * Created on: Oct 18, 2026
+ *
+ * A tree based implementation of the search that reuses partial sums across
+ * trajectories.
+ */
+
+#include "TreeSearch.h"
+
+namespace search {
+
+/*
+ * A node of the halving tree, covering the images [first, last). The node's
+ * sequences are the distinct sequences of pixel offsets of the trajectories over
+ * those images, relative to the offset in the first image. The sequence s of an
+ * internal node is the sequence leftSeq[s] of the left child (the images [first, mid))
+ * followed by the sequence rightSeq[s] of the right child (the images [mid, last))
+ * shifted by (xShift[s], yShift[s]). A leaf (one image) has the single sequence 0.
+ */
+struct treeNode {
+    int first;
+    int last;
+    int left;
+    int right;
+    std::vector<int> leftSeq;
+    std::vector<int> rightSeq;
+    std::vector<int> xShift;
+    std::vector<int> yShift;
+
+    bool isLeaf() const { return left < 0; }
+    int numSeqs() const { return isLeaf() ? 1 : leftSeq.size(); }
+};
+
+/*
+ * The partial sums of an internal node's sequences for one tile of starting pixels.
+ * The sums of sequence s are stored for the box [xMin[s], xMax[s]) x [yMin[s], yMax[s])
+ * of positions in the node's first image, in row-major order from offset[s].
+ */
+struct treeSums {
+    std::vector<int> xMin;
+    std::vector<int> xMax;
+    std::vector<int> yMin;
+    std::vector<int> yMax;
+    std::vector<long> offset;
+    std::vector<float> psi;
+    std::vector<float> phi;
+    std::vector<int> count;
+
+    void resetBoxes(int numSeqs) {
+        xMin.assign(numSeqs, INT_MAX);
+        xMax.assign(numSeqs, INT_MIN);
+        yMin.assign(numSeqs, INT_MAX);
+        yMax.assign(numSeqs, INT_MIN);
+    }
+
+    void addBox(int s, int x0, int y0, int x1, int y1) {
+        xMin[s] = std::min(xMin[s], x0);
+        xMax[s] = std::max(xMax[s], x1);
+        yMin[s] = std::min(yMin[s], y0);
+        yMax[s] = std::max(yMax[s], y1);
+    }
+
+    bool hasBox(int s) const { return xMin[s] < xMax[s]; }
+
+    /* Free the sums (but not the boxes). */
+    void release() {
+        std::vector<float>().swap(psi);
+        std::vector<float>().swap(phi);
+        std::vector<int>().swap(count);
+    }
+};
+
+/* The (possibly encoded) psi and phi images. */
+struct treeImages {
+    int width;
+    int height;
+    long pixelsPerImage;
+    const float* psi;
+    const float* phi;
+};
+
+/*
+ * Build the subtree of the images [first, last), appending its nodes to nodes in
+ * post order (children before their parent), and set seqIds[t] to the sequence of
+ * trajectory t in the subtree's root. Returns the index of the root.
+ */
+int buildTreeNode(int first, int last, int imageCount, int trajCount, const std::vector<int>& xOffsets,
+                  const std::vector<int>& yOffsets, std::vector<treeNode>* nodes, std::vector<int>* seqIds) {
+    treeNode node;
+    node.first = first;
+    node.last = last;
+    node.left = -1;
+    node.right = -1;
+    if (last - first == 1) {
+        seqIds->assign(trajCount, 0);
+        nodes->push_back(node);
+        return nodes->size() - 1;
+    }
+
+    const int mid = (first + last) / 2;
+    std::vector<int> leftIds;
+    std::vector<int> rightIds;
+    node.left = buildTreeNode(first, mid, imageCount, trajCount, xOffsets, yOffsets, nodes, &leftIds);
+    node.right = buildTreeNode(mid, last, imageCount, trajCount, xOffsets, yOffsets, nodes, &rightIds);
+
+    // Two trajectories share a sequence if they share both halves and the offset between them.
+    std::map<std::array<int, 4>, int> seqs;
+    seqIds->resize(trajCount);
+    for (int t = 0; t < trajCount; ++t) {
+        const long base = (long)t * imageCount;
+        const int xShift = xOffsets[base + mid] - xOffsets[base + first];
+        const int yShift = yOffsets[base + mid] - yOffsets[base + first];
+        const std::array<int, 4> key = {leftIds[t], rightIds[t], xShift, yShift};
+        const auto inserted = seqs.emplace(key, (int)seqs.size());
+        if (inserted.second) {
+            node.leftSeq.push_back(key[0]);
+            node.rightSeq.push_back(key[1]);
+            node.xShift.push_back(key[2]);
+            node.yShift.push_back(key[3]);
+        }
+        (*seqIds)[t] = inserted.first->second;
+    }
+    nodes->push_back(std::move(node));
+    return nodes->size() - 1;
+}
+
+/*
+ * Add the psi and phi values of the len pixels of row y from x of one image to the
+ * outputs and count the valid ones. Out of bounds or NO_DATA pixels contribute nothing.
+ */
+KB_CPU_DISPATCH
+void addImageRow(int x, int y, int len, int width, int height, const float* psiImg, const float* phiImg,
+                 float* psiOut, float* phiOut, int* countOut) {
+    if (y < 0 || y >= height) return;
+    const long rowStart = (long)y * width + x;
+    const int start = std::max(0, -x);
+    const int end = std::min(len, width - x);
+    for (int j = start; j < end; ++j) {
+        const float cPsi = psiImg[rowStart + j];
+        const float cPhi = phiImg[rowStart + j];
+        const bool valid = (cPsi != NO_DATA) & (cPhi != NO_DATA);
+        psiOut[j] += valid ? cPsi : 0.0f;
+        phiOut[j] += valid ? cPhi : 0.0f;
+        countOut[j] += valid ? 1 : 0;
+    }
+}
+
+/* Add len partial sums and counts to the outputs. */
+KB_CPU_DISPATCH
+void addSumsRow(int len, const float* psiIn, const float* phiIn, const int* countIn, float* psiOut,
+                float* phiOut, int* countOut) {
+    for (int j = 0; j < len; ++j) {
+        psiOut[j] += psiIn[j];
+        phiOut[j] += phiIn[j];
+        countOut[j] += countIn[j];
+    }
+}
+
+/*
+ * Add the partial sums of sequence s of a node for the len positions of row y from x
+ * (in the node's first image) to the outputs. The node's sums must cover those positions.
+ */
+void addNodeRow(const treeNode& node, const treeSums& sums, int s, int x, int y, int len,
+                const treeImages& images, float* psiOut, float* phiOut, int* countOut) {
+    if (node.isLeaf()) {
+        const long imageStart = images.pixelsPerImage * node.first;
+        addImageRow(x, y, len, images.width, images.height, images.psi + imageStart,
+                    images.phi + imageStart, psiOut, phiOut, countOut);
+        return;
+    }
+    const int boxWidth = sums.xMax[s] - sums.xMin[s];
+    const long index = sums.offset[s] + (long)(y - sums.yMin[s]) * boxWidth + (x - sums.xMin[s]);
+    addSumsRow(len, &sums.psi[index], &sums.phi[index], &sums.count[index], psiOut, phiOut, countOut);
+}
+
+/* Compute the partial sums of all of an internal node's sequences over their boxes. */
+void evaluateTreeNode(const std::vector<treeNode>& nodes, int n, const treeImages& images,
+                      std::vector<treeSums>* state) {
+    const treeNode& node = nodes[n];
+    treeSums& sums = (*state)[n];
+    const treeNode& left = nodes[node.left];
+    const treeNode& right = nodes[node.right];
+    const treeSums& leftSums = (*state)[node.left];
+    const treeSums& rightSums = (*state)[node.right];
+
+    const int numSeqs = node.numSeqs();
+    sums.offset.resize(numSeqs);
+    long total = 0;
+    for (int s = 0; s < numSeqs; ++s) {
+        sums.offset[s] = total;
+        if (sums.hasBox(s)) total += (long)(sums.xMax[s] - sums.xMin[s]) * (sums.yMax[s] - sums.yMin[s]);
+    }
+    sums.psi.assign(total, 0.0);
+    sums.phi.assign(total, 0.0);
+    sums.count.assign(total, 0);
+
+    for (int s = 0; s < numSeqs; ++s) {
+        if (!sums.hasBox(s)) continue;
+        const int boxWidth = sums.xMax[s] - sums.xMin[s];
+        for (int y = sums.yMin[s]; y < sums.yMax[s]; ++y) {
+            const long out = sums.offset[s] + (long)(y - sums.yMin[s]) * boxWidth;
+            addNodeRow(left, leftSums, node.leftSeq[s], sums.xMin[s], y, boxWidth, images, &sums.psi[out],
+                       &sums.phi[out], &sums.count[out]);
+            addNodeRow(right, rightSums, node.rightSeq[s], sums.xMin[s] + node.xShift[s],
+                       y + node.yShift[s], boxWidth, images, &sums.psi[out], &sums.phi[out],
+                       &sums.count[out]);
+        }
+    }
+}
+
+void treeSearch(int imageCount, int width, int height, float* psiVect, float* phiVect,
+                perImageData img_data, searchParameters params, int trajCount,
+                trajectory* trajectoriesToSearch, int resultsCount, trajectory* bestTrajects) {
+    // The offsets depend on the starting pixel when using barycentric corrections,
+    // so fall back to the per-pixel search (as we do when there is nothing to share).
+    if ((params.useCorr && (img_data.baryCorrs != nullptr)) || imageCount < 2) {
+        if (params.debug) printf("Barycentric corrections or a single image. Using the grid search.\n");
+        cpuSearchFilter(imageCount, width, height, psiVect, phiVect, img_data, params, trajCount,
+                        trajectoriesToSearch, resultsCount, bestTrajects);
+        return;
+    }
+
+    const int search_width = params.x_start_max - params.x_start_min;
+    const int search_height = params.y_start_max - params.y_start_min;
+    if ((long)search_width * search_height * params.resultsPerPixel > resultsCount) {
+        throw std::runtime_error("Results buffer is too small for the search bounds.");
+    }
+    if (search_width <= 0 || search_height <= 0) return;
+
+    // Apply the same encoding as the GPU (if requested).
+    const long pixelsPerImage = (long)width * height;
+    std::vector<float> psiQuantized;
+    std::vector<float> phiQuantized;
+    const float* psiData = psiVect;
+    const float* phiData = phiVect;
+    if ((params.psiNumBytes == 1 || params.psiNumBytes == 2) && (img_data.psiParams != nullptr)) {
+        psiQuantized = quantizeImageVect(psiVect, imageCount, pixelsPerImage, params.psiNumBytes,
+                                         img_data.psiParams);
+        psiData = psiQuantized.data();
+    }
+    if ((params.phiNumBytes == 1 || params.phiNumBytes == 2) && (img_data.phiParams != nullptr)) {
+        phiQuantized = quantizeImageVect(phiVect, imageCount, pixelsPerImage, params.phiNumBytes,
+                                         img_data.phiParams);
+        phiData = phiQuantized.data();
+    }
+    const treeImages images = {width, height, pixelsPerImage, psiData, phiData};
+
+    // Precompute the per-image offsets of each trajectory in [trajectory][image] order.
+    std::vector<int> xOffsets((long)trajCount * imageCount);
+    std::vector<int> yOffsets((long)trajCount * imageCount);
+    for (int t = 0; t < trajCount; ++t) {
+        for (int i = 0; i < imageCount; ++i) {
+            const float cTime = img_data.imageTimes[i];
+            xOffsets[(long)t * imageCount + i] = int(trajectoriesToSearch[t].xVel * cTime + 0.5);
+            yOffsets[(long)t * imageCount + i] = int(trajectoriesToSearch[t].yVel * cTime + 0.5);
+        }
+    }
+
+    // Build the tree. The root is the last node.
+    std::vector<treeNode> nodes;
+    std::vector<int> rootIds;
+    const int root =
+            buildTreeNode(0, imageCount, imageCount, trajCount, xOffsets, yOffsets, &nodes, &rootIds);
+    const treeNode& rootNode = nodes[root];
+
+    // Each starting pixel takes one addition per sequence of the internal nodes below
+    // the root and one per trajectory.
+    long numSeqs = 0;
+    for (int n = 0; n < root; ++n) {
+        if (!nodes[n].isLeaf()) numSeqs += nodes[n].numSeqs();
+    }
+
+    // Size the tiles so the partial sums of all the nodes fit in about TREE_SEARCH_TILE_BYTES
+    // (assuming the boxes are twice the tile's size).
+    const long tileArea = std::max(1L, TREE_SEARCH_TILE_BYTES / (24 * std::max(numSeqs, 1L)));
+    const int tileWidth = std::min((long)search_width, std::min((long)TREE_SEARCH_TILE_WIDTH, tileArea));
+    const int tileHeight = std::min((long)search_height, std::max(1L, tileArea / tileWidth));
+    const int tilesPerRow = (search_width + tileWidth - 1) / tileWidth;
+    const long numTiles = (long)tilesPerRow * ((search_height + tileHeight - 1) / tileHeight);
+    if (params.debug) {
+        printf("Tree search of %i x %i starting pixels in %i x %i tiles with %i threads: %li additions "
+               "per starting pixel for %li samples.\n",
+               search_width, search_height, tileWidth, tileHeight, omp_get_max_threads(), numSeqs + trajCount,
+               (long)trajCount * imageCount);
+    }
+
+    #pragma omp parallel
+    {
+        std::vector<treeSums> state(nodes.size());
+        const long tileSize = (long)tileWidth * tileHeight;
+        std::vector<float> psiSums(tileSize);
+        std::vector<float> phiSums(tileSize);
+        std::vector<int> counts(tileSize);
+
+        std::vector<float> lcArray(imageCount);
+        std::vector<float> psiArray(imageCount);
+        std::vector<float> phiArray(imageCount);
+        std::vector<float> sortArray(imageCount);
+
+        #pragma omp for schedule(dynamic)
+        for (long tile = 0; tile < numTiles; ++tile) {
+            const int x_i = (tile % tilesPerRow) * tileWidth;
+            const int y_i = (tile / tilesPerRow) * tileHeight;
+            const int tw = std::min(tileWidth, search_width - x_i);
+            const int th = std::min(tileHeight, search_height - y_i);
+            const int x0 = params.x_start_min + x_i;
+            const int y0 = params.y_start_min + y_i;
+
+            // Find the positions each sequence is needed at, from the root down (the
+            // reverse of the post order).
+            for (int n = 0; n < root; ++n) {
+                if (!nodes[n].isLeaf()) state[n].resetBoxes(nodes[n].numSeqs());
+            }
+            state[root].resetBoxes(rootNode.numSeqs());
+            for (int t = 0; t < trajCount; ++t) {
+                const int bx = x0 + xOffsets[(long)t * imageCount];
+                const int by = y0 + yOffsets[(long)t * imageCount];
+                state[root].addBox(rootIds[t], bx, by, bx + tw, by + th);
+            }
+            for (int n = root; n >= 0; --n) {
+                const treeNode& node = nodes[n];
+                if (node.isLeaf()) continue;
+                const treeSums& sums = state[n];
+                for (int s = 0; s < node.numSeqs(); ++s) {
+                    if (!sums.hasBox(s)) continue;
+                    if (!nodes[node.left].isLeaf()) {
+                        state[node.left].addBox(node.leftSeq[s], sums.xMin[s], sums.yMin[s], sums.xMax[s],
+                                                sums.yMax[s]);
+                    }
+                    if (!nodes[node.right].isLeaf()) {
+                        const int dx = node.xShift[s];
+                        const int dy = node.yShift[s];
+                        state[node.right].addBox(node.rightSeq[s], sums.xMin[s] + dx, sums.yMin[s] + dy,
+                                                 sums.xMax[s] + dx, sums.yMax[s] + dy);
+                    }
+                }
+            }
+
+            // Compute the sums from the leaves up, freeing each node's sums once its
+            // parent has them.
+            for (int n = 0; n < root; ++n) {
+                const treeNode& node = nodes[n];
+                if (node.isLeaf()) continue;
+                evaluateTreeNode(nodes, n, images, &state);
+                state[node.left].release();
+                state[node.right].release();
+            }
+
+            for (int r = 0; r < th; ++r) {
+                for (int j = 0; j < tw; ++j) {
+                    const long base_index =
+                            ((long)(y_i + r) * search_width + x_i + j) * params.resultsPerPixel;
+                    for (int k = 0; k < params.resultsPerPixel; ++k) {
+                        bestTrajects[base_index + k].x = x0 + j;
+                        bestTrajects[base_index + k].y = y0 + r;
+                        bestTrajects[base_index + k].lh = -1.0;
+                    }
+                }
+            }
+
+            for (int t = 0; t < trajCount; ++t) {
+                // The last addition gives the trajectory's sums for the whole tile.
+                const int s = rootIds[t];
+                const int bx = x0 + xOffsets[(long)t * imageCount];
+                const int by = y0 + yOffsets[(long)t * imageCount];
+                std::fill(psiSums.begin(), psiSums.end(), 0.0);
+                std::fill(phiSums.begin(), phiSums.end(), 0.0);
+                std::fill(counts.begin(), counts.end(), 0);
+                for (int r = 0; r < th; ++r) {
+                    const long out = (long)r * tw;
+                    addNodeRow(nodes[rootNode.left], state[rootNode.left], rootNode.leftSeq[s], bx, by + r,
+                               tw, images, &psiSums[out], &phiSums[out], &counts[out]);
+                    addNodeRow(nodes[rootNode.right], state[rootNode.right], rootNode.rightSeq[s],
+                               bx + rootNode.xShift[s], by + r + rootNode.yShift[s], tw, images,
+                               &psiSums[out], &phiSums[out], &counts[out]);
+                }
+
+                // Insert the results for each starting pixel (in the original trajectory order).
+                for (int r = 0; r < th; ++r) {
+                    for (int j = 0; j < tw; ++j) {
+                        const long p = (long)r * tw + j;
+                        const long base_index =
+                                ((long)(y_i + r) * search_width + x_i + j) * params.resultsPerPixel;
+                        trajectory* best = &bestTrajects[base_index];
+
+                        trajectory currentT;
+                        currentT.x = x0 + j;
+                        currentT.y = y0 + r;
+                        currentT.xVel = trajectoriesToSearch[t].xVel;
+                        currentT.yVel = trajectoriesToSearch[t].yVel;
+                        currentT.obsCount = counts[p];
+                        currentT.lh = psiSums[p] / sqrt(phiSums[p]);
+                        currentT.flux = psiSums[p] / phiSums[p];
+
+                        // If we do not have enough observations or a good enough LH score,
+                        // do not bother with any of the following steps.
+                        if ((currentT.obsCount < params.minObservations) ||
+                            (params.do_sigmag_filter && currentT.lh < params.minLH))
+                            continue;
+
+                        if (params.do_sigmag_filter && currentT.obsCount > 0) {
+                            sigmaGFilterTrajectory(currentT.x, currentT.y, imageCount, width, height, psiData,
+                                                   phiData, &xOffsets[(long)t * imageCount],
+                                                   &yOffsets[(long)t * imageCount], 1, params,
+                                                   lcArray.data(), psiArray.data(), phiArray.data(),
+                                                   sortArray.data(), &currentT);
+                        }
+
+                        insertTrajectory(currentT, best, params.resultsPerPixel);
+                    }
+                }
+            }
+            state[rootNode.left].release();
+            state[rootNode.right].release();
+        }
+    }
+}
+
+} /* namespace search */
@@ -0,0 +1,57 @@
+/*
+ * TreeSearch.h
+ *
+ * Created on: Oct 18, 2026
+ *
+ * A tree based implementation of the search that reuses partial sums across
+ * trajectories, as in tree dedispersion. The images are split in halves
+ * recursively. For each half, the trajectories only differ by the sequence of
+ * their pixel offsets relative to the half's first image, and trajectories with
+ * similar velocities share that sequence (all of them do for a single image).
+ * The partial psi and phi sums of each distinct sequence are computed once, for
+ * a tile of starting pixels, by adding the sums of a sequence of the first half
+ * to the (shifted) sums of a sequence of the second half. The full sums of a
+ * trajectory are the last such addition, so each starting pixel costs about one
+ * addition per trajectory plus the (much smaller) numbers of distinct sequences
+ * of the halves, instead of one per trajectory and image.
+ *
+ * The sums are added in a different order than in cpuSearchFilter(), so the
+ * LH and flux values can differ from it by floating point rounding (the
+ * observation counts are identical).
+ */
+
+#ifndef TREESEARCH_H_
+#define TREESEARCH_H_
+
+#include <algorithm>
+#include <array>
+#include <climits>
+#include <cmath>
+#include <map>
+#include <stdexcept>
+#include <stdio.h>
+#include <vector>
+#include <omp.h>
+#include "common.h"
+#include "SearchCPU.h"
+
+namespace search {
+
+/* The maximum width of a tile of starting pixels. */
+constexpr int TREE_SEARCH_TILE_WIDTH = 64;
+
+/* The approximate memory (in bytes) each thread uses for the partial sums of a tile.
+   The tiles get smaller as the number of distinct sequences grows. */
+constexpr long TREE_SEARCH_TILE_BYTES = 1L << 26;
+
+/* Search the (flattened) psi and phi images for the best params.resultsPerPixel
+   trajectories of each starting pixel using the halving tree of partial sums.
+   Uses the same arguments and result layout as cpuSearchFilter() (which is used
+   instead when barycentric corrections are enabled or there is only one image). */
+void treeSearch(int imageCount, int width, int height, float* psiVect, float* phiVect,
+                perImageData img_data, searchParameters params, int trajCount,
+                trajectory* trajectoriesToSearch, int resultsCount, trajectory* bestTrajects);
+
+} /* namespace search */
+
+#endif /* TREESEARCH_H_ */
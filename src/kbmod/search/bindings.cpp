@@ -3,9 +3,14 @@
 #include <pybind11/numpy.h>
 
 #include "PointSpreadFunc.cpp"
+#include "Convolution.cpp"
 #include "RawImage.cpp"
+#include "MaskImage.cpp"
 #include "LayeredImage.cpp"
 #include "ImageStack.cpp"
+#include "SearchCPU.cpp"
+#include "ShiftStackSearch.cpp"
+#include "TreeSearch.cpp"
 #include "KBMOSearch.cpp"
 #include "Filtering.cpp"
 
@@ -13,6 +18,7 @@ namespace py = pybind11;
 
 using pf = search::PointSpreadFunc;
 using ri = search::RawImage;
+using mi = search::MaskImage;
 using li = search::LayeredImage;
 using is = search::ImageStack;
 using ks = search::KBMOSearch;
@@ -25,11 +31,32 @@ using std::to_string;
 PYBIND11_MODULE(search, m) {
     m.attr("KB_NO_DATA") = pybind11::float_(search::NO_DATA);
     m.attr("HAS_GPU") = pybind11::bool_(search::HAVE_GPU);
+    m.attr("MAX_NUM_IMAGES") = pybind11::int_(search::MAX_NUM_IMAGES);
+    m.attr("MAX_SCRATCH_BYTES") = pybind11::int_(search::MAX_SCRATCH_BYTES);
     py::enum_<search::StampType>(m, "StampType")
             .value("STAMP_SUM", search::StampType::STAMP_SUM)
             .value("STAMP_MEAN", search::StampType::STAMP_MEAN)
             .value("STAMP_MEDIAN", search::StampType::STAMP_MEDIAN)
             .export_values();
+    py::enum_<search::SearchMode>(m, "SearchMode")
+            .value("SEARCH_GRID", search::SearchMode::SEARCH_GRID)
+            .value("SEARCH_SHIFT_STACK", search::SearchMode::SEARCH_SHIFT_STACK)
+            .value("SEARCH_TREE", search::SearchMode::SEARCH_TREE)
+            .export_values();
+    py::enum_<search::MaskOperation>(m, "MaskOperation")
+            .value("MASK_FLAGS", search::MaskOperation::MASK_FLAGS)
+            .value("MASK_GLOBAL_FLAGS", search::MaskOperation::MASK_GLOBAL_FLAGS)
+            .value("MASK_THRESHOLD", search::MaskOperation::MASK_THRESHOLD)
+            .value("MASK_GROW", search::MaskOperation::MASK_GROW)
+            .export_values();
+    py::enum_<search::ConvolutionMethod>(m, "ConvolutionMethod")
+            .value("CONVOLVE_AUTO", search::ConvolutionMethod::CONVOLVE_AUTO)
+            .value("CONVOLVE_DIRECT", search::ConvolutionMethod::CONVOLVE_DIRECT)
+            .value("CONVOLVE_SEPARABLE", search::ConvolutionMethod::CONVOLVE_SEPARABLE)
+            .value("CONVOLVE_FFT", search::ConvolutionMethod::CONVOLVE_FFT)
+            .export_values();
+    PYBIND11_NUMPY_DTYPE_EX(tj, xVel, "x_v", yVel, "y_v", lh, "lh", flux, "flux", x, "x", y, "y", obsCount,
+                            "obs_count");
     py::class_<pf>(m, "psf", py::buffer_protocol(), R"pbdoc(
             Point Spread Function.
 
@@ -73,6 +100,16 @@ PYBIND11_MODULE(search, m) {
             .def("get_size", &pf::getSize, "Returns the number of elements in the PSFs kernel.")
             .def("get_kernel", &pf::getKernel, "Returns the PSF kernel.")
             .def("get_value", &pf::getValue, "Returns the PSF kernel value at a specific point.")
+            .def(
+                    "get_separable_kernels",
+                    [](const pf &p) -> py::object {
+                        std::vector<float> rowKernel;
+                        std::vector<float> colKernel;
+                        if (!p.getSeparableKernels(&rowKernel, &colKernel)) return py::none();
+                        return py::make_tuple(rowKernel, colKernel);
+                    },
+                    "Returns the (row, column) kernels whose outer product is the PSF kernel, or None "
+                    "if it is not separable.")
             .def("square_psf", &pf::squarePSF,
                  "Squares, raises to the power of two, the elements of the PSF kernel.")
             .def("print_psf", &pf::printPSF, "Pretty-prints the PSF.");
@@ -101,22 +138,27 @@ PYBIND11_MODULE(search, m) {
             .def("set_pixel", &ri::setPixel, "Set the value of a given pixel.")
             .def("add_pixel", &ri::addToPixel, "Add to the value of a given pixel.")
             .def("apply_mask", &ri::applyMask)
-            .def("grow_mask", &ri::growMask)
+            .def("grow_mask", &ri::growMask, py::call_guard<py::gil_scoped_release>())
             .def("pixel_has_data", &ri::pixelHasData,
                  "Returns a Boolean indicating whether the pixel has data.")
             .def("set_all", &ri::setAllPix, "Set all pixel values given an array.")
             .def("get_pixel", &ri::getPixel, "Returns the value of a pixel.")
             .def("get_pixel_interp", &ri::getPixelInterp, "Get the interoplated value of a pixel.")
-            .def("convolve", &ri::convolve, "Convolve the image with a PSF.")
-            .def("convolve_cpu", &ri::convolve_cpu, "Convolve the image with a PSF.")
-            .def("load_fits", &ri::loadFromFile, "Load the image data from a FITS file.")
-            .def("save_fits", &ri::saveToFile, "Save the image to a FITS file.")
+            .def("convolve", &ri::convolve, "Convolve the image with a PSF.",
+                 py::call_guard<py::gil_scoped_release>())
+            .def("convolve_cpu", &ri::convolve_cpu, "Convolve the image with a PSF on the CPU.",
+                 py::arg("psf"), py::arg("method") = search::CONVOLVE_AUTO,
+                 py::call_guard<py::gil_scoped_release>())
+            .def("load_fits", &ri::loadFromFile, "Load the image data from a FITS file.",
+                 py::call_guard<py::gil_scoped_release>())
+            .def("save_fits", &ri::saveToFile, "Save the image to a FITS file.",
+                 py::call_guard<py::gil_scoped_release>())
             .def("append_fits_layer", &ri::appendLayerToFile, "Append the image as a layer in a FITS file.");
-    m.def("create_median_image", &search::createMedianImage);
-    m.def("create_summed_image", &search::createSummedImage);
-    m.def("create_mean_image", &search::createMeanImage);
+    m.def("create_median_image", &search::createMedianImage, py::call_guard<py::gil_scoped_release>());
+    m.def("create_summed_image", &search::createSummedImage, py::call_guard<py::gil_scoped_release>());
+    m.def("create_mean_image", &search::createMeanImage, py::call_guard<py::gil_scoped_release>());
     py::class_<li>(m, "layered_image")
-            .def(py::init<const std::string, pf &>())
+            .def(py::init<const std::string, pf &>(), py::call_guard<py::gil_scoped_release>())
             .def(py::init<const ri &, const ri &, const ri &, pf &>(), R"pbdoc(
             Creates a layered_image out of individual `raw_image` layers.
 
@@ -135,59 +177,110 @@ PYBIND11_MODULE(search, m) {
             ------
             Raises an exception if the layers are not the same size.
             )pbdoc")
-            .def(py::init<std::string, int, int, double, float, float, pf &>())
-            .def(py::init<std::string, int, int, double, float, float, pf &, int>())
+            .def(py::init<std::string, int, int, double, float, float, pf &>(),
+                 py::call_guard<py::gil_scoped_release>())
+            .def(py::init<std::string, int, int, double, float, float, pf &, int>(),
+                 py::call_guard<py::gil_scoped_release>())
             .def("set_psf", &li::setPSF, "Sets the PSF object.")
             .def("get_psf", &li::getPSF, "Returns the PSF object.")
             .def("get_psfsq", &li::getPSFSQ)
-            .def("apply_mask_flags", &li::applyMaskFlags)
-            .def("apply_mask_threshold", &li::applyMaskThreshold)
-            .def("sub_template", &li::subtractTemplate)
-            .def("save_layers", &li::saveLayers)
+            .def("apply_mask_flags", &li::applyMaskFlags, py::call_guard<py::gil_scoped_release>())
+            .def("apply_mask_threshold", &li::applyMaskThreshold, py::call_guard<py::gil_scoped_release>())
+            .def("sub_template", &li::subtractTemplate, py::call_guard<py::gil_scoped_release>())
+            .def("save_layers", &li::saveLayers, py::call_guard<py::gil_scoped_release>())
             .def("get_science", &li::getScience, "Returns the science layer raw_image.")
             .def("get_mask", &li::getMask, "Returns the mask layer raw_image.")
+            .def(
+                    "get_mask_array",
+                    [](py::object self) -> py::array {
+                        li &img = self.cast<li &>();
+                        mi &mask = img.getMaskImage();
+                        const std::vector<long> shape = {mask.getHeight(), mask.getWidth()};
+                        if (mask.getBytesPerPixel() == 4) {
+                            return py::array_t<uint32_t>(shape, mask.getData32(), self);
+                        }
+                        return py::array_t<uint16_t>(shape, mask.getData16(), self);
+                    },
+                    R"pbdoc(
+            Returns a writable numpy view (uint16, or uint32 if any flag value needs
+            more than 16 bits) of the mask layer's flags. The view keeps the image alive,
+            but is invalidated by ``set_mask``.
+            )pbdoc")
             .def("get_variance", &li::getVariance, "Returns the variance layer raw_image.")
             .def("set_science", &li::setScience)
             .def("set_mask", &li::setMask)
             .def("set_variance", &li::setVariance)
-            .def("convolve_psf", &li::convolvePSF)
+            .def("convolve_psf", &li::convolvePSF, py::call_guard<py::gil_scoped_release>())
             .def("add_object", &li::addObject)
-            .def("grow_mask", &li::growMask)
+            .def("grow_mask", &li::growMask, py::call_guard<py::gil_scoped_release>())
             .def("get_name", &li::getName, "Returns the name of the layered image.")
             .def("get_width", &li::getWidth, "Returns the image's width in pixels.")
             .def("get_height", &li::getHeight, "Returns the image's height in pixels.")
             .def("get_npixels", &li::getNPixels, "Returns the image's total number of pixels.")
             .def("get_obstime", &li::getObstime, "Get the image's observation time.")
             .def("set_obstime", &li::setObstime, "Set the image's observation time.")
-            .def("generate_psi_image", &li::generatePsiImage)
-            .def("generate_phi_image", &li::generatePhiImage);
+            .def("generate_psi_image", &li::generatePsiImage, py::call_guard<py::gil_scoped_release>())
+            .def("generate_phi_image", &li::generatePhiImage, py::call_guard<py::gil_scoped_release>());
     py::class_<is>(m, "image_stack")
-            .def(py::init<std::vector<std::string>, std::vector<pf>>())
+            .def(py::init<std::vector<std::string>, std::vector<pf>>(),
+                 py::call_guard<py::gil_scoped_release>())
             .def(py::init<std::vector<li>>())
+            .def(py::init<unsigned, unsigned, const std::vector<float> &>(), R"pbdoc(
+            Creates a stack with only the width, height and times of its images and
+            no pixel data, for searches that only use precomputed psi and phi images
+            (see stack_search.set_psi_phi_array).
+            )pbdoc")
             .def("get_images", &is::getImages)
             .def("get_single_image", &is::getSingleImage)
+            .def("get_psf", &is::getPSF, "Returns (a copy of) one image's PSF without copying the image.")
             .def("set_single_image", &is::setSingleImage)
             .def("get_times", &is::getTimes)
             .def("set_times", &is::setTimes)
+            .def("append_images", &is::appendImages, R"pbdoc(
+            Adds images (of the same size) to the end of the stack. Their times are
+            their observation times relative to the first image's.
+            )pbdoc")
             .def("img_count", &is::imgCount)
-            .def("apply_mask_flags", &is::applyMaskFlags)
-            .def("apply_mask_threshold", &is::applyMaskThreshold)
-            .def("apply_global_mask", &is::applyGlobalMask)
-            .def("grow_mask", &is::growMask)
-            .def("save_global_mask", &is::saveGlobalMask)
-            .def("save_images", &is::saveImages)
+            .def("apply_mask_flags", &is::applyMaskFlags, py::call_guard<py::gil_scoped_release>())
+            .def("apply_mask_threshold", &is::applyMaskThreshold, py::call_guard<py::gil_scoped_release>())
+            .def("apply_global_mask", &is::applyGlobalMask, py::call_guard<py::gil_scoped_release>())
+            .def("grow_mask", &is::growMask, py::call_guard<py::gil_scoped_release>())
+            .def("apply_mask_steps", &is::applyMaskSteps, py::call_guard<py::gil_scoped_release>(), R"pbdoc(
+            Applies a list of `mask_step` in a single pass over each image. The result
+            is the same as calling the corresponding masking functions in order.
+            )pbdoc")
+            .def("save_global_mask", &is::saveGlobalMask, py::call_guard<py::gil_scoped_release>())
+            .def("save_images", &is::saveImages, py::call_guard<py::gil_scoped_release>())
             .def("get_global_mask", &is::getGlobalMask)
-            .def("convolve_psf", &is::convolvePSF)
+            .def("convolve_psf", &is::convolvePSF, py::call_guard<py::gil_scoped_release>())
             .def("get_width", &is::getWidth)
             .def("get_height", &is::getHeight)
-            .def("get_npixels", &is::getNPixels);
+            .def("get_npixels", &is::getNPixels)
+            .def("has_pixels", &is::hasPixels, "Returns whether the stack holds the images' pixel data.");
     py::class_<ks>(m, "stack_search")
-            .def(py::init<is &>())
-            .def("save_psi_phi", &ks::savePsiPhi)
-            .def("search", &ks::search)
+            .def(py::init<is &>(), py::call_guard<py::gil_scoped_release>())
+            .def("save_psi_phi", &ks::savePsiPhi, py::call_guard<py::gil_scoped_release>())
+            .def("search", &ks::search, py::call_guard<py::gil_scoped_release>())
             .def("enable_gpu_sigmag_filter", &ks::enableGPUSigmaGFilter)
             .def("enable_gpu_encoding", &ks::enableGPUEncoding)
             .def("enable_corr", &ks::enableCorr)
+            .def("set_search_mode", &ks::setSearchMode)
+            .def("set_dedup_trajectories", &ks::setDedupTrajectories)
+            .def("enable_coarse_search", &ks::enableCoarseSearch)
+            .def("set_lh_pruning", &ks::setLHPruning)
+            .def("set_results_per_pixel", &ks::setResultsPerPixel)
+            .def("get_results_per_pixel", &ks::getResultsPerPixel)
+            .def("set_grid_range", &ks::setGridRange, R"pbdoc(
+            Only search the angle steps [angle_start, angle_end) and velocity steps
+            [velocity_start, velocity_end) of the grid given to search (an end of -1
+            means the last step). Duplicate trajectories (see set_dedup_trajectories)
+            are removed using the full grid, so searches over ranges that cover the
+            grid search each trajectory once.
+            )pbdoc")
+            .def("enable_result_filter", &ks::enableResultFilter)
+            .def("get_num_skipped_samples", &ks::getNumSkippedSamples)
+            .def("get_num_trajectories", &ks::getNumTrajectories)
+            .def("get_num_duplicate_trajectories", &ks::getNumDuplicateTrajectories)
             .def("set_start_bounds_x", &ks::setStartBoundsX)
             .def("set_start_bounds_y", &ks::setStartBoundsY)
             .def("set_debug", &ks::setDebug)
@@ -195,25 +288,74 @@ PYBIND11_MODULE(search, m) {
             .def("get_num_images", &ks::numImages)
             .def("get_image_stack", &ks::getImageStack)
             // Science Stamp Functions
-            .def("science_viz_stamps", &ks::scienceStampsForViz)
-            .def("median_sci_stamp", &ks::medianScienceStamp)
-            .def("mean_sci_stamp", &ks::meanScienceStamp)
-            .def("summed_sci_stamp", &ks::summedScienceStamp)
+            .def("science_viz_stamps", &ks::scienceStampsForViz, py::call_guard<py::gil_scoped_release>())
+            .def("median_sci_stamp", &ks::medianScienceStamp, py::call_guard<py::gil_scoped_release>())
+            .def("mean_sci_stamp", &ks::meanScienceStamp, py::call_guard<py::gil_scoped_release>())
+            .def("summed_sci_stamp", &ks::summedScienceStamp, py::call_guard<py::gil_scoped_release>())
             .def("coadded_stamps",
                  (std::vector<ri>(ks::*)(std::vector<tj> &, std::vector<std::vector<bool>> &,
                                          const search::stampParameters &, bool)) &
-                         ks::coaddedScienceStamps)
+                         ks::coaddedScienceStamps,
+                 py::call_guard<py::gil_scoped_release>())
             // For testing
             .def("filter_stamp", &ks::filterStamp)
             .def("get_traj_pos", &ks::getTrajPos)
             .def("get_mult_traj_pos", &ks::getMultTrajPos)
-            .def("psi_curves", (std::vector<float>(ks::*)(tj &)) & ks::psiCurves)
-            .def("phi_curves", (std::vector<float>(ks::*)(tj &)) & ks::phiCurves)
-            .def("prepare_psi_phi", &ks::preparePsiPhi)
+            .def("psi_curves", (std::vector<float>(ks::*)(tj &)) & ks::psiCurves,
+                 py::call_guard<py::gil_scoped_release>())
+            .def("phi_curves", (std::vector<float>(ks::*)(tj &)) & ks::phiCurves,
+                 py::call_guard<py::gil_scoped_release>())
+            .def("psi_phi_curves", &ks::psiPhiCurves, R"pbdoc(
+            Returns the psi and phi curves of a list of trajectories as a tuple
+            of two float32 `numpy.array` with one row per trajectory.
+            )pbdoc")
+            .def("get_result_curves", &ks::resultCurves, R"pbdoc(
+            Returns the psi and phi curves of the results [start, start + count)
+            as a tuple of two float32 `numpy.array` with one row per result.
+            )pbdoc")
+            .def("prepare_psi_phi", &ks::preparePsiPhi, py::call_guard<py::gil_scoped_release>())
+            .def("set_psi_phi", &ks::setPsiPhi, "Sets precomputed psi and phi images.")
+            .def("set_psi_phi_array", &ks::setPsiPhiNumpy, R"pbdoc(
+            Sets precomputed psi and phi images from one float32 array of shape
+            (2, num_images, height, width) holding the psi images followed by the
+            phi images. The array is copied once into the search.
+            )pbdoc")
+            .def("set_psi_phi_prefix", &ks::setPsiPhiPrefixNumpy, R"pbdoc(
+            Sets the precomputed psi and phi images of the first images of the stack
+            from one float32 array of shape (2, num_set, height, width) and generates
+            those of the remaining images. The array is copied once into the search.
+            )pbdoc")
+            .def("fill_psi_phi_array", &ks::fillPsiPhiNumpy, R"pbdoc(
+            Copies the psi and phi images (generating them if needed) into a
+            writable C contiguous float32 array of shape (2, num_images, height, width).
+            )pbdoc")
+            .def("append_images", &ks::appendImages, py::call_guard<py::gil_scoped_release>(), R"pbdoc(
+            Adds images to the end of the search's stack (see image_stack.append_images).
+            If the psi and phi images were already generated (or set), only the new
+            images' psi and phi images are generated.
+            )pbdoc")
             .def("get_psi_images", &ks::getPsiImages)
             .def("get_phi_images", &ks::getPhiImages)
             .def("get_results", &ks::getResults)
-            .def("set_results", &ks::setResults);
+            .def(
+                    "get_results_array",
+                    [](py::object self) {
+                        std::vector<tj> &results = self.cast<ks &>().getAllResults();
+                        return py::array_t<tj>({results.size()}, {sizeof(tj)}, results.data(), self);
+                    },
+                    R"pbdoc(
+            Returns a structured `numpy.array` with the fields (x_v, y_v, lh, flux,
+            x, y, obs_count) that views all of the results without copying them.
+            The view is only valid until the next search (or set_results) call.
+            )pbdoc")
+            .def("set_results", &ks::setResults)
+            .def(
+                    "set_results_array",
+                    [](ks &s, py::array_t<tj, py::array::c_style> arr) {
+                        const tj *data = arr.data();
+                        s.setResults(std::vector<tj>(data, data + arr.size()));
+                    },
+                    "Sets the results from a structured `numpy.array` (see get_results_array).");
     py::class_<tj>(m, "trajectory", R"pbdoc(
             A trajectory structure holding basic information about potential results.
             )pbdoc")
@@ -268,6 +410,14 @@ PYBIND11_MODULE(search, m) {
             .def_readwrite("m11", &search::stampParameters::m11_limit)
             .def_readwrite("m02", &search::stampParameters::m02_limit)
             .def_readwrite("m20", &search::stampParameters::m20_limit);
+    py::class_<search::maskStep>(m, "mask_step")
+            .def(py::init<>())
+            .def_readwrite("operation", &search::maskStep::operation)
+            .def_readwrite("flags", &search::maskStep::flags)
+            .def_readwrite("exceptions", &search::maskStep::exceptions)
+            .def_readwrite("num_images", &search::maskStep::numImages)
+            .def_readwrite("threshold", &search::maskStep::threshold)
+            .def_readwrite("steps", &search::maskStep::steps);
     py::class_<bc>(m, "baryCorrection")
             .def(py::init<>())
             .def_readwrite("dx", &bc::dx)
@@ -283,5 +433,9 @@ PYBIND11_MODULE(search, m) {
             });
     // Functions from Filtering.cpp
     m.def("sigmag_filtered_indices", &search::sigmaGFilteredIndices);
+    m.def("sigmag_filtered_masks", &search::sigmaGFilteredMasks);
     m.def("calculate_likelihood_psi_phi", &search::calculateLikelihoodFromPsiPhi);
+    // Sizing of the GPU search's strips of rows (from common.h).
+    m.def("gpu_search_strip_height", &search::gpuSearchStripHeight);
+    m.def("gpu_scratch_bytes", &search::gpuScratchBytes);
 }
@@ -8,6 +8,9 @@
 #ifndef COMMON_H_
 #define COMMON_H_
 
+#include <algorithm>
+#include <vector>
+
 namespace search {
 
 #ifdef HAVE_CUDA
@@ -21,11 +24,47 @@ constexpr unsigned short MAX_STAMP_EDGE = 64;
 constexpr unsigned short CONV_THREAD_DIM = 32;
 constexpr unsigned short THREAD_DIM_X = 128;
 constexpr unsigned short THREAD_DIM_Y = 2;
-constexpr unsigned short RESULTS_PER_PIXEL = 8;
+constexpr unsigned short RESULTS_PER_PIXEL = 8;  // The default number of results per pixel.
+constexpr unsigned short MAX_RESULTS_PER_PIXEL = 64;
+constexpr long RESULTS_PER_STRIP = 1 << 20;  // The results buffer size when filtering on insert.
 constexpr float NO_DATA = -9999.0;
 
+// The GPU search keeps the sigmaG filter's arrays for stacks of up to MAX_NUM_IMAGES
+// images in local memory. Larger stacks use at most MAX_SCRATCH_BYTES of global memory.
+constexpr int MAX_NUM_IMAGES = 140;
+constexpr long MAX_SCRATCH_BYTES = 1L << 29;
+
 enum StampType { STAMP_SUM = 0, STAMP_MEAN, STAMP_MEDIAN };
 
+// The algorithm used to evaluate the trajectories in KBMOSearch::search().
+enum SearchMode { SEARCH_GRID = 0, SEARCH_SHIFT_STACK, SEARCH_TREE };
+
+// The algorithm used by the CPU convolution (see Convolution.h). CONVOLVE_AUTO picks
+// the fastest one for the image and PSF.
+enum ConvolutionMethod { CONVOLVE_AUTO = 0, CONVOLVE_DIRECT, CONVOLVE_SEPARABLE, CONVOLVE_FFT };
+
+// The masking operations that ImageStack::applyMaskSteps() can run.
+enum MaskOperation { MASK_FLAGS = 0, MASK_GLOBAL_FLAGS, MASK_THRESHOLD, MASK_GROW };
+
+/*
+ * The number of starting rows the GPU search launches at a time. Stacks of more than
+ * MAX_NUM_IMAGES images that use the sigmaG filter need 4 values of scratch space per
+ * image and starting pixel, so they are searched in strips of rows whose scratch space
+ * fits in MAX_SCRATCH_BYTES (but at least one row). Other searches use a single strip.
+ */
+inline int gpuSearchStripHeight(int imageCount, int searchWidth, int searchHeight, bool sigmaGFilter) {
+    if (!sigmaGFilter || imageCount <= MAX_NUM_IMAGES || searchWidth <= 0) return searchHeight;
+    const long bytes_per_row = 4L * sizeof(float) * imageCount * searchWidth;
+    const long rows = MAX_SCRATCH_BYTES / bytes_per_row;
+    return (int)std::max(1L, std::min((long)searchHeight, rows));
+}
+
+/* The bytes of global scratch space the GPU search needs for strips of stripHeight rows. */
+inline long gpuScratchBytes(int imageCount, int searchWidth, int stripHeight, bool sigmaGFilter) {
+    if (!sigmaGFilter || imageCount <= MAX_NUM_IMAGES) return 0;
+    return 4L * sizeof(float) * imageCount * searchWidth * stripHeight;
+}
+
 /*
  * Data structure to represent an objects trajectory
  * through a stack of images
@@ -82,6 +121,13 @@ struct searchParameters {
     // Do barycentric corrections.
     bool useCorr;
 
+    // The number of results to keep for each starting pixel
+    // (at most MAX_RESULTS_PER_PIXEL).
+    int resultsPerPixel;
+
+    // Stop evaluating trajectories that can no longer make the results (CPU only).
+    bool do_lh_pruning;
+
     // Use a compressed image representation.
     int psiNumBytes;  // -1 (No encoding), 1 or 2
     int phiNumBytes;  // -1 (No encoding), 1 or 2
@@ -132,6 +178,27 @@ struct stampParameters {
     float m20_limit;
 };
 
+// One step of a masking plan (see ImageStack::applyMaskSteps). Each operation only
+// uses its own parameters.
+struct maskStep {
+    MaskOperation operation = MASK_FLAGS;
+
+    // MASK_FLAGS and MASK_GLOBAL_FLAGS: mask the pixels with any of these flags.
+    int flags = 0;
+
+    // MASK_FLAGS: the flag values that are not masked.
+    std::vector<int> exceptions;
+
+    // MASK_GLOBAL_FLAGS: mask the pixels flagged in at least this many images.
+    int numImages = 1;
+
+    // MASK_THRESHOLD: mask the pixels whose science value is above this.
+    float threshold = 0.0;
+
+    // MASK_GROW: the number of pixels to grow the mask by.
+    int steps = 0;
+};
+
 // Basic image moments use for analysis.
 struct imageMoments {
     float m00;
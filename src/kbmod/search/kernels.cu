@@ -8,7 +8,6 @@
 #ifndef KERNELS_CU_
 #define KERNELS_CU_
 #define GPU_LC_FILTER 1
-#define MAX_NUM_IMAGES 140
 
 #include "common.h"
 #include <cmath>
@@ -16,6 +15,8 @@
 #include <stdexcept>
 #include <stdio.h>
 #include <float.h>
+#include <algorithm>
+#include <vector>
 
 namespace search {
 
@@ -70,7 +71,7 @@ extern "C" __device__ __host__ void sigmaGFilteredIndicesCU(float *values, int n
     *maxKeepIndex = end - 1;
 }
 
-__device__ float readEncodedPixel(void *imageVect, int index, int numBytes, const scaleParameters &params) {
+__device__ float readEncodedPixel(void *imageVect, long index, int numBytes, const scaleParameters &params) {
     float value = (numBytes == 1) ? (float)reinterpret_cast<uint8_t *>(imageVect)[index]
                                   : (float)reinterpret_cast<uint16_t *>(imageVect)[index];
     float result = (value == 0.0) ? NO_DATA : (value - 1.0) * params.scale + params.minVal;
@@ -80,12 +81,15 @@ __device__ float readEncodedPixel(void *imageVect, int index, int numBytes, cons
 /*
  * Searches through images (represented as a flat array of floats) looking for most likely
  * trajectories in the given list. Outputs a results image of best trajectories. Returns a
- * fixed number of results per pixel specified by RESULTS_PER_PIXEL
+ * fixed number of results per pixel specified by params.resultsPerPixel
  * filters results using a sigmaG-based filter and a central-moment filter.
+ *
+ * The sigmaG filter uses local arrays of MAX_NUM_IMAGES values. For larger stacks
+ * scratch must point to 4 * imageCount values per starting pixel of global memory.
  */
 __global__ void searchFilterImages(int imageCount, int width, int height, void *psiVect, void *phiVect,
                                    perImageData image_data, searchParameters params, int trajectoryCount,
-                                   trajectory *trajectories, trajectory *results) {
+                                   trajectory *trajectories, trajectory *results, float *scratch) {
     // Get the x and y coordinates within the search space.
     const int x_i = blockIdx.x * THREAD_DIM_X + threadIdx.x;
     const int y_i = blockIdx.y * THREAD_DIM_Y + threadIdx.y;
@@ -100,19 +104,32 @@ __global__ void searchFilterImages(int imageCount, int width, int height, void *
     // Get origin pixel for the trajectories in pixel space.
     const int x = x_i + params.x_start_min;
     const int y = y_i + params.y_start_min;
-    const unsigned int pixelsPerImage = width * height;
+    // Index the images with longs: large stacks have more than 2^32 pixels.
+    const long pixelsPerImage = (long)width * height;
 
     // Data structures used for filtering.
-    float lcArray[MAX_NUM_IMAGES];
-    float psiArray[MAX_NUM_IMAGES];
-    float phiArray[MAX_NUM_IMAGES];
-    int idxArray[MAX_NUM_IMAGES];
+    float localLcArray[MAX_NUM_IMAGES];
+    float localPsiArray[MAX_NUM_IMAGES];
+    float localPhiArray[MAX_NUM_IMAGES];
+    int localIdxArray[MAX_NUM_IMAGES];
+    float *lcArray = localLcArray;
+    float *psiArray = localPsiArray;
+    float *phiArray = localPhiArray;
+    int *idxArray = localIdxArray;
+    if (scratch != nullptr) {
+        const long thread_offset = 4L * imageCount * ((long)y_i * search_width + x_i);
+        lcArray = scratch + thread_offset;
+        psiArray = lcArray + imageCount;
+        phiArray = psiArray + imageCount;
+        idxArray = reinterpret_cast<int *>(phiArray + imageCount);
+    }
+    const bool fill_arrays = params.do_sigmag_filter;
 
     // Create an initial set of best results with likelihood -1.0.
     // We also set (x, y) because they are used in the later python
     // functions.
-    trajectory best[RESULTS_PER_PIXEL];
-    for (int r = 0; r < RESULTS_PER_PIXEL; ++r) {
+    trajectory best[MAX_RESULTS_PER_PIXEL];
+    for (int r = 0; r < params.resultsPerPixel; ++r) {
         best[r].x = x;
         best[r].y = y;
         best[r].lh = -1.0;
@@ -131,8 +148,8 @@ __global__ void searchFilterImages(int imageCount, int width, int height, void *
         float psiSum = 0.0;
         float phiSum = 0.0;
 
-        // Loop over each image and sample the appropriate pixel
-        for (int i = 0; i < imageCount; ++i) {
+        // Reset the arrays used for filtering.
+        for (int i = 0; fill_arrays && i < imageCount; ++i) {
             lcArray[i] = 0;
             psiArray[i] = 0;
             phiArray[i] = 0;
@@ -163,7 +180,7 @@ __global__ void searchFilterImages(int imageCount, int width, int height, void *
             }
 
             // Get the Psi and Phi pixel values.
-            unsigned int pixel_index = (pixelsPerImage * i + currentY * width + currentX);
+            const long pixel_index = pixelsPerImage * i + (long)currentY * width + currentX;
             float cPsi = (params.psiNumBytes <= 0 || image_data.psiParams == nullptr)
                                  ? reinterpret_cast<float *>(psiVect)[pixel_index]
                                  : readEncodedPixel(psiVect, pixel_index, params.psiNumBytes,
@@ -180,9 +197,11 @@ __global__ void searchFilterImages(int imageCount, int width, int height, void *
                 currentT.obsCount++;
                 psiSum += cPsi;
                 phiSum += cPhi;
-                psiArray[num_seen] = cPsi;
-                phiArray[num_seen] = cPhi;
-                if (cPhi != 0.0) lcArray[num_seen] = cPsi / cPhi;
+                if (fill_arrays) {
+                    psiArray[num_seen] = cPsi;
+                    phiArray[num_seen] = cPhi;
+                    if (cPhi != 0.0) lcArray[num_seen] = cPsi / cPhi;
+                }
                 num_seen += 1;
             }
         }
@@ -219,7 +238,7 @@ __global__ void searchFilterImages(int imageCount, int width, int height, void *
         // Insert the new trajectory into the sorted list of results.
         // Only sort the values with valid likelihoods.
         trajectory temp;
-        for (int r = 0; r < RESULTS_PER_PIXEL; ++r) {
+        for (int r = 0; r < params.resultsPerPixel; ++r) {
             if (currentT.lh > best[r].lh && currentT.lh > -1.0) {
                 temp = best[r];
                 best[r] = currentT;
@@ -232,14 +251,14 @@ __global__ void searchFilterImages(int imageCount, int width, int height, void *
     // the correct location within the global results vector.
     // Note the results index is based on the pixel values in search
     // space (not image space).
-    const int base_index = (y_i * search_width + x_i) * RESULTS_PER_PIXEL;
-    for (int r = 0; r < RESULTS_PER_PIXEL; ++r) {
+    const long base_index = ((long)y_i * search_width + x_i) * params.resultsPerPixel;
+    for (int r = 0; r < params.resultsPerPixel; ++r) {
         results[base_index + r] = best[r];
     }
 }
 
 template <typename T>
-void *encodeImage(float *imageVect, int numTimes, int numPixels, scaleParameters *params, bool debug) {
+void *encodeImage(float *imageVect, int numTimes, long numPixels, scaleParameters *params, bool debug) {
     void *deviceVect = NULL;
 
     long unsigned int total_size = sizeof(T) * numTimes * numPixels;
@@ -251,8 +270,8 @@ void *encodeImage(float *imageVect, int numTimes, int numPixels, scaleParameters
     T *encoded = (T *)malloc(total_size);
     for (int t = 0; t < numTimes; ++t) {
         float safe_max = params[t].maxVal - params[t].scale / 100.0;
-        for (int p = 0; p < numPixels; ++p) {
-            int index = t * numPixels + p;
+        for (long p = 0; p < numPixels; ++p) {
+            const long index = t * numPixels + p;
             float value = imageVect[index];
             if (value == NO_DATA) {
                 encoded[index] = 0;
@@ -275,7 +294,7 @@ void *encodeImage(float *imageVect, int numTimes, int numPixels, scaleParameters
     return deviceVect;
 }
 
-void *encodeImageFloat(float *imageVect, unsigned int vectLength, bool debug) {
+void *encodeImageFloat(float *imageVect, long vectLength, bool debug) {
     void *deviceVect = NULL;
     long unsigned int total_size = sizeof(float) * vectLength;
 
@@ -288,76 +307,73 @@ void *encodeImageFloat(float *imageVect, unsigned int vectLength, bool debug) {
     return deviceVect;
 }
 
-extern "C" void deviceSearchFilter(int imageCount, int width, int height, float *psiVect, float *phiVect,
-                                   perImageData img_data, searchParameters params, int trajCount,
-                                   trajectory *trajectoriesToSearch, int resultsCount,
-                                   trajectory *bestTrajects) {
-    // Allocate Device memory
-    trajectory *deviceTests;
+/*
+ * The images and per-image data of a GPU search, uploaded once (by deviceSearchUpload)
+ * and searched any number of times (by deviceSearchBlocks).
+ */
+struct deviceSearchImages {
+    int imageCount;
+    int width;
+    int height;
+    int psiNumBytes;
+    int phiNumBytes;
+    void *psi;
+    void *phi;
+    perImageData imageData;
+};
+
+extern "C" void *deviceSearchUpload(int imageCount, int width, int height, float *psiVect, float *phiVect,
+                                    perImageData img_data, searchParameters params) {
+    deviceSearchImages *images = new deviceSearchImages();
+    images->imageCount = imageCount;
+    images->width = width;
+    images->height = height;
+    images->psiNumBytes = -1;
+    images->phiNumBytes = -1;
+
     float *deviceImgTimes;
-    void *devicePsi;
-    void *devicePhi;
-    trajectory *deviceSearchResults;
     baryCorrection *deviceBaryCorrs = nullptr;
     scaleParameters *devicePsiParams = nullptr;
     scaleParameters *devicePhiParams = nullptr;
 
-    // Check the hard coded maximum number of images against the imageCount.
-    if (imageCount > MAX_NUM_IMAGES) {
-        throw std::runtime_error("Number of images exceeds GPU maximum.");
-    }
-
-    if (params.debug) {
-        printf("Allocating %lu bytes for testing grid.\n", sizeof(trajectory) * trajCount);
-    }
-    checkCudaErrors(cudaMalloc((void **)&deviceTests, sizeof(trajectory) * trajCount));
-
     if (params.debug) {
         printf("Allocating %lu bytes for time data.\n", sizeof(float) * imageCount);
     }
     checkCudaErrors(cudaMalloc((void **)&deviceImgTimes, sizeof(float) * imageCount));
-
-    if (params.debug) {
-        printf("Allocating %lu bytes for testing grid.\n", sizeof(trajectory) * trajCount);
-    }
-    checkCudaErrors(cudaMalloc((void **)&deviceSearchResults, sizeof(trajectory) * resultsCount));
-
-    // Copy trajectories to search
-    checkCudaErrors(cudaMemcpy(deviceTests, trajectoriesToSearch, sizeof(trajectory) * trajCount,
-                               cudaMemcpyHostToDevice));
-
-    // Copy image times
     checkCudaErrors(cudaMemcpy(deviceImgTimes, img_data.imageTimes, sizeof(float) * imageCount,
                                cudaMemcpyHostToDevice));
 
     // Copy (and encode) the images. Also copy over the scaling parameters if needed.
+    const long num_pixels = (long)width * height;
     if ((params.psiNumBytes == 1 || params.psiNumBytes == 2) && (img_data.psiParams != nullptr)) {
+        images->psiNumBytes = params.psiNumBytes;
         checkCudaErrors(cudaMalloc((void **)&devicePsiParams, imageCount * sizeof(scaleParameters)));
         checkCudaErrors(cudaMemcpy(devicePsiParams, img_data.psiParams, imageCount * sizeof(scaleParameters),
                                    cudaMemcpyHostToDevice));
         if (params.psiNumBytes == 1) {
-            devicePsi = encodeImage<uint8_t>(psiVect, imageCount, width * height, img_data.psiParams,
-                                             params.debug);
+            images->psi = encodeImage<uint8_t>(psiVect, imageCount, num_pixels, img_data.psiParams,
+                                               params.debug);
         } else {
-            devicePsi = encodeImage<uint16_t>(psiVect, imageCount, width * height, img_data.psiParams,
-                                              params.debug);
+            images->psi = encodeImage<uint16_t>(psiVect, imageCount, num_pixels, img_data.psiParams,
+                                                params.debug);
         }
     } else {
-        devicePsi = encodeImageFloat(psiVect, imageCount * width * height, params.debug);
+        images->psi = encodeImageFloat(psiVect, imageCount * num_pixels, params.debug);
     }
     if ((params.phiNumBytes == 1 || params.phiNumBytes == 2) && (img_data.phiParams != nullptr)) {
+        images->phiNumBytes = params.phiNumBytes;
         checkCudaErrors(cudaMalloc((void **)&devicePhiParams, imageCount * sizeof(scaleParameters)));
         checkCudaErrors(cudaMemcpy(devicePhiParams, img_data.phiParams, imageCount * sizeof(scaleParameters),
                                    cudaMemcpyHostToDevice));
         if (params.phiNumBytes == 1) {
-            devicePhi = encodeImage<uint8_t>(phiVect, imageCount, width * height, img_data.phiParams,
-                                             params.debug);
+            images->phi = encodeImage<uint8_t>(phiVect, imageCount, num_pixels, img_data.phiParams,
+                                               params.debug);
         } else {
-            devicePhi = encodeImage<uint16_t>(phiVect, imageCount, width * height, img_data.phiParams,
-                                              params.debug);
+            images->phi = encodeImage<uint16_t>(phiVect, imageCount, num_pixels, img_data.phiParams,
+                                                params.debug);
         }
     } else {
-        devicePhi = encodeImageFloat(phiVect, imageCount * width * height, params.debug);
+        images->phi = encodeImageFloat(phiVect, imageCount * num_pixels, params.debug);
     }
 
     // allocate memory for and copy barycentric corrections
@@ -372,43 +388,118 @@ extern "C" void deviceSearchFilter(int imageCount, int width, int height, float
     }
 
     // Wrap the per-image data into a struct. This struct will be copied by value
-    // during the function call, so we don't need to allocate memory for the
+    // during the kernel call, so we don't need to allocate memory for the
     // struct itself. We just set the pointers to the on device vectors.
-    perImageData device_image_data;
-    device_image_data.numImages = imageCount;
-    device_image_data.imageTimes = deviceImgTimes;
-    device_image_data.baryCorrs = deviceBaryCorrs;
-    device_image_data.psiParams = devicePsiParams;
-    device_image_data.phiParams = devicePhiParams;
-
-    // Compute the range of starting pixels to use when setting the blocks and threads.
-    // We use the width and height of the search space (as opposed to the image width
-    // and height), meaning the blocks/threads will be indexed relative to the search space.
-    int search_width = params.x_start_max - params.x_start_min;
-    int search_height = params.y_start_max - params.y_start_min;
-    dim3 blocks(search_width / THREAD_DIM_X + 1, search_height / THREAD_DIM_Y + 1);
-    dim3 threads(THREAD_DIM_X, THREAD_DIM_Y);
+    images->imageData.numImages = imageCount;
+    images->imageData.imageTimes = deviceImgTimes;
+    images->imageData.baryCorrs = deviceBaryCorrs;
+    images->imageData.psiParams = devicePsiParams;
+    images->imageData.phiParams = devicePhiParams;
+    return images;
+}
 
-    // Launch Search
-    searchFilterImages<<<blocks, threads>>>(imageCount, width, height, devicePsi, devicePhi,
-                                            device_image_data, params, trajCount, deviceTests,
-                                            deviceSearchResults);
+extern "C" void deviceSearchBlocks(void *uploaded, int numBlocks, const searchParameters *blockParams,
+                                   const int *trajOffsets, trajectory *trajectories,
+                                   const long *resultOffsets, trajectory *bestTrajects) {
+    deviceSearchImages *images = static_cast<deviceSearchImages *>(uploaded);
+    if (numBlocks <= 0) return;
+    const int trajCount = trajOffsets[numBlocks];
+    const long resultsCount = resultOffsets[numBlocks];
+    const bool debug = blockParams[0].debug;
+
+    // Copy the trajectories of all of the blocks at once.
+    trajectory *deviceTests = nullptr;
+    trajectory *deviceSearchResults = nullptr;
+    if (debug) {
+        printf("Allocating %lu bytes for testing grid.\n", sizeof(trajectory) * trajCount);
+    }
+    checkCudaErrors(cudaMalloc((void **)&deviceTests, sizeof(trajectory) * std::max(trajCount, 1)));
+    checkCudaErrors(cudaMemcpy(deviceTests, trajectories, sizeof(trajectory) * trajCount,
+                               cudaMemcpyHostToDevice));
+    if (debug) {
+        printf("Allocating %lu bytes for the results.\n", sizeof(trajectory) * resultsCount);
+    }
+    checkCudaErrors(
+            cudaMalloc((void **)&deviceSearchResults, sizeof(trajectory) * std::max(resultsCount, 1L)));
+
+    // Stacks larger than MAX_NUM_IMAGES need global memory scratch space for the sigmaG
+    // filter. To bound its size we search strips of rows, reusing the scratch space
+    // for every strip of every block (the launches run one after the other).
+    std::vector<int> strip_heights(numBlocks);
+    long scratch_bytes = 0;
+    for (int b = 0; b < numBlocks; ++b) {
+        const searchParameters &params = blockParams[b];
+        const int search_width = params.x_start_max - params.x_start_min;
+        const int search_height = params.y_start_max - params.y_start_min;
+        strip_heights[b] = gpuSearchStripHeight(images->imageCount, search_width, search_height,
+                                                params.do_sigmag_filter);
+        scratch_bytes = std::max(scratch_bytes, gpuScratchBytes(images->imageCount, search_width,
+                                                                strip_heights[b], params.do_sigmag_filter));
+    }
+    float *deviceScratch = nullptr;
+    if (scratch_bytes > 0) {
+        if (debug) printf("Allocating %li bytes of filtering scratch space.\n", scratch_bytes);
+        checkCudaErrors(cudaMalloc((void **)&deviceScratch, scratch_bytes));
+    }
+
+    // Launch the searches. The blocks and threads are indexed relative to each
+    // strip's search space (as opposed to the image width and height).
+    dim3 threads(THREAD_DIM_X, THREAD_DIM_Y);
+    for (int b = 0; b < numBlocks; ++b) {
+        searchParameters params = blockParams[b];
+        params.psiNumBytes = images->psiNumBytes;
+        params.phiNumBytes = images->phiNumBytes;
+        const int search_width = params.x_start_max - params.x_start_min;
+        const int search_height = params.y_start_max - params.y_start_min;
+        if (search_width <= 0 || search_height <= 0) continue;
+
+        for (int y_i = 0; y_i < search_height; y_i += strip_heights[b]) {
+            searchParameters strip_params = params;
+            strip_params.y_start_min = params.y_start_min + y_i;
+            strip_params.y_start_max =
+                    std::min(params.y_start_min + y_i + strip_heights[b], params.y_start_max);
+            const int strip_rows = strip_params.y_start_max - strip_params.y_start_min;
+            const long results_offset = resultOffsets[b] + (long)y_i * search_width * params.resultsPerPixel;
+
+            dim3 blocks(search_width / THREAD_DIM_X + 1, strip_rows / THREAD_DIM_Y + 1);
+            searchFilterImages<<<blocks, threads>>>(
+                    images->imageCount, images->width, images->height, images->psi, images->phi,
+                    images->imageData, strip_params, trajOffsets[b + 1] - trajOffsets[b],
+                    deviceTests + trajOffsets[b], deviceSearchResults + results_offset, deviceScratch);
+        }
+    }
 
     // Read back results
     checkCudaErrors(cudaMemcpy(bestTrajects, deviceSearchResults, sizeof(trajectory) * resultsCount,
                                cudaMemcpyDeviceToHost));
 
-    // Free the on GPU memory.
-    if (deviceBaryCorrs != nullptr) checkCudaErrors(cudaFree(deviceBaryCorrs));
-    if (devicePhiParams != nullptr) checkCudaErrors(cudaFree(devicePhiParams));
-    if (devicePsiParams != nullptr) checkCudaErrors(cudaFree(devicePsiParams));
-    checkCudaErrors(cudaFree(devicePhi));
-    checkCudaErrors(cudaFree(devicePsi));
+    if (deviceScratch != nullptr) checkCudaErrors(cudaFree(deviceScratch));
     checkCudaErrors(cudaFree(deviceSearchResults));
-    checkCudaErrors(cudaFree(deviceImgTimes));
     checkCudaErrors(cudaFree(deviceTests));
 }
 
+extern "C" void deviceSearchRelease(void *uploaded) {
+    deviceSearchImages *images = static_cast<deviceSearchImages *>(uploaded);
+    if (images->imageData.baryCorrs != nullptr) checkCudaErrors(cudaFree(images->imageData.baryCorrs));
+    if (images->imageData.phiParams != nullptr) checkCudaErrors(cudaFree(images->imageData.phiParams));
+    if (images->imageData.psiParams != nullptr) checkCudaErrors(cudaFree(images->imageData.psiParams));
+    checkCudaErrors(cudaFree(images->imageData.imageTimes));
+    checkCudaErrors(cudaFree(images->phi));
+    checkCudaErrors(cudaFree(images->psi));
+    delete images;
+}
+
+extern "C" void deviceSearchFilter(int imageCount, int width, int height, float *psiVect, float *phiVect,
+                                   perImageData img_data, searchParameters params, int trajCount,
+                                   trajectory *trajectoriesToSearch, int resultsCount,
+                                   trajectory *bestTrajects) {
+    void *images = deviceSearchUpload(imageCount, width, height, psiVect, phiVect, img_data, params);
+    const int trajOffsets[2] = {0, trajCount};
+    const long resultOffsets[2] = {0, resultsCount};
+    deviceSearchBlocks(images, 1, &params, trajOffsets, trajectoriesToSearch, resultOffsets, bestTrajects);
+    deviceSearchRelease(images);
+}
+
 } /* namespace search */
 
 #endif /* KERNELS_CU_ */
@@ -0,0 +1,168 @@
+"""
+This is a manually run report that measures the recall of the coarse-to-fine
+search on injected fake objects and compares its run time to the full search.
+
+Usage: python tests/coarse_search_recall.py --bin_factor=2 --lh_fraction=0.5
+"""
+
+import argparse
+import math
+import random
+import time
+
+from kbmod.fake_data_creator import FakeDataSet
+from kbmod.search import *
+
+
+def make_random_trajectory(width, height, min_vel, max_vel, min_ang, max_ang, flux):
+    """Create a random trajectory with a velocity inside the search grid.
+
+    Parameters
+    ----------
+    width : int
+        The width of the images in pixels.
+    height : int
+        The height of the images in pixels.
+    min_vel : float
+        The minimum velocity (in pixels per day).
+    max_vel : float
+        The maximum velocity (in pixels per day).
+    min_ang : float
+        The minimum angle (in radians).
+    max_ang : float
+        The maximum angle (in radians).
+    flux : float
+        The flux of the object.
+
+    Returns
+    -------
+    trj : trajectory
+        The random trajectory.
+    """
+    vel = random.uniform(min_vel, max_vel)
+    ang = random.uniform(min_ang, max_ang)
+
+    trj = trajectory()
+    trj.x = random.randint(0, width - 1)
+    trj.y = random.randint(0, height - 1)
+    trj.x_v = vel * math.cos(ang)
+    trj.y_v = vel * math.sin(ang)
+    trj.flux = flux
+    return trj
+
+
+def count_found(fakes, results, threshold, times):
+    """Count the number of fakes that match one of the results.
+
+    Parameters
+    ----------
+    fakes : list
+        The list of inserted trajectories.
+    results : list
+        The list of result trajectories.
+    threshold : float
+        The maximum average distance (in pixels) between the fake and
+        result at the given times to count as a match.
+    times : list
+        The zero-shifted times at which to compare the trajectories.
+
+    Returns
+    -------
+    num_found : int
+        The number of fakes found.
+    """
+    num_found = 0
+    for fake in fakes:
+        for res in results:
+            total = 0.0
+            for t in times:
+                dx = (fake.x + t * fake.x_v) - (res.x + t * res.x_v)
+                dy = (fake.y + t * fake.y_v) - (res.y + t * res.y_v)
+                total += math.sqrt(dx * dx + dy * dy)
+            if total / len(times) <= threshold:
+                num_found += 1
+                break
+    return num_found
+
+
+def search_fakes(stack, args, bin_factor):
+    """Run the search and return the results above the likelihood threshold.
+
+    Parameters
+    ----------
+    stack : image_stack
+        The images to search.
+    args : argparse.Namespace
+        The command line arguments.
+    bin_factor : int
+        The bin factor for the coarse search (1 to search at full resolution).
+
+    Returns
+    -------
+    results : list
+        The results with likelihood at least ``args.lh_level``.
+    elapsed : float
+        The search time in seconds.
+    """
+    search = stack_search(stack)
+    if bin_factor > 1:
+        search.enable_coarse_search(bin_factor, args.lh_fraction * args.lh_level)
+
+    start = time.time()
+    search.search(
+        args.ang_steps, args.vel_steps, args.min_ang, args.max_ang, args.min_vel, args.max_vel, args.num_obs
+    )
+    elapsed = time.time() - start
+
+    results = []
+    for res in search.get_results(0, 100000):
+        if res.lh < args.lh_level:
+            break
+        results.append(res)
+    return results, elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--width", type=int, default=256, help="The image width.")
+    parser.add_argument("--height", type=int, default=256, help="The image height.")
+    parser.add_argument("--num_times", type=int, default=15, help="The number of time steps.")
+    parser.add_argument("--num_fakes", type=int, default=20, help="The number of fake objects.")
+    parser.add_argument("--flux", type=float, default=250.0, help="The flux of the fake objects.")
+    parser.add_argument("--min_vel", type=float, default=5.0, help="The minimum velocity.")
+    parser.add_argument("--max_vel", type=float, default=20.0, help="The maximum velocity.")
+    parser.add_argument("--vel_steps", type=int, default=32, help="The number of velocity steps.")
+    parser.add_argument("--min_ang", type=float, default=0.0, help="The minimum angle.")
+    parser.add_argument("--max_ang", type=float, default=1.5, help="The maximum angle.")
+    parser.add_argument("--ang_steps", type=int, default=32, help="The number of angle steps.")
+    parser.add_argument("--num_obs", type=int, default=10, help="The minimum number of observations.")
+    parser.add_argument("--lh_level", type=float, default=10.0, help="The likelihood threshold.")
+    parser.add_argument("--bin_factor", type=int, default=2, help="The bin factor of the coarse search.")
+    parser.add_argument("--lh_fraction", type=float, default=0.5, help="The coarse threshold fraction.")
+    parser.add_argument("--threshold", type=float, default=2.0, help="The match distance in pixels.")
+    args = parser.parse_args()
+
+    random.seed(101)
+    ds = FakeDataSet(args.width, args.height, args.num_times, noise_level=4.0, psf_val=1.0, use_seed=True)
+    for i in range(args.num_fakes):
+        ds.insert_object(
+            make_random_trajectory(
+                args.width, args.height, args.min_vel, args.max_vel, args.min_ang, args.max_ang, args.flux
+            )
+        )
+    times = [0.0, ds.times[-1] - ds.times[0]]
+
+    full_results, full_time = search_fakes(ds.stack, args, 1)
+    coarse_results, coarse_time = search_fakes(ds.stack, args, args.bin_factor)
+    full_found = count_found(ds.trajectories, full_results, args.threshold, times)
+    coarse_found = count_found(ds.trajectories, coarse_results, args.threshold, times)
+
+    print(f"Fakes inserted: {args.num_fakes}")
+    print(f"Full search:   {full_found} found ({full_found / args.num_fakes:.2%}) in {full_time:.2f}s")
+    print(
+        f"Coarse search: {coarse_found} found ({coarse_found / args.num_fakes:.2%}) in {coarse_time:.2f}s "
+        f"(bin factor {args.bin_factor}, lh fraction {args.lh_fraction})"
+    )
+    if full_found > 0:
+        print(f"Coarse recall relative to the full search: {coarse_found / full_found:.2%}")
+    print(f"Speed up: {full_time / coarse_time:.1f}x")
@@ -0,0 +1,131 @@
+"""
+This is a manually run report that compares the likelihoods and run times of
+searches with 1 and 2 byte encoded psi and phi images to the float search on
+the same (fake) data.
+
+For each encoding, the report lists the search time, how many of the float
+search's top results it also returns, and the likelihood errors of those
+shared results.
+
+Usage: python tests/encoding_accuracy.py --encodings 1,1 2,2 1,2 2,1
+"""
+
+import argparse
+import math
+import random
+import time
+
+import numpy as np
+
+from kbmod.fake_data_creator import FakeDataSet
+from kbmod.search import *
+
+
+def run_encoded_search(stack, args, psi_bytes, phi_bytes):
+    """Run the search with the given encoding.
+
+    Parameters
+    ----------
+    stack : image_stack
+        The images to search.
+    args : argparse.Namespace
+        The command line arguments.
+    psi_bytes : int
+        The number of bytes used for psi (-1 for floats).
+    phi_bytes : int
+        The number of bytes used for phi (-1 for floats).
+
+    Returns
+    -------
+    results : numpy.ndarray
+        The top ``args.num_results`` results (see ``stack_search.get_results_array``).
+    elapsed : float
+        The search time in seconds.
+    """
+    search = stack_search(stack)
+    search.enable_gpu_encoding(psi_bytes, phi_bytes)
+    search.prepare_psi_phi()
+
+    start = time.time()
+    search.search(
+        args.ang_steps, args.vel_steps, args.min_ang, args.max_ang, args.min_vel, args.max_vel, args.num_obs
+    )
+    elapsed = time.time() - start
+    return search.get_results_array()[: args.num_results].copy(), elapsed
+
+
+def compare_results(expected, results):
+    """Compare a search's results to the float search's results.
+
+    Parameters
+    ----------
+    expected : numpy.ndarray
+        The float search's results.
+    results : numpy.ndarray
+        The encoded search's results.
+
+    Returns
+    -------
+    overlap : float
+        The fraction of the expected trajectories (starting pixel and velocity)
+        that are also in results.
+    max_error : float
+        The largest absolute likelihood difference of the shared trajectories.
+    mean_error : float
+        The mean absolute likelihood difference of the shared trajectories.
+    max_rel_error : float
+        The largest likelihood difference of the shared trajectories relative
+        to the float likelihood.
+    """
+    lh = {(r["x"], r["y"], r["x_v"], r["y_v"]): r["lh"] for r in results}
+    errors = []
+    rel_errors = []
+    for r in expected:
+        key = (r["x"], r["y"], r["x_v"], r["y_v"])
+        if key in lh:
+            errors.append(abs(lh[key] - r["lh"]))
+            rel_errors.append(errors[-1] / max(abs(r["lh"]), 1e-6))
+    if len(errors) == 0:
+        return 0.0, math.nan, math.nan, math.nan
+    return len(errors) / len(expected), max(errors), np.mean(errors), max(rel_errors)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--width", type=int, default=256, help="The image width.")
+    parser.add_argument("--height", type=int, default=256, help="The image height.")
+    parser.add_argument("--num_times", type=int, default=15, help="The number of time steps.")
+    parser.add_argument("--num_fakes", type=int, default=20, help="The number of fake objects.")
+    parser.add_argument("--flux", type=float, default=250.0, help="The flux of the fake objects.")
+    parser.add_argument("--min_vel", type=float, default=5.0, help="The minimum velocity.")
+    parser.add_argument("--max_vel", type=float, default=20.0, help="The maximum velocity.")
+    parser.add_argument("--vel_steps", type=int, default=32, help="The number of velocity steps.")
+    parser.add_argument("--min_ang", type=float, default=0.0, help="The minimum angle.")
+    parser.add_argument("--max_ang", type=float, default=1.5, help="The maximum angle.")
+    parser.add_argument("--ang_steps", type=int, default=32, help="The number of angle steps.")
+    parser.add_argument("--num_obs", type=int, default=10, help="The minimum number of observations.")
+    parser.add_argument("--num_results", type=int, default=1000, help="The number of top results compared.")
+    parser.add_argument(
+        "--encodings",
+        nargs="+",
+        default=["1,1", "2,2", "1,2", "2,1"],
+        help="The encodings to compare as psi_bytes,phi_bytes.",
+    )
+    args = parser.parse_args()
+
+    random.seed(101)
+    ds = FakeDataSet(args.width, args.height, args.num_times, noise_level=4.0, psf_val=1.0, use_seed=True)
+    for i in range(args.num_fakes):
+        ds.insert_random_object(args.flux)
+
+    expected, float_time = run_encoded_search(ds.stack, args, -1, -1)
+    print(f"float32: {float_time:.2f}s")
+    for encoding in args.encodings:
+        psi_bytes, phi_bytes = [int(v) for v in encoding.split(",")]
+        results, elapsed = run_encoded_search(ds.stack, args, psi_bytes, phi_bytes)
+        overlap, max_error, mean_error, max_rel_error = compare_results(expected, results)
+        print(
+            f"psi {psi_bytes} bytes, phi {phi_bytes} bytes: {elapsed:.2f}s ({float_time / elapsed:.2f}x), "
+            f"top {len(expected)} overlap {overlap:.2%}, LH error max {max_error:.4f} "
+            f"mean {mean_error:.4f} (max relative {max_rel_error:.2%})"
+        )
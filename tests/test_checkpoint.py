@@ -0,0 +1,152 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from kbmod.checkpoint import checkpointed_search
+from kbmod.psi_phi_cache import load_psi_phi, save_psi_phi
+from kbmod.parallel_search import configure_search, grid_ranges
+from kbmod.run_search import run_search
+from kbmod.search import *
+
+
+class test_checkpoint(unittest.TestCase):
+    def setUp(self):
+        self.imCount = 10
+        self.p = psf(1.0)
+
+        self.imlist = []
+        for i in range(self.imCount):
+            time = i / self.imCount
+            im = layered_image(str(i), 40, 30, 2.0, 4.0, time, self.p, i)
+            im.add_object(7 + time * 21.0 + 0.5, 9 + time * 16.0 + 0.5, 150.0)
+            self.imlist.append(im)
+        self.stack = image_stack(self.imlist)
+
+        self.search_args = [20, 20, 0.0, 1.5, 5.0, 40.0, int(self.imCount / 2)]
+        self.settings = {"results_per_pixel": 4, "result_filter": [1.0, 200]}
+
+    def test_psi_phi_files(self):
+        search = stack_search(self.stack)
+        with tempfile.TemporaryDirectory() as dir_name:
+            filename = os.path.join(dir_name, "psi_phi.npy")
+            save_psi_phi(search, filename)
+            self.assertEqual(np.load(filename, mmap_mode="r").shape, (2, self.imCount, 30, 40))
+
+            search2 = stack_search(self.stack)
+            load_psi_phi(search2, filename)
+            for i in range(self.imCount):
+                self.assertTrue(search2.get_psi_images()[i].approx_equal(search.get_psi_images()[i], 0.0))
+                self.assertTrue(search2.get_phi_images()[i].approx_equal(search.get_phi_images()[i], 0.0))
+
+    def test_resume(self):
+        ranges = grid_ranges(self.search_args[0], self.search_args[1], 2)
+        with tempfile.TemporaryDirectory() as dir_name:
+            # An uninterrupted run.
+            search = stack_search(self.stack)
+            full_dir = os.path.join(dir_name, "full")
+            self.assertTrue(checkpointed_search(search, self.search_args, self.settings, full_dir, 4, ranges))
+            expected = search.get_results_array().copy()
+            self.assertEqual(len(expected), 200)
+
+            # An interrupted run searches at most max_blocks blocks per call.
+            resume_dir = os.path.join(dir_name, "resume")
+            for i in range(3):
+                search = stack_search(self.stack)
+                done = checkpointed_search(
+                    search, self.search_args, self.settings, resume_dir, 4, ranges, max_blocks=3
+                )
+                self.assertEqual(done, i == 2)
+            self.assertEqual(len([f for f in os.listdir(resume_dir) if f.startswith("block_")]), 8)
+            self.assertEqual(search.get_results_array().tolist(), expected.tolist())
+
+            # Running it again only merges the saved blocks.
+            search = stack_search(self.stack)
+            self.assertTrue(
+                checkpointed_search(search, self.search_args, self.settings, resume_dir, 4, ranges)
+            )
+            self.assertEqual(search.get_results_array().tolist(), expected.tolist())
+
+            # The checkpoint can not be used with different settings.
+            settings = dict(self.settings, results_per_pixel=2)
+            self.assertRaises(
+                ValueError, checkpointed_search, search, self.search_args, settings, resume_dir, 4, ranges
+            )
+
+            # Or with different images of the same size and times.
+            stack = image_stack(self.imlist)
+            stack.apply_mask_threshold(5.0)
+            search = stack_search(stack)
+            self.assertRaises(
+                ValueError,
+                checkpointed_search,
+                search,
+                self.search_args,
+                self.settings,
+                resume_dir,
+                4,
+                ranges,
+            )
+            self.assertEqual(sorted(os.listdir(resume_dir))[-2:], ["manifest.json", "psi_phi.npy"])
+
+            # A key for the inputs is checked instead of the psi and phi images.
+            key_dir = os.path.join(dir_name, "key")
+            search = stack_search(self.stack)
+            self.assertTrue(
+                checkpointed_search(
+                    search, self.search_args, self.settings, key_dir, 4, ranges, input_key="a"
+                )
+            )
+            self.assertEqual(search.get_results_array().tolist(), expected.tolist())
+            self.assertRaises(
+                ValueError,
+                checkpointed_search,
+                search,
+                self.search_args,
+                self.settings,
+                key_dir,
+                4,
+                ranges,
+                input_key="b",
+            )
+
+        # The results match a single search.
+        search = stack_search(self.stack)
+        configure_search(search, self.settings)
+        search.search(*self.search_args)
+        single = search.get_results(0, 1000)
+        self.assertEqual(sorted(expected["lh"].tolist()), sorted([r.lh for r in single]))
+
+    def test_run_search_checkpoint(self):
+        input_parameters = {
+            "im_filepath": "../data/demo",
+            "v_arr": [0, 20, 21],
+            "ang_arr": [0.5, 0.5, 11],
+            "num_obs": 7,
+            "lh_level": 10.0,
+            "mask_num_images": 10,
+            "average_angle": 0.0,
+            "do_clustering": False,
+            "do_stamp_filter": False,
+        }
+        expected = run_search(input_parameters).run_search()
+        self.assertGreater(expected.num_results(), 0)
+
+        with tempfile.TemporaryDirectory() as dir_name:
+            input_parameters["checkpoint_dir"] = dir_name
+            input_parameters["checkpoint_blocks"] = 3
+            for i in range(2):
+                keep = run_search(input_parameters).run_search()
+                self.assertEqual(keep.num_results(), expected.num_results())
+                lh = sorted([row.final_likelihood for row in keep.results])
+                self.assertEqual(lh, sorted([row.final_likelihood for row in expected.results]))
+            self.assertTrue(os.path.exists(os.path.join(dir_name, "block_2.npy")))
+
+            # The checkpoint can not be used with different masking.
+            input_parameters["mask_threshold"] = 100.0
+            self.assertRaises(ValueError, run_search(input_parameters).run_search)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -92,6 +92,30 @@ class test_kernels_wrappers(unittest.TestCase):
             valid = i != 13 and i != 14 and i != 27
             self.assertEqual(i in inds, valid)
 
+    def test_sigmag_filtered_masks(self):
+        rng = np.random.default_rng(100)
+        values = rng.normal(size=(50, 31)).astype(np.float32)
+        values[0, :] = 1.0
+        values[1, 5] = 100.0
+        values[2, 7] = -100.0
+        values[3, :] = [0.0] * 30 + [0.3]
+
+        masks = sigmag_filtered_masks(values, 0.25, 0.75, 0.7413, 2.0)
+        self.assertEqual(masks.shape, values.shape)
+        self.assertEqual(masks.dtype, bool)
+        self.assertTrue(np.all(masks[0, :]))
+        self.assertFalse(masks[1, 5])
+        self.assertFalse(masks[2, 7])
+        self.assertEqual(np.count_nonzero(masks[3, :]), 30)
+
+        # Each row matches the single row filter.
+        for i in range(values.shape[0]):
+            inds = sigmag_filtered_indices(values[i, :].tolist(), 0.25, 0.75, 0.7413, 2.0)
+            self.assertEqual(sorted(inds), np.nonzero(masks[i, :])[0].tolist())
+
+        # The input must be two dimensional.
+        self.assertRaises(RuntimeError, sigmag_filtered_masks, values[0, :], 0.25, 0.75, 0.7413, 2.0)
+
     def test_calculate_likelihood_psiphi(self):
         # make sure that the calculate_likelihood_psi_phi works.
         psi_values = [1.0 for _ in range(20)]
@@ -45,6 +45,13 @@ class test_image_stack(unittest.TestCase):
         with self.assertRaises(IndexError):
             img = self.im_stack.get_single_image(self.num_images + 1)
 
+    def test_get_psf(self):
+        for i in range(self.num_images):
+            self.assertAlmostEqual(self.im_stack.get_psf(i).get_stdev(), self.p[i].get_stdev())
+
+        with self.assertRaises(IndexError):
+            self.im_stack.get_psf(self.num_images)
+
     def test_times(self):
         times = self.im_stack.get_times()
         self.assertEqual(len(times), self.num_images)
@@ -59,6 +66,19 @@ class test_image_stack(unittest.TestCase):
         for i in range(self.num_images):
             self.assertEqual(times2[i], 3.0 * i)
 
+    def test_append_images(self):
+        stack = image_stack(self.images[:3])
+        stack.set_times([0.0, 1.0, 2.5])
+        stack.append_images(self.images[3:])
+        self.assertEqual(stack.img_count(), self.num_images)
+        self.assertEqual(stack.get_times(), [0.0, 1.0, 2.5, 6.0, 8.0])
+        for i in range(self.num_images):
+            self.assertEqual(stack.get_single_image(i).get_name(), "layered_test_%i" % i)
+
+        # The images must be the same size.
+        small = layered_image("small", 10, 10, 2.0, 4.0, 10.0, self.p[0])
+        self.assertRaises(RuntimeError, stack.append_images, [small])
+
     def test_apply_mask(self):
         # Nothing is initially masked.
         for i in range(self.num_images):
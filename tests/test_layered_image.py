@@ -1,6 +1,7 @@
 import tempfile
 import unittest
 
+import numpy as np
 from astropy.io import fits
 
 from kbmod.search import *
@@ -191,6 +192,35 @@ class test_layered_image(unittest.TestCase):
                 else:
                     self.assertTrue(science.pixel_has_data(x, y))
 
+    def test_mask_array(self):
+        # The flags fit in 16 bits, so the view is uint16.
+        mask_array = self.image.get_mask_array()
+        self.assertEqual(mask_array.dtype, np.uint16)
+        self.assertEqual(mask_array.shape, (self.image.get_height(), self.image.get_width()))
+        self.assertEqual(mask_array.sum(), 0)
+
+        # Writes through the view change the mask.
+        mask_array[11, 10] = 1
+        mask_array[12, 10] = 3
+        self.assertEqual(self.image.get_mask().get_pixel(10, 12), 3.0)
+
+        # A flag that needs more than 16 bits widens the mask.
+        mask = self.image.get_mask()
+        mask.set_pixel(10, 13, 2**17 + 1)
+        self.image.set_mask(mask)
+        mask_array = self.image.get_mask_array()
+        self.assertEqual(mask_array.dtype, np.uint32)
+        self.assertEqual(mask_array[13, 10], 2**17 + 1)
+        self.assertEqual(mask_array[12, 10], 3)
+
+        # Mask flag 1 except for the exact value 3.
+        self.image.apply_mask_flags(1, [3])
+        science = self.image.get_science()
+        for y in range(self.image.get_height()):
+            for x in range(self.image.get_width()):
+                should_mask = x == 10 and (y == 11 or y == 13)
+                self.assertEqual(science.pixel_has_data(x, y), not should_mask)
+
     def test_grow_mask(self):
         mask = self.image.get_mask()
         mask.set_pixel(10, 11, 1)
@@ -229,6 +259,24 @@ class test_layered_image(unittest.TestCase):
                 dy = min(abs(y - 11), abs(y - 12))
                 self.assertEqual(science.pixel_has_data(x, y), dx + dy > 3)
 
+    def test_grow_mask_layers(self):
+        # Mask different pixels in the science and variance layers.
+        science = self.image.get_science()
+        science.set_pixel(10, 11, KB_NO_DATA)
+        self.image.set_science(science)
+        variance = self.image.get_variance()
+        variance.set_pixel(20, 5, KB_NO_DATA)
+        self.image.set_variance(variance)
+        self.image.grow_mask(2)
+
+        # Each layer's mask grows on its own.
+        science = self.image.get_science()
+        variance = self.image.get_variance()
+        for y in range(self.image.get_height()):
+            for x in range(self.image.get_width()):
+                self.assertEqual(science.pixel_has_data(x, y), abs(x - 10) + abs(y - 11) > 2)
+                self.assertEqual(variance.pixel_has_data(x, y), abs(x - 20) + abs(y - 5) > 2)
+
     def test_psi_and_phi_image(self):
         p = psf(0.00000001)  # A point function.
         img = layered_image("small_test", 6, 5, 2.0, 4.0, 10.0, p)
@@ -307,6 +355,7 @@ class test_layered_image(unittest.TestCase):
             mask1 = im1.get_mask()
             mask1.set_pixel(3, 5, 1.0)
             mask1.set_pixel(5, 3, 1.0)
+            mask1.set_pixel(7, 2, 2**20 + 3)
             im1.set_mask(mask1)
 
             # Save the test data.
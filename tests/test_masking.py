@@ -1,10 +1,13 @@
 import unittest
 
+import numpy as np
+
 from kbmod.masking import (
     BitVectorMasker,
     DictionaryMasker,
     GlobalDictionaryMasker,
     GrowMask,
+    ImageMasker,
     ThresholdMask,
     apply_mask_operations,
 )
@@ -168,6 +171,68 @@ class test_masking_classes(unittest.TestCase):
                 for y in range(self.dim_y):
                     self.assertEqual(sci.pixel_has_data(x, y), x != 1 or y != 1)
 
+    def test_apply_mask_operations_matches_sequential(self):
+        class RowMasker(BitVectorMasker):
+            # A custom masker that is applied with its own apply_mask.
+            def apply_mask(self, stack):
+                for i in range(stack.img_count()):
+                    img = stack.get_single_image(i)
+                    sci = img.get_science()
+                    sci.set_pixel(0, 0, KB_NO_DATA)
+                    img.set_science(sci)
+                    stack.set_single_image(i, img)
+                return stack
+
+        def make_stack():
+            rng = np.random.default_rng(1234)
+            imlist = []
+            for i in range(self.img_count):
+                img = layered_image(
+                    str(i), self.dim_x, self.dim_y, self.noise_level, self.variance, i, self.p, i
+                )
+                sci = img.get_science()
+                msk = img.get_mask()
+                for x, y in rng.integers(0, self.dim_x, size=(20, 2)):
+                    sci.set_pixel(int(x), int(y), float(rng.uniform(0.0, 2.0)))
+                    msk.set_pixel(int(y), int(x), float(rng.integers(1, 64)))
+                img.set_science(sci)
+                img.set_mask(msk)
+                imlist.append(img)
+            return image_stack(imlist)
+
+        mask_lists = [
+            [
+                DictionaryMasker(self.mask_bits_dict, ["BAD", "INTRP"]),
+                GlobalDictionaryMasker(self.mask_bits_dict, ["CR", "EDGE"], 2),
+                ThresholdMask(1.5),
+                GrowMask(1),
+                BitVectorMasker(32, [33]),
+                GrowMask(2),
+            ],
+            [
+                GrowMask(1),
+                BitVectorMasker(2, []),
+                RowMasker(0, []),
+                GlobalDictionaryMasker(self.mask_bits_dict, ["SAT"], 3),
+                GrowMask(1),
+                ThresholdMask(1.0),
+            ],
+        ]
+        for mask_list in mask_lists:
+            expected = make_stack()
+            for mask in mask_list:
+                expected = mask.apply_mask(expected)
+            result = apply_mask_operations(make_stack(), mask_list)
+
+            for i in range(self.img_count):
+                img1 = expected.get_single_image(i)
+                img2 = result.get_single_image(i)
+                self.assertTrue(np.array_equal(np.array(img1.get_science()), np.array(img2.get_science())))
+                self.assertTrue(np.array_equal(np.array(img1.get_variance()), np.array(img2.get_variance())))
+            self.assertTrue(
+                np.array_equal(np.array(expected.get_global_mask()), np.array(result.get_global_mask()))
+            )
+
 
 class test_run_search_masking(unittest.TestCase):
     def setUp(self):
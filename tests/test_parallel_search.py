@@ -0,0 +1,194 @@
+import unittest
+
+import numpy as np
+
+from kbmod.parallel_search import (
+    SharedPsiPhi,
+    configure_search,
+    grid_ranges,
+    merge_pixel_results,
+    merge_results,
+    parallel_search,
+    shard_bounds,
+)
+from kbmod.search import *
+
+
+class test_parallel_search(unittest.TestCase):
+    def setUp(self):
+        self.imCount = 10
+        self.dim_x = 40
+        self.dim_y = 35
+        self.p = psf(1.0)
+
+        self.imlist = []
+        for i in range(self.imCount):
+            time = i / self.imCount
+            im = layered_image(str(i), self.dim_x, self.dim_y, 2.0, 4.0, time, self.p, i)
+            im.add_object(7 + time * 21.0 + 0.5, 9 + time * 16.0 + 0.5, 150.0)
+            self.imlist.append(im)
+        self.stack = image_stack(self.imlist)
+
+        self.search_args = [20, 20, 0.0, 1.5, 5.0, 40.0, int(self.imCount / 2)]
+        self.settings = {"results_per_pixel": 4, "result_filter": [-1.0, -1]}
+
+    def _single_results(self, settings):
+        search = stack_search(self.stack)
+        configure_search(search, settings)
+        search.search(*self.search_args)
+        return search.get_results(0, 100000)
+
+    def _to_tuples(self, results):
+        return sorted([(r.x, r.y, r.x_v, r.y_v, r.lh, r.flux, r.obs_count) for r in results])
+
+    def test_shard_bounds(self):
+        self.assertEqual(shard_bounds(0, 10, 3), [[0, 3], [3, 6], [6, 10]])
+        self.assertEqual(shard_bounds(-5, 15, 2, 4), [[-5, 4], [4, 15]])
+        self.assertEqual(shard_bounds(0, 2, 5), [[0, 1], [1, 2]])
+        self.assertEqual(shard_bounds(0, 10, 3, 8), [[0, 8], [8, 10]])
+
+    def test_merge_results(self):
+        dtype = stack_search(self.stack).get_results_array().dtype
+        a = np.zeros(3, dtype=dtype)
+        a["lh"] = [5.0, 3.0, 1.0]
+        a["x"] = 0
+        b = np.zeros(2, dtype=dtype)
+        b["lh"] = [4.0, 3.0]
+        b["x"] = 1
+
+        merged = merge_results([a, b])
+        self.assertEqual(merged["lh"].tolist(), [5.0, 4.0, 3.0, 3.0, 1.0])
+        self.assertEqual(merged["x"].tolist(), [0, 1, 0, 1, 0])
+        self.assertEqual(len(merge_results([a, b], 2)), 2)
+
+    def test_grid_ranges(self):
+        self.assertEqual(grid_ranges(10, 5, 2), [[0, 5, 0, 5], [5, 10, 0, 5]])
+        self.assertEqual(grid_ranges(3, 4, 1, 2), [[0, 3, 0, 2], [0, 3, 2, 4]])
+
+    def test_merge_pixel_results(self):
+        dtype = stack_search(self.stack).get_results_array().dtype
+        a = np.zeros(4, dtype=dtype)
+        a["x"] = [0, 0, 1, 1]
+        a["lh"] = [5.0, 1.0, 2.0, 1.0]
+        a["x_v"] = 1.0
+        b = np.zeros(4, dtype=dtype)
+        b["x"] = [0, 0, 1, 1]
+        b["lh"] = [4.0, 3.0, 2.0, 0.5]
+        b["x_v"] = 2.0
+
+        # Each pixel keeps its best two results (ties keep the first array's result).
+        merged = merge_pixel_results([a, b], 2)
+        self.assertEqual(merged["lh"].tolist(), [5.0, 4.0, 2.0, 2.0])
+        self.assertEqual(merged["x"].tolist(), [0, 0, 1, 1])
+        self.assertEqual(merged["x_v"].tolist(), [1.0, 2.0, 1.0, 2.0])
+        self.assertEqual(merge_pixel_results([a, b], 1)["lh"].tolist(), [5.0, 2.0])
+        self.assertEqual(len(merge_pixel_results([a, b], 2, 3)), 3)
+        self.assertEqual(len(merge_pixel_results([a[:0]], 2)), 0)
+
+    def test_shared_psi_phi(self):
+        search = stack_search(self.stack)
+        shared = SharedPsiPhi.from_search(search)
+        try:
+            worker_search = shared.make_search()
+            psi = worker_search.get_psi_images()
+            phi = worker_search.get_phi_images()
+            for i, img in enumerate(search.get_psi_images()):
+                self.assertTrue(psi[i].approx_equal(img, 1e-6))
+            for i, img in enumerate(search.get_phi_images()):
+                self.assertTrue(phi[i].approx_equal(img, 1e-6))
+            self.assertEqual(worker_search.get_image_stack().get_times(), self.stack.get_times())
+        finally:
+            shared.unlink()
+
+        # The psi and phi images must match the stack.
+        self.assertRaises(RuntimeError, worker_search.set_psi_phi, psi[1:], phi[1:])
+        self.assertRaises(RuntimeError, worker_search.set_psi_phi_array, np.zeros((2, 3, 4, 5)))
+
+        # The worker's stack has no pixel data.
+        worker_stack = worker_search.get_image_stack()
+        self.assertFalse(worker_stack.has_pixels())
+        self.assertTrue(self.stack.has_pixels())
+        self.assertEqual(worker_stack.img_count(), self.imCount)
+        self.assertEqual(worker_stack.get_width(), self.dim_x)
+        self.assertEqual(worker_stack.get_height(), self.dim_y)
+        self.assertRaises(IndexError, worker_stack.get_single_image, 0)
+        self.assertRaises(RuntimeError, worker_stack.append_images, self.imlist[:1])
+
+    def test_psi_phi_array(self):
+        search = stack_search(self.stack)
+        cube = np.zeros((2, self.imCount, self.dim_y, self.dim_x), dtype=np.float32)
+        search.fill_psi_phi_array(cube)
+        for i, img in enumerate(search.get_psi_images()):
+            self.assertTrue(np.array_equal(cube[0, i], np.array(img)))
+        for i, img in enumerate(search.get_phi_images()):
+            self.assertTrue(np.array_equal(cube[1, i], np.array(img)))
+
+        # The array must be a writable C contiguous float32 array of the right shape.
+        self.assertRaises(RuntimeError, search.fill_psi_phi_array, cube[:, 1:])
+        self.assertRaises(RuntimeError, search.fill_psi_phi_array, cube.astype(np.float64))
+        self.assertRaises(RuntimeError, search.fill_psi_phi_array, np.asfortranarray(cube))
+
+        # A search of a stack without pixel data can use the array, but not generate it.
+        other = stack_search(image_stack(self.dim_x, self.dim_y, self.stack.get_times()))
+        self.assertRaises(RuntimeError, other.prepare_psi_phi)
+        other.set_psi_phi_array(cube)
+        for i, img in enumerate(search.get_psi_images()):
+            self.assertTrue(other.get_psi_images()[i].approx_equal(img, 1e-6))
+
+        # A prefix of the array is used as is and the rest is generated from the stack.
+        prefix = stack_search(self.stack)
+        prefix.set_psi_phi_prefix(cube[:, :2] + 1.0)
+        for i, img in enumerate(search.get_psi_images()):
+            expected = np.array(img) + (1.0 if i < 2 else 0.0)
+            self.assertTrue(np.allclose(np.array(prefix.get_psi_images()[i]), expected))
+        self.assertRaises(RuntimeError, prefix.set_psi_phi_prefix, np.zeros((2, self.imCount + 1, 4, 5)))
+
+    def test_parallel_matches_single(self):
+        expected = self._single_results(self.settings)
+        self.assertGreater(len(expected), 0)
+
+        search = stack_search(self.stack)
+        parallel_search(search, self.search_args, self.settings, 2, num_shards=3)
+        results = search.get_results(0, 100000)
+        self.assertEqual(self._to_tuples(results), self._to_tuples(expected))
+
+        # The results are sorted by likelihood.
+        lh = [r.lh for r in results]
+        self.assertEqual(lh, sorted(lh, reverse=True))
+
+    def test_parallel_matches_single_options(self):
+        settings = {
+            "results_per_pixel": 4,
+            "result_filter": [1.0, 50],
+            "coarse_search": [4, 1.0],
+            "y_bounds": [-3, 30],
+            "x_bounds": [2, 38],
+        }
+        expected = self._single_results(settings)
+        self.assertEqual(len(expected), 50)
+
+        search = stack_search(self.stack)
+        parallel_search(search, self.search_args, settings, 2, num_shards=3)
+        self.assertEqual(self._to_tuples(search.get_results(0, 100000)), self._to_tuples(expected))
+
+    def test_grid_shards_match_single(self):
+        # Trajectories with the same likelihood at a pixel may be swapped, so only
+        # compare the likelihoods and fluxes.
+        key = lambda res: sorted([(r.x, r.y, r.lh, r.flux, r.obs_count) for r in res])
+        for dedup in [False, True]:
+            settings = {"results_per_pixel": 4, "result_filter": [0.0, -1], "dedup_trajectories": dedup}
+            expected = self._single_results(settings)
+
+            search = stack_search(self.stack)
+            ranges = grid_ranges(self.search_args[0], self.search_args[1], 3)
+            parallel_search(search, self.search_args, settings, 2, num_shards=2, ranges=ranges)
+            self.assertEqual(key(search.get_results(0, 100000)), key(expected))
+
+            search = stack_search(self.stack)
+            ranges = grid_ranges(self.search_args[0], self.search_args[1], 2, 2)
+            parallel_search(search, self.search_args, settings, 2, ranges=ranges)
+            self.assertEqual(key(search.get_results(0, 100000)), key(expected))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,7 @@
 import unittest
 
+import numpy as np
+
 from kbmod.search import psf
 
 
@@ -58,6 +60,19 @@ class test_psf(unittest.TestCase):
             self.assertEqual(x.get_size(), p.get_size())
             self.assertEqual(x.get_radius(), p.get_radius())
 
+    def test_separable_kernels(self):
+        for p in self.psf_list:
+            row_kernel, col_kernel = p.get_separable_kernels()
+            self.assertEqual(len(row_kernel), p.get_dim())
+            self.assertEqual(len(col_kernel), p.get_dim())
+            kernel = np.outer(col_kernel, row_kernel)
+            self.assertTrue(np.allclose(kernel, np.array(p), atol=1e-6))
+
+        # A kernel with rank 2 is not separable.
+        self.assertIsNone(
+            psf(np.array([[0.0, 0.0, 0.0], [0.0, 0.5, 0.4], [0.0, 0.1, 0.0]])).get_separable_kernels()
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,152 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from kbmod.analysis_utils import Interface
+from kbmod.configuration import KBMODConfig
+from kbmod.psi_phi_cache import PsiPhiCache, psi_phi_cache_keys
+from kbmod.run_search import run_search
+from kbmod.search import *
+
+
+class test_psi_phi_cache(unittest.TestCase):
+    def setUp(self):
+        self.input_parameters = {
+            "im_filepath": "../data/demo",
+            "v_arr": [0, 20, 21],
+            "ang_arr": [0.5, 0.5, 11],
+            "num_obs": 7,
+            "lh_level": 10.0,
+            "mask_num_images": 10,
+            "average_angle": 0.0,
+            "do_clustering": False,
+            "do_stamp_filter": False,
+        }
+
+    def make_keys(self, **kwargs):
+        config = KBMODConfig()
+        config.set_from_dict(dict(self.input_parameters, **kwargs))
+        stack, img_info = Interface().load_images(
+            config["im_filepath"], None, None, None, psf(config["psf_val"]), verbose=False
+        )
+        return psi_phi_cache_keys(config, stack, img_info)
+
+    def test_keys(self):
+        keys = self.make_keys()
+        self.assertEqual(len(keys), 10)
+        self.assertEqual(len(set(keys)), 10)
+        self.assertEqual(keys, self.make_keys())
+
+        # The search parameters do not matter, but the masking parameters and PSF do.
+        self.assertEqual(keys, self.make_keys(v_arr=[0, 10, 11], num_obs=5))
+        self.assertNotEqual(keys[0], self.make_keys(mask_grow=5)[0])
+        self.assertNotEqual(keys[0], self.make_keys(psf_val=2.0)[0])
+
+        # With global masking only the full set of images has a key.
+        global_keys = self.make_keys(repeated_flag_keys=["EDGE"])
+        self.assertEqual(global_keys[:9], [None] * 9)
+        self.assertNotEqual(global_keys[9], keys[9])
+
+        with tempfile.TemporaryDirectory() as dir_name:
+            # The keys depend on the file contents, not the directory, and the
+            # keys of the first images do not depend on the later images.
+            for visit_file in sorted(os.listdir("../data/demo"))[:7]:
+                shutil.copy(os.path.join("../data/demo", visit_file), dir_name)
+            self.assertEqual(keys[:7], self.make_keys(im_filepath=dir_name))
+
+    def test_load_save(self):
+        p = psf(1.0)
+        imlist = [layered_image(str(i), 20, 15, 2.0, 4.0, i / 5.0, p, i) for i in range(5)]
+        search = stack_search(image_stack(imlist))
+
+        with tempfile.TemporaryDirectory() as dir_name:
+            cache = PsiPhiCache(os.path.join(dir_name, "cache"))
+            search2 = stack_search(image_stack(imlist))
+            self.assertFalse(cache.load(search2, "abc"))
+
+            cache.save(search, "abc")
+            self.assertTrue(os.path.exists(cache.filename("abc")))
+            self.assertTrue(cache.load(search2, "abc"))
+            for i in range(5):
+                self.assertTrue(search2.get_psi_images()[i].approx_equal(search.get_psi_images()[i], 0.0))
+                self.assertTrue(search2.get_phi_images()[i].approx_equal(search.get_phi_images()[i], 0.0))
+
+            # The cached images must match the search's stack.
+            search3 = stack_search(image_stack(imlist[:4]))
+            self.assertRaises(RuntimeError, cache.load, search3, "abc")
+
+    def test_make_search(self):
+        p = psf(1.0)
+        imlist = [layered_image(str(i), 20, 15, 2.0, 4.0, i / 5.0, p, i) for i in range(5)]
+        stack = image_stack(imlist)
+        expected = stack_search(stack)
+        expected.prepare_psi_phi()
+
+        with tempfile.TemporaryDirectory() as dir_name:
+            cache = PsiPhiCache(dir_name)
+            search, num_cached = cache.make_search(stack, ["a", "b", "c", "d", "e"])
+            self.assertEqual(num_cached, 0)
+            self.assertTrue(os.path.exists(cache.filename("e")))
+
+            # Only the first three images are cached under their own key.
+            cache.save(stack_search(image_stack(imlist[:3])), "c")
+            search, num_cached = cache.make_search(stack, ["a", "b", "c", "d", "f"])
+            self.assertEqual(num_cached, 3)
+            self.assertEqual(search.get_image_stack().get_times(), stack.get_times())
+            for i in range(5):
+                self.assertTrue(search.get_psi_images()[i].approx_equal(expected.get_psi_images()[i], 0.0))
+                self.assertTrue(search.get_phi_images()[i].approx_equal(expected.get_phi_images()[i], 0.0))
+
+            search, num_cached = cache.make_search(stack, ["a", "b", "c", "d", "f"])
+            self.assertEqual(num_cached, 5)
+
+            # Images without a key are not cached.
+            search, num_cached = cache.make_search(stack, [None, None, None, None, "g"])
+            self.assertEqual(num_cached, 0)
+            self.assertTrue(os.path.exists(cache.filename("g")))
+
+    def check_results(self, keep, expected):
+        self.assertEqual(keep.num_results(), expected.num_results())
+        for j in range(keep.num_results()):
+            trj = keep.results[j].trajectory
+            exp = expected.results[j].trajectory
+            self.assertEqual((trj.x, trj.y, trj.x_v, trj.y_v), (exp.x, exp.y, exp.x_v, exp.y_v))
+            self.assertEqual(trj.lh, exp.lh)
+
+    def test_run_search_cache(self):
+        expected = run_search(self.input_parameters).run_search()
+        self.assertGreater(expected.num_results(), 0)
+
+        with tempfile.TemporaryDirectory() as dir_name:
+            self.input_parameters["psi_phi_cache_dir"] = dir_name
+            for i in range(2):
+                keep = run_search(self.input_parameters).run_search()
+                self.assertEqual(len(os.listdir(dir_name)), 1)
+                self.check_results(keep, expected)
+
+    def test_run_search_new_images(self):
+        self.input_parameters["num_obs"] = 5
+        expected = run_search(self.input_parameters).run_search()
+        self.assertGreater(expected.num_results(), 0)
+
+        with tempfile.TemporaryDirectory() as dir_name:
+            im_dir = os.path.join(dir_name, "images")
+            cache_dir = os.path.join(dir_name, "cache")
+            os.mkdir(im_dir)
+            visit_files = sorted(os.listdir("../data/demo"))
+            for visit_file in visit_files[:7]:
+                shutil.copy(os.path.join("../data/demo", visit_file), im_dir)
+            params = dict(self.input_parameters, im_filepath=im_dir, psi_phi_cache_dir=cache_dir)
+            run_search(params).run_search()
+
+            # Add the rest of the images and search again, reusing the first seven.
+            for visit_file in visit_files[7:]:
+                shutil.copy(os.path.join("../data/demo", visit_file), im_dir)
+            keep = run_search(params).run_search()
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+            self.check_results(keep, expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -363,6 +363,47 @@ class test_raw_image(unittest.TestCase):
                 # Compute the manually computed result with the convolution.
                 self.assertAlmostEqual(img2.get_pixel(x, y), ave, delta=0.001)
 
+    def test_convolve_methods_cpu(self):
+        rng = np.random.default_rng(100)
+        data = rng.normal(size=(40, 50)).astype(np.float32)
+        data[rng.random(data.shape) < 0.1] = KB_NO_DATA
+        data[:, 3] = KB_NO_DATA
+        img = raw_image(data)
+
+        # A Gaussian (separable) PSF and a random (not separable) one.
+        psfs = [psf(1.2), psf(rng.random((7, 7)).astype(np.float32))]
+        self.assertIsNotNone(psfs[0].get_separable_kernels())
+        self.assertIsNone(psfs[1].get_separable_kernels())
+
+        for p in psfs:
+            expected = raw_image(img)
+            expected.convolve_cpu(p, CONVOLVE_DIRECT)
+            expected = np.array(expected)
+            self.assertTrue(np.array_equal(expected == KB_NO_DATA, data == KB_NO_DATA))
+
+            for method in [CONVOLVE_AUTO, CONVOLVE_SEPARABLE, CONVOLVE_FFT]:
+                img2 = raw_image(img)
+                if method == CONVOLVE_SEPARABLE and p is psfs[1]:
+                    self.assertRaises(RuntimeError, img2.convolve_cpu, p, method)
+                    continue
+                img2.convolve_cpu(p, method)
+                self.assertTrue(np.allclose(np.array(img2), expected, atol=1e-4))
+
+    def test_convolve_fft_tiles(self):
+        # Images larger than one FFT tile are convolved one tile at a time.
+        rng = np.random.default_rng(102)
+        data = rng.normal(size=(200, 300)).astype(np.float32)
+        data[rng.random(data.shape) < 0.05] = KB_NO_DATA
+        img = raw_image(data)
+
+        for size in [9, 41]:
+            p = psf(rng.random((size, size)).astype(np.float32))
+            expected = raw_image(img)
+            expected.convolve_cpu(p, CONVOLVE_DIRECT)
+            img2 = raw_image(img)
+            img2.convolve_cpu(p, CONVOLVE_FFT)
+            self.assertTrue(np.allclose(np.array(img2), np.array(expected), atol=1e-4))
+
     def test_grow_mask(self):
         self.img.set_pixel(5, 7, KB_NO_DATA)
         self.img.set_pixel(3, 7, KB_NO_DATA)
@@ -386,6 +427,27 @@ class test_raw_image(unittest.TestCase):
                 dist = min([abs(3 - x) + abs(7 - y), abs(5 - x) + abs(7 - y)])
                 self.assertEqual(self.img.pixel_has_data(x, y), dist > 3)
 
+    def test_grow_mask_random(self):
+        rng = np.random.default_rng(101)
+        data = rng.normal(size=(23, 31)).astype(np.float32)
+        data[rng.random(data.shape) < 0.02] = KB_NO_DATA
+        data[0, 30] = KB_NO_DATA
+
+        for steps in range(5):
+            # Grow the mask one pixel at a time in the 4 directions.
+            expected = data == KB_NO_DATA
+            for _ in range(steps):
+                grown = expected.copy()
+                grown[1:, :] |= expected[:-1, :]
+                grown[:-1, :] |= expected[1:, :]
+                grown[:, 1:] |= expected[:, :-1]
+                grown[:, :-1] |= expected[:, 1:]
+                expected = grown
+
+            img = raw_image(data)
+            img.grow_mask(steps)
+            self.assertTrue(np.array_equal(np.array(img) == KB_NO_DATA, expected))
+
     def test_make_stamp(self):
         for x in range(self.width):
             for y in range(self.height):
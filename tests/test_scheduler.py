@@ -0,0 +1,138 @@
+import os
+import tempfile
+import time
+import unittest
+
+from kbmod.run_search import run_search
+from kbmod.scheduler import SQLiteWorkQueue, merge_search, run_worker, submit_search
+
+
+class test_scheduler(unittest.TestCase):
+    def setUp(self):
+        self.input_parameters = {
+            "im_filepath": "../data/demo",
+            "res_filepath": None,
+            "time_file": None,
+            "output_suffix": "DEMO",
+            "v_arr": [0, 20, 21],
+            "ang_arr": [0.5, 0.5, 11],
+            "num_obs": 7,
+            "do_mask": True,
+            "lh_level": 10.0,
+            "gpu_filter": True,
+            "sigmaG_lims": [15, 60],
+            "mom_lims": [37.5, 37.5, 1.5, 1.0, 1.0],
+            "peak_offset": [3.0, 3.0],
+            "chunk_size": 1000000,
+            "stamp_type": "cpp_median",
+            "clip_negative": True,
+            "mask_num_images": 10,
+            "cluster_type": "position",
+            "average_angle": 0.0,
+        }
+
+    def test_queue(self):
+        with tempfile.TemporaryDirectory() as dir_name:
+            queue = SQLiteWorkQueue(os.path.join(dir_name, "queue.db"), max_attempts=2)
+            id1 = queue.put("a", {"value": 1})
+            id2 = queue.put("a", {"value": 2})
+            id3 = queue.put("b", {"value": 3})
+            self.assertEqual(queue.counts("a"), {"pending": 2, "running": 0, "done": 0, "failed": 0})
+
+            # Tasks are claimed in order.
+            task = queue.claim("w1")
+            self.assertEqual(task.task_id, id1)
+            self.assertEqual(task.job, "a")
+            self.assertEqual(task.payload, {"value": 1})
+            self.assertEqual(task.attempts, 1)
+            self.assertTrue(queue.complete(task, "result1"))
+
+            # A failed task is retried until it runs out of attempts.
+            task = queue.claim("w1")
+            self.assertEqual(task.task_id, id2)
+            self.assertTrue(queue.fail(task, "error"))
+            task = queue.claim("w2")
+            self.assertEqual(task.task_id, id2)
+            self.assertEqual(task.attempts, 2)
+            self.assertTrue(queue.fail(task, "error"))
+            self.assertEqual(queue.counts("a"), {"pending": 0, "running": 0, "done": 1, "failed": 1})
+
+            tasks = queue.tasks("a")
+            self.assertEqual([t["task_id"] for t in tasks], [id1, id2])
+            self.assertEqual(tasks[0]["result"], "result1")
+            self.assertEqual(tasks[1]["error"], "error")
+
+            # Stale tasks go back to the queue.
+            task = queue.claim("w3")
+            self.assertEqual(task.task_id, id3)
+            self.assertEqual(queue.requeue_stale(1000.0), 0)
+            self.assertEqual(queue.requeue_stale(-1.0), 1)
+            self.assertEqual(queue.counts("b")["pending"], 1)
+            self.assertEqual(queue.claim("w3").task_id, id3)
+            self.assertIsNone(queue.claim("w3"))
+
+    def test_leases(self):
+        with tempfile.TemporaryDirectory() as dir_name:
+            queue = SQLiteWorkQueue(os.path.join(dir_name, "queue.db"))
+            queue.put("a", {"value": 1})
+
+            # A heartbeat keeps a running task from being requeued.
+            task = queue.claim("w1")
+            time.sleep(0.2)
+            self.assertTrue(queue.heartbeat(task))
+            self.assertEqual(queue.requeue_stale(0.1), 0)
+
+            # Once requeued, the first worker's lease is void.
+            self.assertEqual(queue.requeue_stale(-1.0), 1)
+            retry = queue.claim("w2")
+            self.assertEqual(retry.task_id, task.task_id)
+            self.assertNotEqual(retry.lease, task.lease)
+            self.assertFalse(queue.heartbeat(task))
+            self.assertFalse(queue.complete(task, "stale"))
+            self.assertFalse(queue.fail(task, "stale"))
+            self.assertEqual(queue.counts("a")["running"], 1)
+
+            self.assertTrue(queue.complete(retry, "result"))
+            self.assertFalse(queue.heartbeat(retry))
+            self.assertFalse(queue.fail(retry, "error"))
+            self.assertEqual(queue.tasks("a")[0]["result"], "result")
+
+    def test_distributed_matches_run_search(self):
+        expected = run_search(self.input_parameters).run_search()
+        self.assertGreaterEqual(expected.num_results(), 1)
+
+        with tempfile.TemporaryDirectory() as dir_name:
+            queue = SQLiteWorkQueue(os.path.join(dir_name, "queue.db"))
+            submit_search(queue, "demo", self.input_parameters, 3, num_angle_shards=2)
+            self.assertRaises(ValueError, submit_search, queue, "demo", self.input_parameters, 3)
+
+            # Two workers split the tasks.
+            self.assertEqual(run_worker(queue, dir_name, worker="w1", max_tasks=1), 1)
+            self.assertEqual(
+                run_worker(queue, dir_name, worker="w2", lease_timeout=60.0, heartbeat_interval=0.01), 5
+            )
+            self.assertEqual(queue.counts("demo")["done"], 6)
+
+            keep = merge_search(queue, "demo")
+            self.assertEqual(keep.num_results(), expected.num_results())
+            for i in range(keep.num_results()):
+                trj = keep.results[i].trajectory
+                exp = expected.results[i].trajectory
+                self.assertEqual((trj.x, trj.y, trj.x_v, trj.y_v), (exp.x, exp.y, exp.x_v, exp.y_v))
+                self.assertAlmostEqual(trj.lh, exp.lh, delta=1e-4)
+
+    def test_failed_tasks(self):
+        self.input_parameters["im_filepath"] = "./no_such_directory"
+        with tempfile.TemporaryDirectory() as dir_name:
+            queue = SQLiteWorkQueue(os.path.join(dir_name, "queue.db"), max_attempts=2)
+            submit_search(queue, "bad", self.input_parameters, 2)
+
+            # Each task is tried twice.
+            self.assertEqual(run_worker(queue, dir_name), 4)
+            self.assertEqual(queue.counts("bad")["failed"], 2)
+            self.assertRaises(RuntimeError, merge_search, queue, "bad")
+            self.assertRaises(ValueError, merge_search, queue, "unknown")
+
+
+if __name__ == "__main__":
+    unittest.main()
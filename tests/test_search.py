@@ -1,4 +1,5 @@
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
@@ -135,6 +136,25 @@ class test_search(unittest.TestCase):
                     )
                     self.assertAlmostEqual(phi[1].get_pixel(x, y), 1.0 / var.get_pixel(x, y), delta=1e-6)
 
+    def test_psiphi_matches_images(self):
+        # Mask a pixel in half of the images.
+        for i in range(0, self.imCount, 2):
+            var = self.imlist[i].get_variance()
+            var.set_pixel(self.masked_x, self.masked_y, KB_NO_DATA)
+            self.imlist[i].set_variance(var)
+        search = stack_search(image_stack(self.imlist))
+        search.prepare_psi_phi()
+        psi = search.get_psi_images()
+        phi = search.get_phi_images()
+
+        self.assertEqual(len(psi), self.imCount)
+        self.assertEqual(len(phi), self.imCount)
+        for i in range(self.imCount):
+            self.assertTrue(psi[i].approx_equal(self.imlist[i].generate_psi_image(), 0.0))
+            self.assertTrue(phi[i].approx_equal(self.imlist[i].generate_phi_image(), 0.0))
+        self.assertFalse(psi[0].pixel_has_data(self.masked_x, self.masked_y))
+        self.assertTrue(psi[1].pixel_has_data(self.masked_x, self.masked_y))
+
     def test_results(self):
         self.search.search(
             self.angle_steps,
@@ -242,6 +262,417 @@ class test_search(unittest.TestCase):
         self.assertAlmostEqual(best.x_v / trj.x_v, 1, delta=self.velocity_error)
         self.assertAlmostEqual(best.y_v / trj.y_v, 1, delta=self.velocity_error)
 
+    def test_results_match_curves(self):
+        self.search.set_start_bounds_x(10, 20)
+        self.search.set_start_bounds_y(10, 15)
+        self.search.search(10, 10, self.min_angle, self.max_angle, self.min_vel, self.max_vel, 0)
+
+        # We get RESULTS_PER_PIXEL (8) results for each of the 50 starting pixels
+        # and they are sorted by decreasing likelihood.
+        results = self.search.get_results(0, 1000)
+        self.assertEqual(len(results), 400)
+        for i in range(1, len(results)):
+            self.assertGreaterEqual(results[i - 1].lh, results[i].lh)
+
+        # The likelihood and flux of each result match those computed from its curves.
+        for trj in results[0:50]:
+            psi_sum = np.sum(self.search.psi_curves(trj))
+            phi_sum = np.sum(self.search.phi_curves(trj))
+            self.assertAlmostEqual(trj.lh, psi_sum / np.sqrt(phi_sum), delta=1e-3)
+            self.assertAlmostEqual(trj.flux, psi_sum / phi_sum, delta=1e-3)
+
+    def test_batched_curves(self):
+        self.search.set_start_bounds_x(10, 20)
+        self.search.set_start_bounds_y(10, 15)
+        self.search.search(10, 10, self.min_angle, self.max_angle, self.min_vel, self.max_vel, 0)
+        results = self.search.get_results(0, 1000)
+
+        # Add one trajectory that leaves the images.
+        trjs = results[0:99]
+        off_chip = trajectory()
+        off_chip.x = 70
+        off_chip.y = 50
+        off_chip.x_v = 50.0
+        off_chip.y_v = 50.0
+        trjs.append(off_chip)
+
+        # Use barycentric corrections for the second pass.
+        for use_corr in [False, True]:
+            if use_corr:
+                self.search.enable_corr([0.1, 0.01, -0.02, -0.3, 0.03, 0.01] * self.imCount)
+
+            psi, phi = self.search.psi_phi_curves(trjs)
+            self.assertEqual(psi.shape, (100, self.imCount))
+            self.assertEqual(phi.shape, (100, self.imCount))
+            self.assertEqual(psi.dtype, np.float32)
+            for i, trj in enumerate(trjs):
+                self.assertEqual(psi[i].tolist(), self.search.psi_curves(trj))
+                self.assertEqual(phi[i].tolist(), self.search.phi_curves(trj))
+
+            # Extract the curves for a range of results.
+            res_psi, res_phi = self.search.get_result_curves(10, 50)
+            self.assertEqual(res_psi.shape, (50, self.imCount))
+            self.assertTrue(np.array_equal(res_psi, psi[10:60]))
+            self.assertTrue(np.array_equal(res_phi, phi[10:60]))
+
+        # Ranges are clipped to the number of results.
+        res_psi, res_phi = self.search.get_result_curves(390, 50)
+        self.assertEqual(res_psi.shape, (10, self.imCount))
+        res_psi, res_phi = self.search.get_result_curves(1000, 50)
+        self.assertEqual(res_psi.shape, (0, self.imCount))
+
+    def test_results_array(self):
+        self.search.set_start_bounds_x(10, 20)
+        self.search.set_start_bounds_y(10, 15)
+        self.search.search(10, 10, self.min_angle, self.max_angle, self.min_vel, self.max_vel, 0)
+        results = self.search.get_results(0, 1000)
+
+        arr = self.search.get_results_array()
+        self.assertEqual(arr.shape, (400,))
+        self.assertEqual(arr.dtype.names, ("x_v", "y_v", "lh", "flux", "x", "y", "obs_count"))
+        self.assertFalse(arr.flags["OWNDATA"])
+        for i, trj in enumerate(results):
+            self.assertEqual(arr["x"][i], trj.x)
+            self.assertEqual(arr["y"][i], trj.y)
+            self.assertEqual(arr["x_v"][i], trj.x_v)
+            self.assertEqual(arr["y_v"][i], trj.y_v)
+            self.assertEqual(arr["lh"][i], trj.lh)
+            self.assertEqual(arr["flux"][i], trj.flux)
+            self.assertEqual(arr["obs_count"][i], trj.obs_count)
+
+        # The array can be used for vectorized cuts.
+        mask = (arr["lh"] > 5.0) & (arr["obs_count"] >= 10)
+        expected = [r.lh > 5.0 and r.obs_count >= 10 for r in results]
+        self.assertEqual(mask.tolist(), expected)
+
+        # The array is a view of the results.
+        arr["lh"][0] = 1000.0
+        self.assertEqual(self.search.get_results(0, 1)[0].lh, 1000.0)
+
+        # Empty results give an empty array.
+        self.search.set_results([])
+        self.assertEqual(len(self.search.get_results_array()), 0)
+
+    def test_concurrent_searches(self):
+        def run_search(mode):
+            search = stack_search(self.stack)
+            search.set_search_mode(mode)
+            search.set_start_bounds_x(0, 40)
+            search.set_start_bounds_y(0, 30)
+            search.search(20, 20, self.min_angle, self.max_angle, self.min_vel, self.max_vel, 10)
+            psi, phi = search.get_result_curves(0, 100)
+            return search.get_results_array().copy(), psi
+
+        modes = [SearchMode.SEARCH_GRID, SearchMode.SEARCH_SHIFT_STACK, SearchMode.SEARCH_TREE] * 2
+        expected = [run_search(mode) for mode in modes]
+        with ThreadPoolExecutor(max_workers=len(modes)) as executor:
+            results = list(executor.map(run_search, modes))
+
+        for i in range(len(modes)):
+            self.assertTrue(np.array_equal(results[i][0], expected[i][0]))
+            self.assertTrue(np.array_equal(results[i][1], expected[i][1]))
+
+    def _search_results(self, search_mode, sigmag=False):
+        search = stack_search(self.stack)
+        search.set_search_mode(search_mode)
+        search.set_start_bounds_x(-5, 30)
+        search.set_start_bounds_y(-5, 20)
+        if sigmag:
+            search.enable_gpu_sigmag_filter([0.25, 0.75], 0.7413, 0.0)
+        search.search(20, 20, self.min_angle, self.max_angle, self.min_vel, self.max_vel, 0)
+
+        results = search.get_results(0, 100000)
+        return sorted([(r.x, r.y, r.x_v, r.y_v, r.lh, r.flux, r.obs_count) for r in results])
+
+    def test_shift_stack_matches_grid(self):
+        grid = self._search_results(SearchMode.SEARCH_GRID)
+        shift_stack = self._search_results(SearchMode.SEARCH_SHIFT_STACK)
+        self.assertEqual(len(grid), 35 * 25 * 8)
+        self.assertEqual(grid, shift_stack)
+
+    def test_shift_stack_matches_grid_sigmag(self):
+        grid = self._search_results(SearchMode.SEARCH_GRID, True)
+        shift_stack = self._search_results(SearchMode.SEARCH_SHIFT_STACK, True)
+        self.assertEqual(grid, shift_stack)
+
+    def _assert_results_close(self, expected, results):
+        # The sums are added in a different order, so the LH and flux can differ by rounding.
+        self.assertEqual(len(results), len(expected))
+        for res, exp in zip(results, expected):
+            self.assertEqual(res[:4] + res[6:], exp[:4] + exp[6:])
+            self.assertAlmostEqual(res[4], exp[4], delta=1e-4 * max(1.0, abs(exp[4])))
+            self.assertAlmostEqual(res[5], exp[5], delta=1e-4 * max(1.0, abs(exp[5])))
+
+    def test_tree_matches_grid(self):
+        grid = self._search_results(SearchMode.SEARCH_GRID)
+        tree = self._search_results(SearchMode.SEARCH_TREE)
+        self._assert_results_close(grid, tree)
+
+    def test_tree_matches_grid_sigmag(self):
+        grid = self._search_results(SearchMode.SEARCH_GRID, True)
+        tree = self._search_results(SearchMode.SEARCH_TREE, True)
+        self._assert_results_close(grid, tree)
+
+    def test_tree_many_images(self):
+        # Enough images and velocities for several levels of shared sequences.
+        rng = np.random.default_rng(103)
+        p = psf(1.0)
+        imlist = []
+        for i in range(37):
+            im = layered_image(str(i), 150, 20, 2.0, 4.0, i / 36.0, p, i)
+            sci = im.get_science()
+            sci.set_pixel(int(rng.integers(150)), int(rng.integers(20)), KB_NO_DATA)
+            im.set_science(sci)
+            imlist.append(im)
+        stack = image_stack(imlist)
+
+        results = []
+        for mode in [SearchMode.SEARCH_GRID, SearchMode.SEARCH_TREE]:
+            search = stack_search(stack)
+            search.set_search_mode(mode)
+            search.set_start_bounds_x(-3, 153)
+            search.set_start_bounds_y(-2, 22)
+            search.search(16, 16, -0.5, 1.0, 2.0, 30.0, 0)
+            found = search.get_results(0, 100000)
+            results.append(sorted([(r.x, r.y, r.x_v, r.y_v, r.lh, r.flux, r.obs_count) for r in found]))
+        self._assert_results_close(results[0], results[1])
+
+    def test_dedup_trajectories(self):
+        self.search.set_start_bounds_x(10, 20)
+        self.search.set_start_bounds_y(10, 15)
+        self.search.search(20, 20, self.min_angle, self.max_angle, self.min_vel, self.max_vel, 0)
+        self.assertEqual(self.search.get_num_trajectories(), 400)
+        self.assertEqual(self.search.get_num_duplicate_trajectories(), 0)
+        full_results = self.search.get_results(0, 1000)
+
+        search = stack_search(self.stack)
+        search.set_dedup_trajectories(True)
+        search.set_start_bounds_x(10, 20)
+        search.set_start_bounds_y(10, 15)
+        search.search(20, 20, self.min_angle, self.max_angle, self.min_vel, self.max_vel, 0)
+        num_dups = search.get_num_duplicate_trajectories()
+        self.assertGreater(num_dups, 0)
+        self.assertEqual(search.get_num_trajectories() + num_dups, 400)
+
+        # The best result for each starting pixel is unchanged.
+        dedup_results = search.get_results(0, 1000)
+        full_best = {}
+        for r in full_results:
+            if (r.x, r.y) not in full_best or r.lh > full_best[(r.x, r.y)].lh:
+                full_best[(r.x, r.y)] = r
+        dedup_best = {}
+        for r in dedup_results:
+            if (r.x, r.y) not in dedup_best or r.lh > dedup_best[(r.x, r.y)].lh:
+                dedup_best[(r.x, r.y)] = r
+        self.assertEqual(len(dedup_best), 50)
+        for key, r in dedup_best.items():
+            self.assertEqual(r.lh, full_best[key].lh)
+            self.assertEqual(r.obs_count, full_best[key].obs_count)
+
+    def test_grid_range(self):
+        self.search.set_dedup_trajectories(True)
+        self.search.set_start_bounds_x(10, 20)
+        self.search.set_start_bounds_y(10, 15)
+        self.search.search(20, 20, self.min_angle, self.max_angle, self.min_vel, self.max_vel, 0)
+        full_best = {}
+        for r in self.search.get_results(0, 1000):
+            if (r.x, r.y) not in full_best or r.lh > full_best[(r.x, r.y)].lh:
+                full_best[(r.x, r.y)] = r
+
+        best = {}
+        num_searched = 0
+        num_total = 0
+        for grid_range in [[0, 8, 0, -1], [8, 20, 0, 5], [8, -1, 5, 20]]:
+            search = stack_search(self.stack)
+            search.set_dedup_trajectories(True)
+            search.set_grid_range(*grid_range)
+            search.set_start_bounds_x(10, 20)
+            search.set_start_bounds_y(10, 15)
+            search.search(20, 20, self.min_angle, self.max_angle, self.min_vel, self.max_vel, 0)
+            num_searched += search.get_num_trajectories()
+            num_total += search.get_num_trajectories() + search.get_num_duplicate_trajectories()
+            for r in search.get_results(0, 1000):
+                if (r.x, r.y) not in best or r.lh > best[(r.x, r.y)].lh:
+                    best[(r.x, r.y)] = r
+
+        # The ranges cover the grid and each unique trajectory is searched in one of them.
+        self.assertEqual(num_total, 400)
+        self.assertEqual(num_searched, self.search.get_num_trajectories())
+
+        # The best result for each starting pixel is the same.
+        self.assertEqual(len(best), 50)
+        for key, r in best.items():
+            self.assertEqual(
+                (r.x_v, r.y_v, r.lh), (full_best[key].x_v, full_best[key].y_v, full_best[key].lh)
+            )
+
+        self.assertRaises(RuntimeError, self.search.set_grid_range, -1, 5, 0, 5)
+        self.assertRaises(RuntimeError, self.search.set_grid_range, 5, 4, 0, 5)
+
+    def test_append_images(self):
+        self.search.set_start_bounds_x(10, 30)
+        self.search.set_start_bounds_y(5, 20)
+        self.search.search(20, 20, self.min_angle, self.max_angle, self.min_vel, self.max_vel, 10)
+        expected = self.search.get_results_array().tolist()
+
+        # Only the new images' psi and phi images are generated when appending.
+        search = stack_search(image_stack(self.imlist[:15]))
+        search.prepare_psi_phi()
+        old_psi = search.get_psi_images()
+        search.append_images(self.imlist[15:])
+        self.assertEqual(search.get_num_images(), self.imCount)
+        self.assertEqual(search.get_image_stack().get_times(), self.stack.get_times())
+
+        psi = search.get_psi_images()
+        full_psi = self.search.get_psi_images()
+        for i in range(self.imCount):
+            self.assertTrue(psi[i].approx_equal(full_psi[i], 0.0))
+        for i in range(15):
+            self.assertTrue(psi[i].approx_equal(old_psi[i], 0.0))
+
+        # The search matches a search of all of the images.
+        search.set_start_bounds_x(10, 30)
+        search.set_start_bounds_y(5, 20)
+        search.search(20, 20, self.min_angle, self.max_angle, self.min_vel, self.max_vel, 10)
+        self.assertEqual(search.get_results_array().tolist(), expected)
+
+        search.enable_corr([0.0] * 6 * self.imCount)
+        self.assertRaises(RuntimeError, search.append_images, self.imlist[:1])
+
+    def test_coarse_search(self):
+        self.search.enable_coarse_search(2, 10.0)
+        self.search.search(
+            self.angle_steps,
+            self.velocity_steps,
+            self.min_angle,
+            self.max_angle,
+            self.min_vel,
+            self.max_vel,
+            int(self.imCount / 2),
+        )
+
+        # Only the blocks around promising coarse results are refined.
+        results = self.search.get_results(0, 100000)
+        self.assertLess(len(results), self.dim_x * self.dim_y * 8)
+
+        best = results[0]
+        self.assertAlmostEqual(best.x, self.start_x, delta=self.pixel_error)
+        self.assertAlmostEqual(best.y, self.start_y, delta=self.pixel_error)
+        self.assertAlmostEqual(best.x_v / self.x_vel, 1, delta=self.velocity_error)
+        self.assertAlmostEqual(best.y_v / self.y_vel, 1, delta=self.velocity_error)
+        self.assertAlmostEqual(best.flux / self.object_flux, 1, delta=self.flux_error)
+
+    def test_lh_pruning(self):
+        results = []
+        for prune in [False, True]:
+            search = stack_search(self.stack)
+            search.set_lh_pruning(prune)
+            search.search(30, 30, self.min_angle, self.max_angle, self.min_vel, self.max_vel, 15)
+            if prune:
+                self.assertGreater(search.get_num_skipped_samples(), 0)
+            else:
+                self.assertEqual(search.get_num_skipped_samples(), 0)
+
+            res = search.get_results(0, 100000)
+            results.append(sorted([(r.x, r.y, r.x_v, r.y_v, r.lh, r.flux, r.obs_count) for r in res]))
+
+        # Pruning does not change the results.
+        self.assertEqual(results[0], results[1])
+
+    def test_results_per_pixel(self):
+        self.search.set_results_per_pixel(3)
+        self.search.set_start_bounds_x(10, 20)
+        self.search.set_start_bounds_y(10, 15)
+        self.search.search(10, 10, self.min_angle, self.max_angle, self.min_vel, self.max_vel, 0)
+        self.assertEqual(len(self.search.get_results(0, 1000)), 150)
+
+        self.assertRaises(RuntimeError, self.search.set_results_per_pixel, 0)
+        self.assertRaises(RuntimeError, self.search.set_results_per_pixel, 1000)
+
+    def test_result_filter(self):
+        self.search.set_start_bounds_x(0, 40)
+        self.search.set_start_bounds_y(0, 30)
+        self.search.search(20, 20, self.min_angle, self.max_angle, self.min_vel, self.max_vel, 10)
+        all_results = self.search.get_results(0, 100000)
+
+        search = stack_search(self.stack)
+        search.enable_result_filter(5.0, 25)
+        search.set_start_bounds_x(0, 40)
+        search.set_start_bounds_y(0, 30)
+        search.search(20, 20, self.min_angle, self.max_angle, self.min_vel, self.max_vel, 10)
+        results = search.get_results(0, 100000)
+
+        # We get the best 25 results (which all pass the filter).
+        expected = [r.lh for r in all_results if r.lh >= 5.0][0:25]
+        self.assertEqual(len(expected), 25)
+        self.assertEqual([r.lh for r in results], expected)
+        for r in results:
+            self.assertGreaterEqual(r.obs_count, 10)
+
+        # Without a limit we get all of the results above the threshold.
+        search = stack_search(self.stack)
+        search.enable_result_filter(5.0, -1)
+        search.set_start_bounds_x(0, 40)
+        search.set_start_bounds_y(0, 30)
+        search.search(20, 20, self.min_angle, self.max_angle, self.min_vel, self.max_vel, 10)
+        results = search.get_results(0, 100000)
+        self.assertEqual(len(results), len([r for r in all_results if r.lh >= 5.0]))
+
+    def test_search_many_images(self):
+        # Search more images than fit in the GPU kernel's local filtering arrays.
+        num_images = 160
+        imlist = []
+        for i in range(num_images):
+            time = i / num_images
+            im = layered_image(str(i), 30, 20, self.noise_level, self.variance, time, self.p, i)
+            im.add_object(5 + time * self.x_vel + 0.5, 2 + time * self.y_vel + 0.5, self.object_flux)
+            imlist.append(im)
+        stack = image_stack(imlist)
+
+        for sigmag in [False, True]:
+            search = stack_search(stack)
+            if sigmag:
+                search.enable_gpu_sigmag_filter([0.25, 0.75], 0.7413, 0.0)
+            search.search(20, 20, self.min_angle, self.max_angle, self.min_vel, self.max_vel, 80)
+
+            best = search.get_results(0, 1)[0]
+            self.assertEqual(best.x, 5)
+            self.assertEqual(best.y, 2)
+            self.assertAlmostEqual(best.x_v / self.x_vel, 1, delta=self.velocity_error)
+            self.assertAlmostEqual(best.y_v / self.y_vel, 1, delta=self.velocity_error)
+            self.assertGreater(best.obs_count, 80)
+
+    def test_gpu_strip_sizing(self):
+        # Small stacks and unfiltered searches use one strip and no scratch space.
+        self.assertEqual(gpu_search_strip_height(MAX_NUM_IMAGES, 4000, 4000, True), 4000)
+        self.assertEqual(gpu_scratch_bytes(MAX_NUM_IMAGES, 4000, 4000, True), 0)
+        self.assertEqual(gpu_search_strip_height(1000, 4000, 4000, False), 4000)
+        self.assertEqual(gpu_scratch_bytes(1000, 4000, 4000, False), 0)
+
+        # Large filtered stacks use strips whose scratch space fits in MAX_SCRATCH_BYTES.
+        for num_images, width, height in [
+            (141, 4000, 4000),
+            (300, 4096, 4096),
+            (1000, 100, 50),
+            (500, 10, 7),
+        ]:
+            rows = gpu_search_strip_height(num_images, width, height, True)
+            self.assertGreaterEqual(rows, 1)
+            self.assertLessEqual(rows, height)
+            scratch = gpu_scratch_bytes(num_images, width, rows, True)
+            self.assertEqual(scratch, 16 * num_images * width * rows)
+            self.assertLessEqual(scratch, MAX_SCRATCH_BYTES)
+            if rows < height:
+                self.assertGreater(gpu_scratch_bytes(num_images, width, rows + 1, True), MAX_SCRATCH_BYTES)
+        self.assertEqual(
+            gpu_search_strip_height(300, 4096, 4096, True), MAX_SCRATCH_BYTES // (16 * 300 * 4096)
+        )
+
+        # A row that does not fit still gets searched (one row at a time) and the sizes
+        # do not overflow 32 bits.
+        self.assertEqual(gpu_search_strip_height(100000, 100000, 10, True), 1)
+        self.assertEqual(gpu_scratch_bytes(100000, 100000, 1, True), 16 * 100000 * 100000)
+
     def test_sci_viz_stamps(self):
         sci_stamps = self.search.science_viz_stamps(self.trj, 2)
         self.assertEqual(len(sci_stamps), self.imCount)
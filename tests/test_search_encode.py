@@ -127,6 +127,31 @@ class test_search_filter(unittest.TestCase):
         self.assertAlmostEqual(best.y_v / self.y_vel, 1, delta=self.velocity_error)
         self.assertAlmostEqual(best.flux / self.object_flux, 1, delta=self.flux_error)
 
+    def _encoded_results(self, search_mode, psi_bytes, phi_bytes, sigmag):
+        search = stack_search(self.stack)
+        search.set_search_mode(search_mode)
+        search.enable_gpu_encoding(psi_bytes, phi_bytes)
+        search.set_start_bounds_x(25, 45)
+        search.set_start_bounds_y(0, 15)
+        if sigmag:
+            search.enable_gpu_sigmag_filter(self.sigmaG_lims, self.sigmaG_coeff, 0.0)
+        search.search(20, 20, self.min_angle, self.max_angle, self.min_vel, self.max_vel, 0)
+
+        results = search.get_results(0, 100000)
+        return sorted([(r.x, r.y, r.x_v, r.y_v, r.lh, r.flux, r.obs_count) for r in results])
+
+    def test_encoded_matches_quantized(self):
+        # The grid search reads the encoded images directly while the shift-stack
+        # search reads decoded float images, so the results must be identical.
+        for psi_bytes, phi_bytes in [(1, 1), (2, 2), (1, -1), (-1, 2)]:
+            for sigmag in [False, True]:
+                grid = self._encoded_results(SearchMode.SEARCH_GRID, psi_bytes, phi_bytes, sigmag)
+                shift_stack = self._encoded_results(
+                    SearchMode.SEARCH_SHIFT_STACK, psi_bytes, phi_bytes, sigmag
+                )
+                self.assertEqual(len(grid), 20 * 15 * 8)
+                self.assertEqual(grid, shift_stack)
+
 
 if __name__ == "__main__":
     unittest.main()